@@ -1,22 +1,48 @@
 """Type stub file for SmartKDB v5."""
 
-from typing import Dict, List, Any, Optional, Literal
+from typing import Dict, List, Any, AsyncIterator, Callable, Iterator, Optional, Literal, Set, Tuple, Union
 from enum import Enum
 
 # Core Engine
 class KTable:
     """Represents a database table."""
-    def __init__(self, db: SmartKDB, name: str, pk: str = ..., indexes: Optional[List[str]] = ...) -> None: ...
+    auto_compact_ratio: Optional[float]
+    auto_compact_min_bytes: int
+    last_compaction: Optional[Dict[str, Any]]
+    codec: str
+    pk_index: str
+    load_stats: Dict[str, float]
+    def __init__(self, db: SmartKDB, name: str, pk: str = ..., indexes: Optional[List[Any]] = ..., codec: Literal["json", "binary"] = ..., pk_index: Literal["hash", "compact"] = ..., create: bool = ...) -> None: ...
+    @property
+    def id_index(self) -> Any: ...
+    @property
+    def secondary_indexes(self) -> Dict[str, Any]: ...
     def insert(self, doc: Dict[str, Any], transaction_id: Optional[str] = ...) -> Dict[str, Any]: ...
-    def get(self, id_val: str) -> Optional[Dict[str, Any]]: ...
+    def insert_many(self, docs: List[Dict[str, Any]], transaction_id: Optional[str] = ...) -> List[Dict[str, Any]]: ...
+    def get(self, id_val: str, transaction_id: Optional[str] = ..., as_of: Optional[float] = ...) -> Optional[Dict[str, Any]]: ...
+    def get_many(self, ids: List[str], transaction_id: Optional[str] = ...) -> List[Optional[Dict[str, Any]]]: ...
     def update(self, id_val: str, updates: Dict[str, Any], transaction_id: Optional[str] = ...) -> Dict[str, Any]: ...
+    def update_many(self, pairs: List[Tuple[str, Dict[str, Any]]], transaction_id: Optional[str] = ...) -> List[Dict[str, Any]]: ...
     def delete(self, id_val: str, transaction_id: Optional[str] = ...) -> None: ...
-    def query(self) -> QueryBuilder: ...
+    def scan(self) -> Iterator[Dict[str, Any]]: ...
+    def query(self, transaction_id: Optional[str] = ...) -> QueryBuilder: ...
+    def compact(self) -> Dict[str, Any]: ...
+    def close(self) -> None: ...
 
 class QueryBuilder:
     """Query builder for fluent query construction."""
-    def __init__(self, table: KTable) -> None: ...
+    transaction_id: Optional[str]
+    def __init__(self, table: KTable, transaction_id: Optional[str] = ...) -> None: ...
     def where(self, field: str, op: str, value: Any) -> QueryBuilder: ...
+    def order_by(self, field: str, desc: bool = ...) -> QueryBuilder: ...
+    def limit(self, n: int) -> QueryBuilder: ...
+    def offset(self, k: int) -> QueryBuilder: ...
+    def as_of(self, timestamp: float) -> QueryBuilder: ...
+    def iter(self) -> Iterator[Dict[str, Any]]: ...
+    def __iter__(self) -> Iterator[Dict[str, Any]]: ...
+    def first(self) -> Optional[Dict[str, Any]]: ...
+    def exists(self) -> bool: ...
+    def explain(self) -> Dict[str, Any]: ...
     def execute(self) -> List[Dict[str, Any]]: ...
 
 class SmartKDB:
@@ -26,10 +52,17 @@ class SmartKDB:
     Provides a cognitive, AI-native embedded database with ACID transactions,
     versioning, and distributed capabilities.
     """
-    def __init__(self, path: str = ...) -> None: ...
-    def create_table(self, name: str, pk: str = ..., indexes: Optional[List[str]] = ...) -> KTable: ...
+    def __init__(self, path: str = ..., durability: Literal["none", "on_commit", "every_n_ms", "always"] = ..., fsync_interval_ms: int = ..., cache_bytes: int = ..., multiprocess: bool = ..., post_commit_queue: int = ...) -> None: ...
+    multiprocess: bool
+    post_commit: PostCommitPipeline
+    cache: RecordCache
+    last_recovery: Dict[str, int]
+    def create_table(self, name: str, pk: str = ..., indexes: Optional[List[Any]] = ..., codec: Literal["json", "binary"] = ..., pk_index: Literal["hash", "compact"] = ...) -> KTable: ...
     def get_table(self, name: str) -> KTable: ...
     def login(self, user: str, password: str) -> None: ...
+    def close(self) -> None: ...
+    def __enter__(self) -> SmartKDB: ...
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None: ...
     
     # Properties
     @property
@@ -43,12 +76,89 @@ class SmartKDB:
     @property
     def auth(self) -> AuthManager: ...
 
+# Asyncio API
+class AsyncSmartKDB:
+    """Asyncio front end of SmartKDB backed by a thread pool."""
+    db: SmartKDB
+    def __init__(self, path: Union[str, SmartKDB] = ..., max_workers: int = ..., read_batch: int = ..., write_batch: int = ..., **options: Any) -> None: ...
+    async def create_table(self, name: str, **options: Any) -> AsyncKTable: ...
+    async def get_table(self, name: str) -> AsyncKTable: ...
+    def transaction(self, deferred: bool = ..., snapshot: bool = ...) -> AsyncTransaction: ...
+    async def begin(self, deferred: bool = ..., snapshot: bool = ...) -> AsyncTransaction: ...
+    async def close(self) -> None: ...
+    async def __aenter__(self) -> AsyncSmartKDB: ...
+    async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> None: ...
+
+class AsyncKTable:
+    """Awaitable counterpart of KTable with batched reads and writes."""
+    table: KTable
+    name: str
+    stats: Dict[str, int]
+    async def get(self, id_val: str, transaction_id: Optional[str] = ..., as_of: Optional[float] = ...) -> Optional[Dict[str, Any]]: ...
+    async def get_many(self, ids: List[str], transaction_id: Optional[str] = ...) -> List[Optional[Dict[str, Any]]]: ...
+    async def insert(self, doc: Dict[str, Any], transaction_id: Optional[str] = ...) -> Dict[str, Any]: ...
+    async def insert_many(self, docs: List[Dict[str, Any]], transaction_id: Optional[str] = ...) -> List[Dict[str, Any]]: ...
+    async def update(self, id_val: str, updates: Dict[str, Any], transaction_id: Optional[str] = ...) -> Dict[str, Any]: ...
+    async def update_many(self, pairs: List[Tuple[str, Dict[str, Any]]], transaction_id: Optional[str] = ...) -> List[Dict[str, Any]]: ...
+    async def delete(self, id_val: str, transaction_id: Optional[str] = ...) -> None: ...
+    async def flush(self) -> None: ...
+    def query(self, transaction_id: Optional[str] = ...) -> AsyncQuery: ...
+    def scan(self, batch_size: int = ...) -> AsyncCursor: ...
+    async def compact(self) -> Dict[str, Any]: ...
+
+class AsyncQuery:
+    """Awaitable wrapper of QueryBuilder."""
+    def where(self, field: str, op: str, value: Any) -> AsyncQuery: ...
+    def order_by(self, field: str, desc: bool = ...) -> AsyncQuery: ...
+    def limit(self, n: int) -> AsyncQuery: ...
+    def offset(self, k: int) -> AsyncQuery: ...
+    def as_of(self, timestamp: float) -> AsyncQuery: ...
+    async def execute(self) -> List[Dict[str, Any]]: ...
+    async def first(self) -> Optional[Dict[str, Any]]: ...
+    async def exists(self) -> bool: ...
+    async def explain(self) -> Dict[str, Any]: ...
+    def cursor(self, batch_size: Optional[int] = ...) -> AsyncCursor: ...
+    def __aiter__(self) -> AsyncCursor: ...
+
+class AsyncCursor(AsyncIterator[Dict[str, Any]]):
+    """Streams documents in batches fetched on the thread pool."""
+    def __aiter__(self) -> AsyncCursor: ...
+    async def __anext__(self) -> Dict[str, Any]: ...
+    async def aclose(self) -> None: ...
+
+class AsyncTransaction:
+    """Transaction of an AsyncSmartKDB; commits or rolls back as an async context manager."""
+    id: Optional[str]
+    deferred: bool
+    snapshot: bool
+    async def begin(self) -> str: ...
+    async def commit(self) -> bool: ...
+    async def rollback(self) -> bool: ...
+    async def __aenter__(self) -> AsyncTransaction: ...
+    async def __aexit__(self, exc_type: Any, exc: Any, tb: Any) -> None: ...
+
+class RecordCache:
+    """Size-bounded LRU cache of decoded documents."""
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    def __init__(self, max_bytes: int = ...) -> None: ...
+    def get(self, key: Any) -> Optional[Dict[str, Any]]: ...
+    def put(self, key: Any, doc: Dict[str, Any]) -> None: ...
+    def discard(self, key: Any) -> None: ...
+    def clear(self) -> None: ...
+    def stats(self) -> Dict[str, Any]: ...
+
 class AuthManager:
     """Authentication and authorization manager."""
     def __init__(self, db: SmartKDB) -> None: ...
     def create_user(self, username: str, password: str, role: str) -> None: ...
 
 # Transaction System
+class WriteConflictError(ValueError):
+    """A snapshot transaction wrote a key changed after its snapshot."""
+
 class TransactionState(Enum):
     ACTIVE: str
     COMMITTED: str
@@ -58,24 +168,103 @@ class Transaction:
     """Represents a database transaction."""
     id: str
     state: TransactionState
-    def add_operation(self, table: str, op_type: str, data: Any, original_data: Optional[Any] = ...) -> None: ...
+    deferred: bool
+    snapshot_ts: Optional[int]
+    write_set: Dict[str, Dict[Any, Optional[Dict[str, Any]]]]
+    created: Dict[str, Set[Any]]
+    post_commit: List[Tuple[str, List[Tuple[Any, Optional[Dict[str, Any]]]], bool]]
+    def add_operation(self, table: str, op_type: str, data: Any, original_data: Optional[Any] = ..., key: Any = ...) -> None: ...
     def create_savepoint(self, name: str) -> None: ...
     def rollback_to_savepoint(self, name: str) -> List[Dict[str, Any]]: ...
 
 class TransactionManager:
     """Manages ACID transactions."""
-    def begin(self) -> str: ...
+    checkpoint_bytes: int
+    wal: WriteAheadLog
+    clock: int
+    snapshots: Dict[str, int]
+    def begin(self, deferred: bool = ..., snapshot: bool = ...) -> str: ...
+    def begin_change(self) -> None: ...
+    def end_change(self) -> None: ...
+    def oldest_snapshot(self) -> Optional[int]: ...
     def commit(self, tx_id: str) -> bool: ...
     def rollback(self, tx_id: str) -> bool: ...
     def get_transaction(self, tx_id: str) -> Optional[Transaction]: ...
+    def log_operations(self, tx_id: str, table: str, ops: List[Tuple[str, Any, Any, Any, Any]]) -> None: ...
+    def recover(self) -> Dict[str, int]: ...
+    def checkpoint(self) -> bool: ...
+    def close(self) -> None: ...
+
+class WriteAheadLog:
+    """Per-database log of transactional writes."""
+    path: str
+    next_lsn: int
+    def __init__(self, path: str, durability: str = ..., fsync_interval_ms: int = ...) -> None: ...
+    @property
+    def size(self) -> int: ...
+    def entries(self) -> Iterator[Dict[str, Any]]: ...
+    def log_ops(self, tx_id: str, table: str, changes: List[Tuple[Any, Any, Any]]) -> int: ...
+    def log_commit(self, tx_id: str) -> int: ...
+    def log_abort(self, tx_id: str) -> int: ...
+    def analyze(self) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]: ...
+    def reset(self) -> None: ...
+    def close(self) -> None: ...
 
 # Versioning
+class HistoryStore:
+    """Append-only, segmented history of one table."""
+    path: str
+    segment_bytes: int
+    snapshot_every: int
+    prune_interval: Optional[float]
+    retention: Dict[str, float]
+    last_prune: Optional[Dict[str, Any]]
+    def __init__(self, path: str, segment_bytes: int = ..., snapshot_every: int = ..., prune_interval: Optional[float] = ..., multiprocess: bool = ...) -> None: ...
+    def append(self, entries: List[Tuple[Any, float, Optional[Dict[str, Any]]]]) -> None: ...
+    def rotate(self) -> int: ...
+    def segments(self) -> List[str]: ...
+    def versions(self, key: Any) -> List[Tuple[float, int]]: ...
+    def version_at(self, key: Any, timestamp: float, default: Any = ...) -> Optional[Dict[str, Any]]: ...
+    def read(self, position: int) -> Optional[Dict[str, Any]]: ...
+    def history(self, key: Any) -> List[Dict[str, Any]]: ...
+    def keys_at(self, timestamp: float) -> Set[Any]: ...
+    def scan_at(self, timestamp: float) -> Iterator[Dict[str, Any]]: ...
+    def set_retention(self, max_age: Optional[float] = ..., max_versions: Optional[int] = ..., keep_one_per: Optional[float] = ...) -> None: ...
+    def prune(self) -> Dict[str, Any]: ...
+    def close(self) -> None: ...
+
 class VersionManager:
     """Manages data versioning and time-travel queries."""
-    def __init__(self, db_path: str) -> None: ...
-    def archive_record(self, table: str, record_id: str, data: Dict[str, Any], timestamp: Optional[float] = ...) -> None: ...
+    history_path: str
+    segment_bytes: int
+    snapshot_every: int
+    prune_interval: Optional[float]
+    drain: Optional[Callable[[], Any]]
+    def __init__(self, db_path: str, segment_bytes: int = ..., snapshot_every: int = ..., prune_interval: Optional[float] = ..., multiprocess: bool = ...) -> None: ...
+    def store(self, table: str) -> HistoryStore: ...
+    def rotate(self, table: str) -> int: ...
+    def set_retention(self, table: str, max_age: Optional[float] = ..., max_versions: Optional[int] = ..., keep_one_per: Optional[float] = ...) -> None: ...
+    def retention(self, table: str) -> Dict[str, float]: ...
+    def prune(self, table: str) -> Dict[str, Any]: ...
+    def close(self) -> None: ...
+    def archive_record(self, table: str, record_id: str, data: Optional[Dict[str, Any]], timestamp: Optional[float] = ...) -> None: ...
+    def archive_records(self, table: str, records: List[Tuple[str, Optional[Dict[str, Any]]]], timestamp: Optional[float] = ...) -> None: ...
     def get_version_at(self, table: str, record_id: str, timestamp: float) -> Optional[Dict[str, Any]]: ...
     def get_history(self, table: str, record_id: str) -> List[Dict[str, Any]]: ...
+    def scan_at(self, table: str, timestamp: float) -> Iterator[Dict[str, Any]]: ...
+
+class PostCommitPipeline:
+    """Applies history appends and replication of committed writes on a background worker."""
+    version_manager: VersionManager
+    node_manager: NodeManager
+    max_pending: int
+    batch_size: int
+    last_error: Optional[str]
+    def __init__(self, version_manager: VersionManager, node_manager: NodeManager, max_pending: int = ..., batch_size: int = ...) -> None: ...
+    def submit(self, table: str, records: List[Tuple[Any, Optional[Dict[str, Any]]]], replicate: bool = ...) -> None: ...
+    def flush(self, timeout: Optional[float] = ...) -> bool: ...
+    def stats(self) -> Dict[str, Any]: ...
+    def close(self) -> None: ...
 
 # Distributed
 class NodeManager:
@@ -83,6 +272,7 @@ class NodeManager:
     def __init__(self, my_address: str, peers: Optional[List[str]] = ...) -> None: ...
     def join_cluster(self, seed_node: str) -> None: ...
     def broadcast_update(self, table: str, record_id: str, data: Dict[str, Any]) -> None: ...
+    def broadcast_updates(self, table: str, records: List[Tuple[str, Dict[str, Any]]]) -> None: ...
     def get_cluster_status(self) -> Dict[str, Any]: ...
 
 # AI Layer
@@ -4,14 +4,36 @@ SmartKDB v5 - The Cognitive AI-Native Database Platform
 
 __version__ = "5.0.5"
 
+from importlib import import_module
+
 from .core.engine import SmartKDB, KTable, QueryBuilder
-from .core.transaction import Transaction, TransactionManager, TransactionState
+from .core.transaction import Transaction, TransactionManager, TransactionState, WriteConflictError
 from .core.versioning import VersionManager
 from .core.distributed import NodeManager
-from .ai.brain import Brain
-from .ai.trainer import Trainer
-from .ai.llm_connectors import LLMConnector
-from .plugins.manager import PluginManager
+
+# Optional components, imported on first attribute access (PEP 562)
+_LAZY_ATTRS = {
+    "Brain": ".ai.brain",
+    "Trainer": ".ai.trainer",
+    "LLMConnector": ".ai.llm_connectors",
+    "PluginManager": ".plugins.manager",
+    "AsyncSmartKDB": ".core.aio",
+    "AsyncKTable": ".core.aio",
+}
+
+
+def __getattr__(name):
+    module = _LAZY_ATTRS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
+
 
 __all__ = [
     "SmartKDB",
@@ -20,12 +42,15 @@ __all__ = [
     "Transaction",
     "TransactionManager",
     "TransactionState",
+    "WriteConflictError",
     "VersionManager",
     "NodeManager",
     "Brain",
     "Trainer",
     "LLMConnector",
     "PluginManager",
+    "AsyncSmartKDB",
+    "AsyncKTable",
 ]
 
 __author__ = "Alhdrawi"
@@ -0,0 +1,429 @@
+"""
+Asyncio interface to SmartKDB.
+
+Every call runs on a bounded thread pool, so the event loop never waits
+on file I/O. Point reads of a table issued in the same loop iteration are
+served together by one ``get_many``; writes queue per table behind the
+batch being applied and are then applied together, consecutive inserts
+and updates as one ``insert_many`` / ``update_many`` (one append, one
+index save and at most one fsync), which keeps tail latency flat when
+many requests write at once.
+"""
+
+import asyncio
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, List, Any, Iterator, Optional, Tuple, Union
+
+from .engine import SmartKDB, KTable, QueryBuilder
+
+# Writes that are applied as one bulk call when consecutive in a batch
+_BULK_WRITES = {"insert": "insert_many", "update": "update_many"}
+
+
+class AsyncSmartKDB:
+    """
+    Awaitable facade over a SmartKDB database.
+
+    Use it from one event loop. Results are the same objects the
+    synchronous API returns.
+
+    Attributes:
+        db: The underlying SmartKDB instance, usable from synchronous code
+        read_batch: Most keys served by one ``get_many``
+        write_batch: Most writes applied by one pool task
+
+    Example:
+        >>> async with AsyncSmartKDB("app.kdb", durability="on_commit") as db:
+        ...     users = await db.create_table("users", indexes=["email"])
+        ...     await users.insert({"id": "u1", "email": "alice@example.com"})
+        ...     async with db.transaction() as tx:
+        ...         await users.update("u1", {"plan": "pro"}, transaction_id=tx.id)
+        ...     async for user in users.query().where("plan", "==", "pro"):
+        ...         print(user)
+    """
+
+    def __init__(self, path: Union[str, SmartKDB] = "mydb.kdb", max_workers: int = 8,
+                 read_batch: int = 256, write_batch: int = 256, **options: Any):
+        """
+        Open a database (or wrap an open one) for asyncio use.
+
+        Args:
+            path: Database directory, or an open SmartKDB instance to share
+            max_workers: Size of the I/O thread pool
+            read_batch: Most keys served by one batched point read
+            write_batch: Most writes applied by one pool task
+            **options: SmartKDB options (durability, cache_bytes, ...)
+        """
+        self.db = path if isinstance(path, SmartKDB) else SmartKDB(path, **options)
+        self.read_batch = read_batch
+        self.write_batch = write_batch
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="smartkdb-io")
+        self._tables: Dict[str, AsyncKTable] = {}
+
+    def _submit(self, fn, *args: Any, **kwargs: Any) -> "asyncio.Future":
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _run(self, fn, *args: Any, **kwargs: Any) -> Any:
+        return await self._submit(fn, *args, **kwargs)
+
+    def _wrap(self, table: KTable) -> "AsyncKTable":
+        wrapped = self._tables.get(table.name)
+        if wrapped is None or wrapped.table is not table:
+            wrapped = self._tables[table.name] = AsyncKTable(self, table)
+        return wrapped
+
+    async def create_table(self, name: str, **options: Any) -> "AsyncKTable":
+        """Create a table; takes the options of ``SmartKDB.create_table``."""
+        return self._wrap(await self._run(self.db.create_table, name, **options))
+
+    async def get_table(self, name: str) -> "AsyncKTable":
+        """
+        Get an existing table.
+
+        Raises:
+            ValueError: If the table doesn't exist
+        """
+        return self._wrap(await self._run(self.db.get_table, name))
+
+    def transaction(self, deferred: bool = False, snapshot: bool = False) -> "AsyncTransaction":
+        """
+        A transaction to use with ``async with``: it begins on entry and
+        commits on exit, or rolls back if the block raised.
+        """
+        return AsyncTransaction(self, deferred, snapshot)
+
+    async def begin(self, deferred: bool = False, snapshot: bool = False) -> "AsyncTransaction":
+        """Start a transaction; finish it with ``commit`` or ``rollback``."""
+        tx = AsyncTransaction(self, deferred, snapshot)
+        await tx.begin()
+        return tx
+
+    async def close(self) -> None:
+        """Wait for queued writes, close the database and stop the thread pool."""
+        for table in list(self._tables.values()):
+            await table.flush()
+        await self._run(self.db.close)
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncSmartKDB":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+
+class AsyncKTable:
+    """
+    Awaitable counterpart of KTable.
+
+    Writes outside a transaction are queued and applied in order of
+    arrival, in batches; a failing write only fails its own caller.
+    Writes inside a transaction (``transaction_id``) go straight to the
+    pool.
+
+    Attributes:
+        table: The underlying KTable
+        stats: Counters of point reads, writes and the pool tasks serving them
+    """
+
+    def __init__(self, adb: AsyncSmartKDB, table: KTable):
+        self.adb = adb
+        self.table = table
+        self.name = table.name
+        self.stats = {"reads": 0, "read_batches": 0, "writes": 0, "write_batches": 0}
+        # transaction ID -> key -> futures waiting for it
+        self._reads: Dict[Optional[str], Dict[Any, List[asyncio.Future]]] = {}
+        self._reads_scheduled = False
+        self._writes: deque = deque()
+        self._writing = False
+
+    # -- Reads --------------------------------------------------------------
+
+    async def get(self, id_val: Any, transaction_id: Optional[str] = None,
+                  as_of: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Retrieve a document by primary key (batched with concurrent gets unless ``as_of`` is given)."""
+        if as_of is not None:
+            return await self.adb._run(self.table.get, id_val, transaction_id, as_of)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._reads.setdefault(transaction_id, {}).setdefault(id_val, []).append(future)
+        self.stats["reads"] += 1
+        if not self._reads_scheduled:
+            self._reads_scheduled = True
+            loop.call_soon(self._dispatch_reads)
+        return await future
+
+    async def get_many(self, ids: List[Any], transaction_id: Optional[str] = None) -> List[Optional[Dict[str, Any]]]:
+        """Retrieve several documents by primary key in one pool task."""
+        return await self.adb._run(self.table.get_many, ids, transaction_id)
+
+    def _dispatch_reads(self) -> None:
+        self._reads_scheduled = False
+        reads, self._reads = self._reads, {}
+        for transaction_id, waiting in reads.items():
+            keys = list(waiting)
+            for start in range(0, len(keys), self.adb.read_batch):
+                chunk = keys[start:start + self.adb.read_batch]
+                task = self.adb._submit(self.table.get_many, chunk, transaction_id)
+                task.add_done_callback(functools.partial(self._resolve_reads, chunk, waiting))
+                self.stats["read_batches"] += 1
+
+    @staticmethod
+    def _resolve_reads(keys: List[Any], waiting: Dict[Any, List[asyncio.Future]], task: asyncio.Future) -> None:
+        error = task.exception()
+        docs = [None] * len(keys) if error else task.result()
+        for key, doc in zip(keys, docs):
+            for i, future in enumerate(waiting[key]):
+                if future.done():
+                    continue # Cancelled by its caller
+                if error:
+                    future.set_exception(error)
+                else:
+                    # Callers of the same key get their own copy
+                    future.set_result(doc if i == 0 or doc is None else dict(doc))
+
+    # -- Writes -------------------------------------------------------------
+
+    async def insert(self, doc: Dict[str, Any], transaction_id: Optional[str] = None) -> Dict[str, Any]:
+        """Insert a document; see ``KTable.insert``."""
+        return await self._write("insert", (doc,), transaction_id)
+
+    async def insert_many(self, docs: List[Dict[str, Any]], transaction_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Insert several documents; see ``KTable.insert_many``."""
+        return await self._write("insert_many", (docs,), transaction_id)
+
+    async def update(self, id_val: Any, updates: Dict[str, Any], transaction_id: Optional[str] = None) -> Dict[str, Any]:
+        """Update a document; see ``KTable.update``."""
+        return await self._write("update", (id_val, updates), transaction_id)
+
+    async def update_many(self, pairs: List[Tuple[Any, Dict[str, Any]]],
+                          transaction_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Update several documents; see ``KTable.update_many``."""
+        return await self._write("update_many", (pairs,), transaction_id)
+
+    async def delete(self, id_val: Any, transaction_id: Optional[str] = None) -> None:
+        """Delete a document; see ``KTable.delete``."""
+        return await self._write("delete", (id_val,), transaction_id)
+
+    async def flush(self) -> None:
+        """Wait until every write queued so far has been applied."""
+        if self._writing:
+            await self._write("flush", (), None)
+
+    async def _write(self, kind: str, args: tuple, transaction_id: Optional[str]) -> Any:
+        if transaction_id:
+            return await self.adb._run(getattr(self.table, kind), *args, transaction_id=transaction_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.append((kind, args, future))
+        if kind != "flush":
+            self.stats["writes"] += 1
+        if not self._writing:
+            # Give writers running in this loop iteration a chance to join
+            self._writing = True
+            loop.call_soon(self._dispatch_writes)
+        return await future
+
+    def _dispatch_writes(self) -> None:
+        if not self._writes:
+            self._writing = False
+            return
+        batch = [self._writes.popleft() for _ in range(min(len(self._writes), self.adb.write_batch))]
+        task = self.adb._submit(self._apply_writes, [(kind, args) for kind, args, _ in batch])
+        task.add_done_callback(functools.partial(self._resolve_writes, [future for _, _, future in batch]))
+        self.stats["write_batches"] += 1
+
+    def _resolve_writes(self, futures: List[asyncio.Future], task: asyncio.Future) -> None:
+        error = task.exception()
+        outcomes = [(None, error)] * len(futures) if error else task.result()
+        for future, (result, exc) in zip(futures, outcomes):
+            if future.done():
+                continue
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+        # Writes queued meanwhile form the next batch
+        self._dispatch_writes()
+
+    def _apply_writes(self, batch: List[Tuple[str, tuple]]) -> List[Tuple[Any, Optional[BaseException]]]:
+        """Apply a batch in order on a pool thread; returns (result, exception) per write."""
+        outcomes = []
+        start = 0
+        while start < len(batch):
+            kind = batch[start][0]
+            end = start + 1
+            if kind in _BULK_WRITES:
+                while end < len(batch) and batch[end][0] == kind:
+                    end += 1
+            outcomes.extend(self._apply_run(kind, [args for _, args in batch[start:end]]))
+            start = end
+        return outcomes
+
+    def _apply_run(self, kind: str, runs: List[tuple]) -> List[Tuple[Any, Optional[BaseException]]]:
+        if len(runs) > 1:
+            bulk = getattr(self.table, _BULK_WRITES[kind])
+            try:
+                if kind == "insert":
+                    return [(doc, None) for doc in bulk([doc for doc, in runs])]
+                return [(doc, None) for doc in bulk(runs)]
+            except (ValueError, TypeError):
+                # insert_many / update_many check keys and encode every
+                # document before changing anything, so the table is
+                # untouched: retry one by one to find the write that failed
+                pass
+
+        outcomes = []
+        for args in runs:
+            try:
+                result = None if kind == "flush" else getattr(self.table, kind)(*args)
+                outcomes.append((result, None))
+            except Exception as exc:
+                outcomes.append((None, exc))
+        return outcomes
+
+    # -- Queries ------------------------------------------------------------
+
+    def query(self, transaction_id: Optional[str] = None) -> "AsyncQuery":
+        """Create an async query builder; see ``KTable.query``."""
+        return AsyncQuery(self.adb, QueryBuilder(self.table, transaction_id))
+
+    def scan(self, batch_size: int = 256) -> "AsyncCursor":
+        """Stream every live document in file order; see ``KTable.scan``."""
+        return AsyncCursor(self.adb, self.table.scan(), batch_size)
+
+    async def compact(self) -> Dict[str, Any]:
+        """Reclaim dead space; see ``KTable.compact``."""
+        await self.flush()
+        return await self.adb._run(self.table.compact)
+
+
+class AsyncQuery:
+    """
+    Awaitable QueryBuilder. Filters and ordering are set as usual; results
+    come from ``await execute()`` or, streamed, ``async for``.
+    """
+
+    def __init__(self, adb: AsyncSmartKDB, builder: QueryBuilder, batch_size: int = 256):
+        self.adb = adb
+        self.builder = builder
+        self.batch_size = batch_size
+
+    def where(self, field: str, op: str, value: Any) -> "AsyncQuery":
+        self.builder.where(field, op, value)
+        return self
+
+    def order_by(self, field: str, desc: bool = False) -> "AsyncQuery":
+        self.builder.order_by(field, desc)
+        return self
+
+    def limit(self, n: int) -> "AsyncQuery":
+        self.builder.limit(n)
+        return self
+
+    def offset(self, k: int) -> "AsyncQuery":
+        self.builder.offset(k)
+        return self
+
+    def as_of(self, timestamp: float) -> "AsyncQuery":
+        self.builder.as_of(timestamp)
+        return self
+
+    async def execute(self) -> List[Dict[str, Any]]:
+        return await self.adb._run(self.builder.execute)
+
+    async def first(self) -> Optional[Dict[str, Any]]:
+        return await self.adb._run(self.builder.first)
+
+    async def exists(self) -> bool:
+        return await self.adb._run(self.builder.exists)
+
+    async def explain(self) -> Dict[str, Any]:
+        return await self.adb._run(self.builder.explain)
+
+    def cursor(self, batch_size: Optional[int] = None) -> "AsyncCursor":
+        """Stream the matches, ``batch_size`` per trip to the thread pool."""
+        return AsyncCursor(self.adb, self.builder.iter(), batch_size or self.batch_size)
+
+    def __aiter__(self) -> "AsyncCursor":
+        return self.cursor()
+
+
+class AsyncCursor:
+    """
+    Async iterator over a synchronous result stream, advanced on the thread
+    pool a batch at a time. Close it (``aclose``) when stopping early so the
+    underlying query releases the table at once.
+    """
+
+    def __init__(self, adb: AsyncSmartKDB, source: Iterator[Dict[str, Any]], batch_size: int = 256):
+        self.adb = adb
+        self.batch_size = batch_size
+        self._source: Optional[Iterator[Dict[str, Any]]] = source
+        self._buffer: deque = deque()
+
+    def _fetch(self) -> List[Dict[str, Any]]:
+        return list(islice(self._source, self.batch_size))
+
+    def __aiter__(self) -> "AsyncCursor":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        if not self._buffer:
+            if self._source is not None:
+                batch = await self.adb._run(self._fetch)
+                if len(batch) < self.batch_size:
+                    self._source = None # Exhausted
+                self._buffer.extend(batch)
+            if not self._buffer:
+                raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    async def aclose(self) -> None:
+        # Dropping the last reference finalizes the query generator
+        self._source = None
+        self._buffer.clear()
+
+
+class AsyncTransaction:
+    """
+    Transaction of an AsyncSmartKDB. Pass ``tx.id`` as ``transaction_id``
+    to table calls. As an async context manager it commits on success and
+    rolls back if the block raised.
+    """
+
+    def __init__(self, adb: AsyncSmartKDB, deferred: bool = False, snapshot: bool = False):
+        self.adb = adb
+        self.deferred = deferred
+        self.snapshot = snapshot
+        self.id: Optional[str] = None
+
+    async def begin(self) -> str:
+        self.id = await self.adb._run(self.adb.db.tx_manager.begin, deferred=self.deferred, snapshot=self.snapshot)
+        return self.id
+
+    async def commit(self) -> bool:
+        """
+        Commit the transaction.
+
+        Raises:
+            WriteConflictError: If a snapshot transaction lost a write-write conflict
+        """
+        return await self.adb._run(self.adb.db.tx_manager.commit, self.id)
+
+    async def rollback(self) -> bool:
+        return await self.adb._run(self.adb.db.tx_manager.rollback, self.id)
+
+    async def __aenter__(self) -> "AsyncTransaction":
+        await self.begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
@@ -0,0 +1,99 @@
+"""
+Decoded-record cache shared by the tables of a database.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Hashable, Optional
+
+
+def estimate_size(doc: Dict[str, Any]) -> int:
+    """Approximate memory held by a decoded document (top-level fields)."""
+    size = sys.getsizeof(doc)
+    for key, value in doc.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+class RecordCache:
+    """
+    Size-bounded LRU cache of decoded documents.
+
+    Entries are keyed by storage location. Records are never rewritten in
+    place, so a cached location stays valid until the table is compacted;
+    tables handle that by changing the key prefix they use.
+
+    Attributes:
+        max_bytes: Budget for the estimated size of cached documents
+        hits, misses, evictions: Running counters
+    """
+
+    def __init__(self, max_bytes: int = 32 << 20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Return a shallow copy of the cached document, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return dict(entry[0])
+
+    def put(self, key: Hashable, doc: Dict[str, Any]) -> None:
+        """Cache a private copy of ``doc``, evicting least recently used entries."""
+        if self.max_bytes <= 0:
+            return
+        charge = estimate_size(doc)
+        if charge > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (dict(doc), charge)
+            self.size += charge
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Cache counters.
+
+        Returns:
+            Dictionary with hits, misses, evictions, hit_ratio, entries,
+            size_bytes and max_bytes
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "size_bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
@@ -1,6 +1,5 @@
-import requests
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 
 class NodeManager:
     def __init__(self, my_address: str, peers: List[str] = None):
@@ -12,6 +11,7 @@ class NodeManager:
         """
         Join an existing cluster via a seed node.
         """
+        import requests
         try:
             response = requests.post(f"{seed_node}/cluster/join", json={"address": self.my_address})
             if response.status_code == 200:
@@ -30,6 +30,7 @@ class NodeManager:
         """
         if self.status != "clustered":
             return
+        import requests
 
         for peer in self.peers:
             if peer == self.my_address:
@@ -45,6 +46,27 @@ class NodeManager:
             except:
                 pass # Peer might be down
 
+    def broadcast_updates(self, table: str, records: List[Tuple[str, Dict[str, Any]]]):
+        """
+        Broadcast a batch of data updates to all peers, one request per peer.
+        """
+        if self.status != "clustered" or not records:
+            return
+        import requests
+
+        updates = [{"id": record_id, "data": data} for record_id, data in records]
+        for peer in self.peers:
+            if peer == self.my_address:
+                continue
+
+            try:
+                requests.post(f"{peer}/sync/batch", json={
+                    "table": table,
+                    "updates": updates
+                }, timeout=1)
+            except:
+                pass # Peer might be down
+
     def get_cluster_status(self) -> Dict[str, Any]:
         return {
             "status": self.status,
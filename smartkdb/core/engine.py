@@ -5,19 +5,78 @@ This module contains the main SmartKDB class and KTable class that provide
 the primary interface for database operations.
 """
 
+import functools
 import os
+import threading
+import time
 import uuid
-from typing import Dict, List, Any, Optional, TYPE_CHECKING
+from contextlib import ExitStack, contextmanager
+from itertools import islice
+from typing import Dict, List, Any, Iterator, Optional, Tuple, TYPE_CHECKING
 
-from .storage import BlockStorage
-from .index import Index, SecondaryIndex
-from .transaction import TransactionManager
+from .storage import BlockStorage, DURABILITY_POLICIES
+from .codec import get_codec
+from .cache import RecordCache
+from .index import Index, SecondaryIndex, OrderedIndex, INDEX_TYPES, PK_INDEX_TYPES, sort_key
+from .locks import RWLock, FileLock, SharedCounters, HAVE_FILE_LOCKS
+from .transaction import TransactionManager, WriteConflictError
 from .versioning import VersionManager
 from .distributed import NodeManager
+from .pipeline import PostCommitPipeline
 
 if TYPE_CHECKING:
     from ..ai.brain import Brain
 
+# Slots of a table's shared counters (multiprocess mode): changes published
+# by all processes, and the last publisher's dead bytes plus one (0: unknown)
+CHANGES_SLOT = 0
+DEAD_BYTES_SLOT = 1
+
+# KTable._find result for a record another process has just replaced
+_SUPERSEDED = object()
+
+
+def _shared(method):
+    """Run a KTable method under the table's read lock, after catching up with other processes."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._poll()
+        lock = self._lock
+        lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release_read()
+    return wrapper
+
+
+def _exclusive(method):
+    """
+    Run a KTable method under the table's write lock (and in multiprocess
+    mode its file lock), as one change on the transaction clock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self._lock
+        lock.acquire_write()
+        try:
+            if self._in_change:
+                return method(self, *args, **kwargs)
+            self._in_change = True
+            self.db.tx_manager.begin_change()
+            try:
+                if self._file_lock is None:
+                    return method(self, *args, **kwargs)
+                with self._cross_process_write():
+                    return method(self, *args, **kwargs)
+            finally:
+                self._in_change = False
+                self.db.tx_manager.end_change()
+        finally:
+            lock.release_write()
+    return wrapper
+
+
 class KTable:
     """
     Represents a database table in SmartKDB.
@@ -25,11 +84,18 @@ class KTable:
     A table stores documents (records) and provides CRUD operations with support
     for transactions, versioning, and distributed synchronization.
     
+    Tables can be shared between threads: reads take a shared lock,
+    writes (appends plus index mutation) an exclusive per-table lock. In
+    multiprocess mode writes also take the table's file lock, and every
+    call first catches up with changes published by other processes.
+    
     Attributes:
         db: The parent SmartKDB database instance
         name: Name of the table
         pk: Primary key field name
-        indexes_config: List of secondary indexed fields
+        indexes_config: Secondary index specs, as given to ``create_table``
+        codec: Record encoding for new writes ("json" or "binary")
+        pk_index: Primary key index type ("hash" or "compact")
     
     Example:
         >>> db = SmartKDB("mydb.kdb")
@@ -37,58 +103,167 @@ class KTable:
         >>> users.insert({"name": "Alice", "email": "alice@example.com"})
     """
     
-    def __init__(self, db, name: str, pk: str = "id", indexes: Optional[List[str]] = None):
+    # Compact automatically once deleted records make up this share of
+    # data.bin (None disables), but not before the file reaches min bytes.
+    auto_compact_ratio: Optional[float] = 0.5
+    auto_compact_min_bytes: int = 4 << 20
+
+    def __init__(self, db, name: str, pk: str = "id", indexes: Optional[List[Any]] = None,
+                 codec: str = "json", pk_index: str = "hash", create: bool = True):
         """
         Initialize a new KTable instance.
+
+        Indexes are loaded from disk on first use, so opening a table only
+        touches its metadata and data file; ``load_stats`` records the time
+        taken by the open and by each index load.
         
         Args:
             db: The parent SmartKDB instance
             name: Table name
             pk: Primary key field name (default: "id")
-            indexes: List of secondary indexed fields
+            indexes: Secondary indexes: field names for hash indexes, or
+                ``{"field": name, "type": "hash" | "ordered"}`` specs
+            codec: Record encoding for new writes: "json" (default) or the
+                faster, more compact "binary". Existing records keep the
+                encoding they were written with.
+            pk_index: "hash" (default, a dict in memory) or "compact", a
+                memory-mapped sorted index for very large tables
+            create: Write meta.json; False when opening an existing table
         """
+        started = time.perf_counter()
         self.db = db
         self.name = name
         self.pk = pk
         self.indexes_config = indexes or []
+        self.codec = get_codec(codec).name
+        if pk_index not in PK_INDEX_TYPES:
+            raise ValueError(f"Unknown primary key index type: {pk_index}")
+        self.pk_index = pk_index
+        self._index_types = dict(self._parse_index_spec(spec) for spec in self.indexes_config)
         
         # Storage paths
         self.table_dir = os.path.join(db.db_path, "tables", name)
         if not os.path.exists(self.table_dir):
             os.makedirs(self.table_dir)
             
-        # Save metadata
-        self._save_metadata()
+        if create or not os.path.exists(os.path.join(self.table_dir, "meta.json")):
+            self._save_metadata()
+
+        # Multiprocess mode: table.lock serializes the writers of all
+        # processes and counts the changes they publish, compact.lock
+        # serializes compactions
+        self._file_lock: Optional[FileLock] = None
+        self._compact_file_lock: Optional[FileLock] = None
+        self._counters: Optional[SharedCounters] = None
+        self._seen_changes = 0
+        if db.multiprocess:
+            lock_path = os.path.join(self.table_dir, "table.lock")
+            self._file_lock = FileLock(lock_path)
+            self._counters = SharedCounters(lock_path, 2)
+            self._seen_changes = self._counters.values[CHANGES_SLOT]
+            self._compact_file_lock = FileLock(os.path.join(self.table_dir, "compact.lock"))
+
+        with self._compacting():
+            self._recover_compaction()
             
-        self.storage = BlockStorage(os.path.join(self.table_dir, "data.bin"))
+        self.storage = BlockStorage(
+            os.path.join(self.table_dir, "data.bin"),
+            durability=db.durability,
+            fsync_interval_ms=db.fsync_interval_ms,
+            codec=codec,
+        )
+        self.storage.before_sync = self._write_ahead
         
-        # Indexes
-        self.id_index = Index(os.path.join(self.table_dir, "pk.idx"))
-        self.secondary_indexes: Dict[str, SecondaryIndex] = {}
-        for field in self.indexes_config:
-            self.secondary_indexes[field] = SecondaryIndex(os.path.join(self.table_dir, f"{field}.idx"))
+        # Indexes (loaded on first use)
+        self._id_index: Optional[Index] = None
+        self._secondary_indexes: Optional[Dict[str, SecondaryIndex]] = None
+        self._load_lock = threading.Lock()
+
+        self._lock = RWLock()
+        self._in_change = False
+        # Background compaction, and query cursors reading by offset
+        self._compact_lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        self._cursors = 0
+        self._cursor_lock = threading.Lock()
+
+        self.last_compaction: Optional[Dict[str, Any]] = None
+        self._cache_epoch = 0
+        # key -> [(change timestamp, offset of the version it replaced)],
+        # kept only while snapshot transactions are open
+        self._versions: Dict[Any, List[Tuple[int, Optional[int]]]] = {}
+        self.load_stats: Dict[str, float] = {"open": time.perf_counter() - started}
+
+    @property
+    def id_index(self) -> Index:
+        """The primary key index, loaded from disk on first access."""
+        if self._id_index is None:
+            with self._load_lock:
+                if self._id_index is None:
+                    started = time.perf_counter()
+                    index_cls = PK_INDEX_TYPES[self.pk_index]
+                    with self._reading_files():
+                        self._id_index = index_cls(os.path.join(self.table_dir, "pk.idx"))
+                    self.load_stats["pk_index"] = time.perf_counter() - started
+        return self._id_index
+
+    @property
+    def secondary_indexes(self) -> Dict[str, SecondaryIndex]:
+        """Secondary indexes by field, loaded from disk on first access."""
+        if self._secondary_indexes is None:
+            with self._load_lock:
+                if self._secondary_indexes is None:
+                    started = time.perf_counter()
+                    indexes = {}
+                    with self._reading_files():
+                        for field, index_type in self._index_types.items():
+                            index_cls = INDEX_TYPES[index_type]
+                            indexes[field] = index_cls(os.path.join(self.table_dir, f"{field}.idx"))
+                    self._secondary_indexes = indexes
+                    self.load_stats["secondary_indexes"] = time.perf_counter() - started
+        return self._secondary_indexes
+
+    @staticmethod
+    def _parse_index_spec(spec: Any) -> Tuple[str, str]:
+        """Normalize an index spec to (field, index type)."""
+        if isinstance(spec, str):
+            return spec, "hash"
+        if isinstance(spec, dict) and "field" in spec:
+            index_type = spec.get("type", "hash")
+            if index_type in INDEX_TYPES:
+                return spec["field"], index_type
+            raise ValueError(f"Unknown index type: {index_type}")
+        raise ValueError(f"Invalid index spec: {spec!r}")
 
     def _save_metadata(self):
-        """Save table metadata (pk and indexes)."""
+        """Save table metadata (pk, indexes, codec and pk index type)."""
         import json
         metadata = {
             "pk": self.pk,
-            "indexes": self.indexes_config
+            "indexes": self.indexes_config,
+            "codec": self.codec,
+            "pk_index": self.pk_index
         }
         with open(os.path.join(self.table_dir, "meta.json"), "w") as f:
             json.dump(metadata, f)
     
     @staticmethod
-    def _load_metadata(table_dir: str) -> tuple:
-        """Load table metadata. Returns (pk, indexes)."""
+    def _load_metadata(table_dir: str) -> Dict[str, Any]:
+        """Load table metadata as KTable keyword arguments."""
         import json
         meta_path = os.path.join(table_dir, "meta.json")
+        metadata = {}
         if os.path.exists(meta_path):
             with open(meta_path, "r") as f:
                 metadata = json.load(f)
-                return metadata.get("pk", "id"), metadata.get("indexes", [])
-        return "id", []
+        return {
+            "pk": metadata.get("pk", "id"),
+            "indexes": metadata.get("indexes", []),
+            "codec": metadata.get("codec", "json"),
+            "pk_index": metadata.get("pk_index", "hash"),
+        }
 
+    @_exclusive
     def insert(self, doc: Dict[str, Any], transaction_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Insert a new document into the table.
@@ -114,36 +289,108 @@ class KTable:
             doc[self.pk] = str(uuid.uuid4())
         
         id_val = doc[self.pk]
+        staged = self._write_set(transaction_id)
+        if staged is not None:
+            if self.get(id_val, transaction_id) is not None:
+                raise ValueError(f"Duplicate Key: {id_val}")
+            self._stage_inserts(transaction_id, staged, [doc])
+            return doc
+
         if self.id_index.get(id_val) is not None:
             raise ValueError(f"Duplicate Key: {id_val}")
 
         # Transaction Logging
         if transaction_id:
-            tx = self.db.tx_manager.get_transaction(transaction_id)
-            if tx:
-                tx.add_operation(self.name, "INSERT", doc)
+            self.db.tx_manager.log_operations(transaction_id, self.name, [("INSERT", id_val, doc, None, doc)])
 
         # Write
         offset = self.storage.write_record(doc)
         
         # Update Indexes
+        self._superseded(id_val, None)
         self.id_index.set(id_val, offset)
-        self.id_index.save()
-        
         for field, idx in self.secondary_indexes.items():
             if field in doc:
                 idx.add(doc[field], offset)
-                idx.save()
-                
-        # Versioning
-        self.db.version_manager.archive_record(self.name, id_val, doc)
-        
-        # Distributed Sync
-        self.db.node_manager.broadcast_update(self.name, id_val, doc)
+
+        # A transaction persists its indexes once, at commit
+        if not transaction_id:
+            self._save_indexes()
+            self.storage.commit()
+
+        # Versioning and distributed sync, in the background
+        self._after_commit(transaction_id, [(id_val, doc)], replicate=True)
 
         return doc
 
-    def get(self, id_val: str) -> Optional[Dict[str, Any]]:
+    @_exclusive
+    def insert_many(self, docs: List[Dict[str, Any]], transaction_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Insert several documents in one batch.
+        
+        All records are serialized into a single append, each index is
+        persisted once for the whole batch, and history and replication
+        are batched too. Primary keys are validated before anything is
+        written, so a rejected batch leaves the table untouched.
+        
+        Args:
+            docs: Documents to insert
+            transaction_id: Optional transaction ID for atomic operations
+            
+        Returns:
+            The inserted documents including generated primary keys
+            
+        Raises:
+            ValueError: If a primary key already exists or repeats in the batch
+            
+        Example:
+            >>> users.insert_many([{"name": "Bob"}, {"name": "Carol"}])
+        """
+        staged = self._write_set(transaction_id)
+        seen = set()
+        for doc in docs:
+            if self.pk not in doc:
+                doc[self.pk] = str(uuid.uuid4())
+            id_val = doc[self.pk]
+            if id_val in seen or self.get(id_val, transaction_id) is not None:
+                raise ValueError(f"Duplicate Key: {id_val}")
+            seen.add(id_val)
+
+        if staged is not None:
+            self._stage_inserts(transaction_id, staged, docs)
+            return docs
+
+        if not docs:
+            return docs
+
+        # Transaction Logging
+        if transaction_id:
+            self.db.tx_manager.log_operations(
+                transaction_id, self.name, [("INSERT", doc[self.pk], doc, None, doc) for doc in docs]
+            )
+
+        # Write
+        offsets = self.storage.write_records(docs)
+
+        # Update Indexes
+        for doc, offset in zip(docs, offsets):
+            self._superseded(doc[self.pk], None)
+            self.id_index.set(doc[self.pk], offset)
+            for field, idx in self.secondary_indexes.items():
+                if field in doc:
+                    idx.add(doc[field], offset)
+
+        if not transaction_id:
+            self._save_indexes()
+            self.storage.commit()
+
+        # Versioning and distributed sync, in the background
+        self._after_commit(transaction_id, [(doc[self.pk], doc) for doc in docs], replicate=True)
+
+        return docs
+
+    def get(self, id_val: str, transaction_id: Optional[str] = None,
+            as_of: Optional[float] = None) -> Optional[Dict[str, Any]]:
         """
         Retrieve a document by its primary key.
         
@@ -151,20 +398,203 @@ class KTable:
         
         Args:
             id_val: The primary key value
+            transaction_id: Optional deferred transaction whose uncommitted
+                writes should be visible
+            as_of: Return the document as it was at this time (seconds
+                since the epoch, as ``time.time()``), from the version history
             
         Returns:
             The document if found, None otherwise
             
+        Raises:
+            ValueError: If both ``transaction_id`` and ``as_of`` are given
+            
         Example:
             >>> user = users.get("user_123")
             >>> print(user["name"])
             'Alice'
+            >>> last_week = users.get("user_123", as_of=time.time() - 7 * 86400)
+        """
+        if as_of is not None:
+            if transaction_id:
+                raise ValueError("as_of reads cannot go through a transaction")
+            return self.db.version_manager.get_version_at(self.name, id_val, as_of)
+        doc = self._lookup(id_val, transaction_id)
+        if doc is _SUPERSEDED:
+            # Another process is replacing the record and has not published
+            # the change yet: wait for it, catch up and look again
+            self._catch_up()
+            doc = self._lookup(id_val, transaction_id)
+        return None if doc is _SUPERSEDED else doc
+
+    def get_many(self, ids: List[Any], transaction_id: Optional[str] = None) -> List[Optional[Dict[str, Any]]]:
         """
+        Retrieve several documents by primary key under a single read lock.
+        
+        Args:
+            ids: Primary key values
+            transaction_id: Optional deferred transaction whose uncommitted
+                writes should be visible
+            
+        Returns:
+            One entry per key, in input order: the document, or None
+            
+        Example:
+            >>> alice, bob = users.get_many(["u1", "u2"])
+        """
+        docs = self._lookup_many(ids, transaction_id)
+        return [self.get(id_val, transaction_id) if doc is _SUPERSEDED else doc
+                for id_val, doc in zip(ids, docs)]
+
+    @_shared
+    def _lookup(self, id_val: Any, transaction_id: Optional[str]) -> Any:
+        return self._find(id_val, transaction_id)
+
+    @_shared
+    def _lookup_many(self, ids: List[Any], transaction_id: Optional[str]) -> List[Any]:
+        return [self._find(id_val, transaction_id) for id_val in ids]
+
+    def _find(self, id_val: Any, transaction_id: Optional[str]) -> Any:
+        """
+        ``get`` for a caller holding the read lock; _SUPERSEDED if the
+        indexed record was just deleted by another process.
+        """
+        tx = self._transaction(transaction_id)
+        if tx is not None:
+            staged = tx.write_set.get(self.name)
+            if staged and id_val in staged:
+                doc = staged[id_val]
+                return None if doc is None else dict(doc)
+            if tx.snapshot_ts is not None:
+                return self._version_at(id_val, tx.snapshot_ts)
+
         offset = self.id_index.get(id_val)
         if offset is None:
             return None
-        return self.storage.read_record(offset)
+        doc = self._read(offset)
+        if doc is None and self._file_lock is not None:
+            return _SUPERSEDED
+        return doc
+
+    def _transaction(self, transaction_id: Optional[str]):
+        return self.db.tx_manager.get_transaction(transaction_id) if transaction_id else None
+
+    def _write_set(self, transaction_id: Optional[str]) -> Optional[Dict[Any, Optional[Dict[str, Any]]]]:
+        """Staged changes to this table of a deferred transaction, else None."""
+        tx = self._transaction(transaction_id)
+        if tx is None or not tx.deferred:
+            return None
+        return tx.write_set.setdefault(self.name, {})
+
+    def _stage_inserts(self, transaction_id: str, staged: Dict[Any, Optional[Dict[str, Any]]],
+                       docs: List[Dict[str, Any]]) -> None:
+        """Stage inserts of a deferred transaction, noting the keys that are new to the table."""
+        created = self._transaction(transaction_id).created.setdefault(self.name, set())
+        for doc in docs:
+            id_val = doc[self.pk]
+            # Re-inserting a key the transaction deleted replaces the record
+            if id_val not in staged:
+                created.add(id_val)
+            staged[id_val] = doc
+
+    def _after_commit(self, transaction_id: Optional[str], records: List[Tuple[Any, Optional[Dict[str, Any]]]],
+                      replicate: bool = False) -> None:
+        """
+        Hand the history (and replication) of a write to the post-commit
+        pipeline, or hold it on the write's transaction until it commits.
+        """
+        records = [(key, self._portable(doc)) for key, doc in records]
+        tx = self._transaction(transaction_id)
+        if tx is None:
+            self.db.post_commit.submit(self.name, records, replicate)
+        else:
+            tx.post_commit.append((self.name, records, replicate))
+
+    def _portable(self, doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        A private copy of ``doc`` as this table stores it, for the history
+        and the write-ahead log. Both encode with the binary codec, which
+        does not take every value JSON does (IntEnum, OrderedDict, ...),
+        so a JSON table's documents are passed through JSON first.
+        """
+        if doc is None:
+            return None
+        if self.codec == "binary":
+            return dict(doc)
+        codec = self.storage.codec
+        return codec.decode(codec.encode(doc))
+
+    def _superseded(self, id_val: Any, offset: Optional[int]) -> None:
+        """
+        Remember the version of ``id_val`` being replaced (None: the key did
+        not exist) for open snapshots. Must precede the index update; the
+        change is stamped with the clock value it will publish.
+        """
+        tx_manager = self.db.tx_manager
+        if tx_manager.snapshots:
+            self._versions.setdefault(id_val, []).append((tx_manager.clock + 1, offset))
+
+    def _version_at(self, id_val: Any, ts: int) -> Optional[Dict[str, Any]]:
+        """The version of ``id_val`` a snapshot taken at ``ts`` sees."""
+        for change_ts, offset in self._versions.get(id_val, ()):
+            if change_ts > ts:
+                # The first later change recorded what was current at ts
+                if offset is None:
+                    return None
+                return self.storage.read_record(offset, include_deleted=True)
+        offset = self.id_index.get(id_val)
+        return None if offset is None else self._read(offset)
 
+    def _changed_since(self, ts: int) -> List[Any]:
+        """Keys changed after snapshot timestamp ``ts``."""
+        return [id_val for id_val, chain in self._versions.items() if chain[-1][0] > ts]
+
+    def _visible_changes(self, transaction_id: Optional[str]) -> Dict[Any, Optional[Dict[str, Any]]]:
+        """
+        Versions a transaction sees in place of the stored ones: the snapshot
+        versions of keys changed since its snapshot, then its staged writes.
+        """
+        tx = self._transaction(transaction_id)
+        if tx is None:
+            return {}
+        changes = {}
+        if tx.snapshot_ts is not None:
+            for id_val in self._changed_since(tx.snapshot_ts):
+                changes[id_val] = self._version_at(id_val, tx.snapshot_ts)
+        changes.update(tx.write_set.get(self.name) or {})
+        return changes
+
+    def _prune_versions(self) -> None:
+        """Drop version entries no open snapshot can need any more."""
+        with self._lock.write():
+            self._prune_versions_locked(self.db.tx_manager.oldest_snapshot())
+
+    def _prune_versions_locked(self, oldest: Optional[int]) -> None:
+        if oldest is None:
+            self._versions.clear()
+            return
+        for id_val in list(self._versions):
+            chain = [entry for entry in self._versions[id_val] if entry[0] > oldest]
+            if chain:
+                self._versions[id_val] = chain
+            else:
+                del self._versions[id_val]
+
+    def _cache_key(self, offset: int) -> tuple:
+        # The epoch changes when compaction moves records to new offsets
+        return (self.name, self._cache_epoch, offset)
+
+    def _read(self, offset: int) -> Optional[Dict[str, Any]]:
+        """Read a live record through the database's decoded-record cache."""
+        key = self._cache_key(offset)
+        doc = self.db.cache.get(key)
+        if doc is None:
+            doc = self.storage.read_record(offset)
+            if doc is not None:
+                self.db.cache.put(key, doc)
+        return doc
+
+    @_exclusive
     def update(self, id_val: str, updates: Dict[str, Any], transaction_id: Optional[str] = None) -> Dict[str, Any]:
         """
         Update an existing document.
@@ -187,48 +617,162 @@ class KTable:
             >>> users.update("user_123", {"age": 31, "role": "admin"})
             {'id': 'user_123', 'name': 'Alice', 'age': 31, 'role': 'admin'}
         """
+        staged = self._write_set(transaction_id)
+        if staged is not None:
+            existing = self.get(id_val, transaction_id)
+            if existing is None:
+                raise ValueError("Record not found")
+            existing.update(updates)
+            staged[id_val] = existing
+            return existing
+
         offset = self.id_index.get(id_val)
         if offset is None:
             raise ValueError("Record not found")
             
-        existing = self.storage.read_record(offset)
+        existing = self._read(offset)
         if not existing:
             raise ValueError("Record deleted")
 
+        new_doc = existing.copy()
+        new_doc.update(updates)
+
         # Transaction Logging
         if transaction_id:
-            tx = self.db.tx_manager.get_transaction(transaction_id)
-            if tx:
-                tx.add_operation(self.name, "UPDATE", updates, original_data=existing)
+            self.db.tx_manager.log_operations(
+                transaction_id, self.name, [("UPDATE", id_val, updates, existing, new_doc)]
+            )
 
-        new_doc = existing.copy()
-        new_doc.update(updates)
+        # Write new (first: a document the codec rejects changes nothing)
+        new_offset = self.storage.write_record(new_doc)
         
         # Mark old deleted
         self.storage.mark_deleted(offset)
+        self.db.cache.discard(self._cache_key(offset))
         
         # Remove old secondary indexes
         for field, idx in self.secondary_indexes.items():
             if field in existing:
                 idx.remove_val(existing[field], offset)
-
-        # Write new
-        new_offset = self.storage.write_record(new_doc)
         
         # Update Indexes
+        self._superseded(id_val, offset)
         self.id_index.set(id_val, new_offset)
-        self.id_index.save()
-        
         for field, idx in self.secondary_indexes.items():
             if field in new_doc:
                 idx.add(new_doc[field], new_offset)
-                idx.save()
-                
+
+        if not transaction_id:
+            self._save_indexes()
+            self.storage.commit()
+            self._maybe_compact()
+
         # Versioning
-        self.db.version_manager.archive_record(self.name, id_val, new_doc)
+        self._after_commit(transaction_id, [(id_val, new_doc)])
         
         return new_doc
 
+    @_exclusive
+    def update_many(self, pairs: List[Tuple[str, Dict[str, Any]]], transaction_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Update several documents in one batch.
+        
+        The new versions are written with a single append and each index
+        is persisted once. A key may appear more than once; its updates are
+        applied in order. All keys are checked and all new versions encoded
+        before anything is changed, so a rejected batch leaves the table
+        untouched.
+        
+        Args:
+            pairs: (primary key, updates) pairs
+            transaction_id: Optional transaction ID
+            
+        Returns:
+            The updated documents, one per input pair
+            
+        Raises:
+            ValueError: If a document is not found or has been deleted
+            
+        Example:
+            >>> users.update_many([("u1", {"age": 31}), ("u2", {"age": 42})])
+        """
+        staged = self._write_set(transaction_id)
+        if staged is not None:
+            current: Dict[Any, Dict[str, Any]] = {}
+            results = []
+            for id_val, updates in pairs:
+                new_doc = current.get(id_val) or self.get(id_val, transaction_id)
+                if new_doc is None:
+                    raise ValueError("Record not found")
+                new_doc = dict(new_doc, **updates)
+                current[id_val] = new_doc
+                results.append(new_doc)
+            staged.update(current)
+            return results
+
+        current = {}
+        originals: Dict[Any, Tuple[int, Dict[str, Any]]] = {}
+        results = []
+        for id_val, updates in pairs:
+            if id_val not in current:
+                offset = self.id_index.get(id_val)
+                if offset is None:
+                    raise ValueError("Record not found")
+                existing = self._read(offset)
+                if not existing:
+                    raise ValueError("Record deleted")
+                current[id_val] = existing
+                originals[id_val] = (offset, existing)
+
+            new_doc = current[id_val].copy()
+            new_doc.update(updates)
+            results.append((id_val, updates, current[id_val], new_doc))
+            current[id_val] = new_doc
+
+        if not results:
+            return []
+
+        # Transaction Logging
+        if transaction_id:
+            self.db.tx_manager.log_operations(transaction_id, self.name, [
+                ("UPDATE", id_val, updates, existing, new_doc)
+                for id_val, updates, existing, new_doc in results
+            ])
+
+        # Write the final version of each key once. The whole batch is
+        # encoded before the append, so a document the codec rejects
+        # fails it here, with nothing changed yet
+        final_ids = list(current)
+        new_offsets = self.storage.write_records([current[id_val] for id_val in final_ids])
+
+        # Mark old versions deleted and drop their secondary entries
+        for offset, existing in originals.values():
+            self.storage.mark_deleted(offset)
+            self.db.cache.discard(self._cache_key(offset))
+            for field, idx in self.secondary_indexes.items():
+                if field in existing:
+                    idx.remove_val(existing[field], offset)
+
+        # Update Indexes
+        for id_val, new_offset in zip(final_ids, new_offsets):
+            new_doc = current[id_val]
+            self._superseded(id_val, originals[id_val][0])
+            self.id_index.set(id_val, new_offset)
+            for field, idx in self.secondary_indexes.items():
+                if field in new_doc:
+                    idx.add(new_doc[field], new_offset)
+
+        if not transaction_id:
+            self._save_indexes()
+            self.storage.commit()
+            self._maybe_compact()
+
+        # Versioning: one history entry per update, as with update()
+        self._after_commit(transaction_id, [(id_val, new_doc) for id_val, _, _, new_doc in results])
+
+        return [new_doc for _, _, _, new_doc in results]
+
+    @_exclusive
     def delete(self, id_val: str, transaction_id: Optional[str] = None) -> None:
         """
         Delete a document from the table.
@@ -243,42 +787,421 @@ class KTable:
         Example:
             >>> users.delete("user_123")
         """
+        staged = self._write_set(transaction_id)
+        if staged is not None:
+            if self.get(id_val, transaction_id) is not None:
+                staged[id_val] = None
+            return
+
         offset = self.id_index.get(id_val)
         if offset is None:
             return
 
-        existing = self.storage.read_record(offset)
+        existing = self._read(offset)
         
         # Transaction Logging
         if transaction_id:
-            tx = self.db.tx_manager.get_transaction(transaction_id)
-            if tx:
-                tx.add_operation(self.name, "DELETE", id_val, original_data=existing)
+            self.db.tx_manager.log_operations(
+                transaction_id, self.name, [("DELETE", id_val, id_val, existing, None)]
+            )
 
         self.storage.mark_deleted(offset)
+        self.db.cache.discard(self._cache_key(offset))
         
+        self._superseded(id_val, offset)
         self.id_index.remove(id_val)
-        self.id_index.save()
-        
         if existing:
             for field, idx in self.secondary_indexes.items():
                 if field in existing:
                     idx.remove_val(existing[field], offset)
-                    idx.save()
 
-    def query(self) -> 'QueryBuilder':
+        if not transaction_id:
+            self._save_indexes()
+            self.storage.commit()
+            self._maybe_compact()
+
+        # Versioning: a tombstone, so as-of reads see the deletion
+        self._after_commit(transaction_id, [(id_val, None)])
+
+    def compact(self) -> Dict[str, Any]:
+        """
+        Reclaim the space held by deleted and superseded records.
+        
+        Live records are copied, in file order, into a new segment; offsets
+        in the primary and secondary indexes are remapped; then the segment
+        and the new index snapshots are swapped in. A marker file makes the
+        swap atomic across a crash: it is rolled forward on the next open if
+        the marker was written, and discarded otherwise.
+        
+        Returns:
+            Report with bytes before/after, reclaimed bytes, live record
+            count and duration in seconds
+            
+        Raises:
+            ValueError: If snapshot transactions are open; they may still
+                read superseded records
+            
+        Example:
+            >>> report = users.compact()
+            >>> print(f"Reclaimed {report['reclaimed_bytes']} bytes")
+        """
+        return self._compact()
+
+    def _compact(self, background: bool = False) -> Optional[Dict[str, Any]]:
+        """``compact``; in the background it gives up (returning None) if query cursors are open at swap time."""
+        with self._compact_lock, self._compacting():
+            if self.db.tx_manager.snapshots:
+                raise ValueError("Cannot compact while snapshot transactions are open")
+            started = time.perf_counter()
+            self._poll()
+            with self._lock.read():
+                bytes_before = self.storage.size
+                live = set(self.id_index.values())
+
+            # Copy phase only reads data.bin; readers and writers carry on
+            plan = self.storage.copy_live(live, upto=bytes_before)
+
+            # Swap phase, writers excluded: catch up with writes made during
+            # the copy, then remap
+            with self._lock.write(), self._cross_process_write():
+                if self.db.tx_manager.snapshots:
+                    os.remove(plan.path)
+                    raise ValueError("Cannot compact while snapshot transactions are open")
+                if background and self._cursors:
+                    os.remove(plan.path)
+                    return None
+                self._save_indexes()
+                referenced = set(self.id_index.values())
+                remap = self.storage.finish_compaction(plan, referenced)
+
+                indexes = [self.id_index, *self.secondary_indexes.values()]
+                for idx in indexes:
+                    idx.remap_offsets(remap)
+                    idx.prepare_checkpoint()
+
+                marker = os.path.join(self.table_dir, "compact.commit")
+                with open(marker, "wb") as f:
+                    os.fsync(f.fileno())
+                for idx in indexes:
+                    idx.commit_checkpoint()
+                self.storage.install(plan)
+                os.remove(marker)
+                self._cache_epoch += 1
+
+        report = {
+            "bytes_before": bytes_before,
+            "bytes_after": self.storage.size,
+            "reclaimed_bytes": bytes_before - self.storage.size,
+            "live_records": len(referenced),
+            "duration": time.perf_counter() - started,
+        }
+        self.last_compaction = report
+        return report
+
+    def _maybe_compact(self) -> None:
+        """
+        Start a background ``compact`` if the dead-bytes ratio crossed the
+        auto threshold. Dead bytes not counted yet (after opening the table)
+        are counted by the background thread, not on the write path.
+        """
+        if self.auto_compact_ratio is None or self.db.tx_manager.active_transactions:
+            return
+        size = self.storage.size
+        if size < self.auto_compact_min_bytes:
+            return
+        dead_bytes = self.storage.counted_dead_bytes
+        if dead_bytes is not None and dead_bytes / size < self.auto_compact_ratio:
+            return
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self._auto_compact, daemon=True,
+                                           name=f"smartkdb-compact-{self.name}")
+        self._compactor.start()
+
+    def _auto_compact(self) -> None:
+        try:
+            size = self.storage.size
+            if not size or self.storage.dead_bytes / size < self.auto_compact_ratio:
+                return # Walks data.bin if not counted yet
+            # Cursors hold offsets that compaction would invalidate; a later
+            # write tries again
+            if self._cursors or self.db.tx_manager.active_transactions:
+                return
+            self._compact(background=True)
+        except ValueError:
+            pass # A snapshot opened meanwhile
+
+    def _recover_compaction(self) -> None:
+        """Finish or discard a compaction interrupted by a crash."""
+        marker = os.path.join(self.table_dir, "compact.commit")
+        committed = os.path.exists(marker)
+        for entry in os.listdir(self.table_dir):
+            path = os.path.join(self.table_dir, entry)
+            if entry.endswith(".idx.tmp") or entry == "data.bin.compact":
+                if committed:
+                    os.replace(path, path[:-len(".tmp")] if entry.endswith(".tmp") else path[:-len(".compact")])
+                else:
+                    os.remove(path)
+        if committed:
+            os.remove(marker)
+
+    def _save_indexes(self) -> None:
+        """Persist the primary key index and every secondary index."""
+        with self._lock.write():
+            self.id_index.save()
+            for idx in self.secondary_indexes.values():
+                idx.save()
+
+    def _write_ahead(self) -> None:
+        """
+        Runs ahead of every fsync of data.bin: forces the write-ahead log,
+        whose entries must reach the disk before the changes they describe,
+        and the index journals, since a record's deletion mark must never
+        reach the disk without the index entries pointing at its replacement.
+        """
+        self.db.tx_manager.wal.force()
+        with self._lock.write():
+            for idx in self._loaded_indexes():
+                idx.sync()
+
+    def _loaded_indexes(self) -> List[Index]:
+        """The indexes loaded from disk so far."""
+        loaded = [] if self._id_index is None else [self._id_index]
+        return loaded + list((self._secondary_indexes or {}).values())
+
+    @contextmanager
+    def _reading_files(self) -> Iterator[None]:
+        """Keep other processes from writing the table meanwhile (multiprocess mode)."""
+        if self._file_lock is None:
+            yield
+        else:
+            with self._file_lock.shared():
+                yield
+
+    @contextmanager
+    def _compacting(self) -> Iterator[None]:
+        """Keep other processes from compacting the table meanwhile (multiprocess mode)."""
+        if self._compact_file_lock is None:
+            yield
+        else:
+            with self._compact_file_lock.exclusive():
+                yield
+
+    @contextmanager
+    def _cross_process_write(self) -> Iterator[None]:
+        """
+        Write section of multiprocess mode, under the write lock: hold the
+        file lock exclusively, catch up with the other processes first and
+        publish this process's changes to them at the end.
+        """
+        if self._file_lock is None:
+            yield
+            return
+        with self._file_lock.exclusive():
+            self._refresh()
+            try:
+                yield
+            finally:
+                self._publish()
+
+    def _poll(self) -> None:
+        """Catch up if another process published changes (one memory read when it has not)."""
+        counters = self._counters
+        if counters is not None and counters.values[CHANGES_SLOT] != self._seen_changes:
+            self._catch_up()
+
+    def _catch_up(self) -> None:
+        with self._lock.write(), self._file_lock.shared():
+            self._refresh()
+
+    def _refresh(self) -> None:
+        """
+        Apply the changes other processes published since this one last
+        looked: new appends are found by the size of data.bin, index changes
+        by replaying only the new tail of each index journal. Caller holds
+        the write lock and the file lock.
+        """
+        changes = self._counters.values[CHANGES_SLOT]
+        if changes == self._seen_changes:
+            return
+        dead_bytes = self._counters.values[DEAD_BYTES_SLOT] - 1
+        if self.storage.refresh(dead_bytes if dead_bytes >= 0 else None):
+            # Compacted by another process: cached offsets are stale
+            self._cache_epoch += 1
+        for idx in self._loaded_indexes():
+            idx.refresh()
+        self._seen_changes = changes
+
+    def _publish(self) -> None:
+        """
+        Hand this process's appends and index changes to the files and
+        bump the change counter. Caller holds the write lock and the file
+        lock exclusively.
+        """
+        self._save_indexes()
+        self.storage.flush()
+        dead_bytes = self.storage.counted_dead_bytes
+        values = self._counters.values
+        values[DEAD_BYTES_SLOT] = 0 if dead_bytes is None else dead_bytes + 1
+        values[CHANGES_SLOT] += 1
+        self._seen_changes = values[CHANGES_SLOT]
+
+    @_exclusive
+    def _check_write_set(self, tx, changes: Dict[Any, Optional[Dict[str, Any]]]) -> None:
+        """
+        Validate the staged changes of a deferred transaction at commit,
+        under the write lock so that nothing can change before they are
+        applied.
+
+        Raises:
+            WriteConflictError: If the transaction reads a snapshot and a
+                key it writes was changed by someone else since
+            ValueError: If a key it inserts has been inserted meanwhile,
+                as ``insert`` would
+        """
+        if tx.snapshot_ts is not None:
+            conflicts = [key for key in self._changed_since(tx.snapshot_ts) if key in changes]
+            if conflicts:
+                raise WriteConflictError(f"Write-write conflict on {self.name}/{conflicts[0]}")
+        for id_val in tx.created.get(self.name, ()):
+            if changes.get(id_val) is not None and self.id_index.get(id_val) is not None:
+                raise ValueError(f"Duplicate Key: {id_val}")
+
+    @_exclusive
+    def _apply_write_set(self, transaction_id: str, changes: Dict[Any, Optional[Dict[str, Any]]]) -> None:
+        """
+        Apply the staged changes of a deferred transaction at commit.
+
+        The changes are logged, the new versions are written with a single
+        append (encoding them all first, so a rejected document fails the
+        commit before anything is changed), the superseded records are
+        marked deleted and the indexes are saved once.
+        """
+        current = {}
+        ops = []
+        for id_val, doc in changes.items():
+            offset = self.id_index.get(id_val)
+            existing = self._read(offset) if offset is not None else None
+            current[id_val] = (offset, existing)
+            if existing is None and doc is None:
+                continue
+            op_type = "INSERT" if existing is None else "DELETE" if doc is None else "UPDATE"
+            ops.append((op_type, id_val, id_val if doc is None else doc, existing, doc))
+        self.db.tx_manager.log_operations(transaction_id, self.name, ops)
+
+        records = [(id_val, doc) for id_val, doc in changes.items() if doc is not None]
+        offsets = self.storage.write_records([doc for _, doc in records])
+
+        for id_val, (offset, existing) in current.items():
+            self._superseded(id_val, offset)
+            if offset is None:
+                continue
+            self.storage.mark_deleted(offset)
+            self.db.cache.discard(self._cache_key(offset))
+            if changes[id_val] is None:
+                self.id_index.remove(id_val)
+            if existing:
+                for field, idx in self.secondary_indexes.items():
+                    if field in existing:
+                        idx.remove_val(existing[field], offset)
+
+        for (id_val, doc), offset in zip(records, offsets):
+            self.id_index.set(id_val, offset)
+            for field, idx in self.secondary_indexes.items():
+                if field in doc:
+                    idx.add(doc[field], offset)
+        self._save_indexes()
+
+        deleted = [(id_val, None) for id_val, doc in changes.items() if doc is None and current[id_val][1]]
+        self._after_commit(transaction_id, records + deleted, replicate=True)
+
+    def _sync(self) -> None:
+        """Persist the indexes and force them and data.bin to disk, unless durability is "none"."""
+        with self._lock.write():
+            if self.storage.durability == "none":
+                self._save_indexes()
+                self.storage.flush()
+                return
+            self.storage.sync() # Syncs the index journals first
+
+    @_exclusive
+    def _restore(self, id_val: Any, doc: Optional[Dict[str, Any]]) -> None:
+        """
+        Make ``doc`` the stored version of ``id_val`` (None removes it).
+
+        Used by transaction rollback and recovery; bypasses logging,
+        history and replication. The caller saves the indexes and commits
+        the storage once it has restored everything.
+        """
+        offset = self.id_index.get(id_val)
+        self._superseded(id_val, offset)
+        if offset is not None:
+            existing = self._read(offset)
+            self.storage.mark_deleted(offset)
+            self.db.cache.discard(self._cache_key(offset))
+            self.id_index.remove(id_val)
+            for field, idx in self.secondary_indexes.items():
+                if existing and field in existing:
+                    idx.remove_val(existing[field], offset)
+        if doc is not None:
+            new_offset = self.storage.write_record(doc)
+            self.id_index.set(id_val, new_offset)
+            for field, idx in self.secondary_indexes.items():
+                if field in doc:
+                    idx.add(doc[field], new_offset)
+
+    def scan(self) -> Iterator[Dict[str, Any]]:
+        """
+        Stream every live document in physical file order.
+        
+        Reads data.bin sequentially instead of following the primary key
+        index, so it is the fastest way to visit a whole table (ETL jobs,
+        full-table filters). Documents inserted while the scan is running
+        may or may not be included.
+        
+        Yields:
+            Live documents
+            
+        Example:
+            >>> for user in users.scan():
+            ...     export(user)
+        """
+        self._poll()
+        for _, doc in self.storage.scan():
+            yield doc
+
+    def query(self, transaction_id: Optional[str] = None) -> 'QueryBuilder':
         """
         Create a new query builder for this table.
         
         Returns a fluent query builder interface for constructing complex queries.
         
+        Args:
+            transaction_id: Optional deferred transaction whose uncommitted
+                writes the query should see
+            
         Returns:
             QueryBuilder instance
             
         Example:
             >>> results = users.query().where("age", ">", 25).where("role", "==", "admin").execute()
         """
-        return QueryBuilder(self)
+        return QueryBuilder(self, transaction_id)
+
+    def close(self) -> None:
+        """Wait for a background compaction, flush pending writes and release the table's file handles."""
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        with self._lock.write():
+            self.storage.close()
+            for idx in self._loaded_indexes():
+                idx.close()
+            for lock in (self._file_lock, self._compact_file_lock):
+                if lock is not None:
+                    lock.close()
+            if self._counters is not None:
+                self._counters.close()
 
 
 class QueryBuilder:
@@ -286,21 +1209,31 @@ class QueryBuilder:
     Fluent query builder for table queries.
     
     Provides a chainable interface for constructing filtered queries with
-    support for multiple conditions.
+    support for multiple conditions. Results are produced lazily: iterating
+    a query (or calling ``first``/``exists``) stops reading storage as soon
+    as the requested rows have been found.
     
     Example:
         >>> results = table.query().where("age", ">", 21).where("active", "==", True).execute()
+        >>> for doc in table.query().where("role", "==", "admin").limit(10).iter():
+        ...     print(doc["name"])
     """
     
-    def __init__(self, table: KTable):
+    def __init__(self, table: KTable, transaction_id: Optional[str] = None):
         """
         Initialize a query builder.
         
         Args:
             table: The KTable instance to query
+            transaction_id: Optional deferred transaction to read through
         """
         self.table = table
+        self.transaction_id = transaction_id
         self.filters: List[tuple] = []
+        self._limit: Optional[int] = None
+        self._offset = 0
+        self._order: Optional[Tuple[str, bool]] = None
+        self._as_of: Optional[float] = None
 
     def where(self, field: str, op: str, value: Any) -> 'QueryBuilder':
         """
@@ -322,12 +1255,188 @@ class QueryBuilder:
         self.filters.append((field, op, value))
         return self
 
+    def order_by(self, field: str, desc: bool = False) -> 'QueryBuilder':
+        """
+        Return results sorted by ``field``.
+        
+        Numbers sort before strings; documents without an orderable value
+        for the field come last. With an ordered index on the field the
+        results are streamed in index order, so ``limit`` stops early
+        (e.g. a top-10 leaderboard reads 10 records).
+        
+        Args:
+            field: Field to sort by
+            desc: Sort in descending order
+            
+        Returns:
+            Self for method chaining
+            
+        Example:
+            >>> top = scores.query().order_by("points", desc=True).limit(10).execute()
+        """
+        self._order = (field, desc)
+        return self
+
+    def limit(self, n: int) -> 'QueryBuilder':
+        """
+        Return at most ``n`` matching documents.
+        
+        Args:
+            n: Maximum number of documents
+            
+        Returns:
+            Self for method chaining
+            
+        Raises:
+            ValueError: If n is negative
+        """
+        if n < 0:
+            raise ValueError("limit must be non-negative")
+        self._limit = n
+        return self
+
+    def offset(self, k: int) -> 'QueryBuilder':
+        """
+        Skip the first ``k`` matching documents.
+        
+        Args:
+            k: Number of matches to skip
+            
+        Returns:
+            Self for method chaining
+            
+        Raises:
+            ValueError: If k is negative
+        """
+        if k < 0:
+            raise ValueError("offset must be non-negative")
+        self._offset = k
+        return self
+
+    def as_of(self, timestamp: float) -> 'QueryBuilder':
+        """
+        Query the table as it was at ``timestamp``.
+        
+        Documents come from the version history: each record's latest
+        version archived at or before ``timestamp``, records deleted by
+        then left out. Equality and "in" filters on the primary key look
+        up just those records; otherwise the table's history is streamed
+        in file order. Secondary indexes describe the current data and
+        are not used.
+        
+        Args:
+            timestamp: Point in time, in seconds since the epoch (as ``time.time()``)
+            
+        Returns:
+            Self for method chaining
+            
+        Raises:
+            ValueError: If the query reads through a transaction
+            
+        Example:
+            >>> admins_then = users.query().as_of(ts).where("role", "==", "admin").execute()
+        """
+        if self.transaction_id:
+            raise ValueError("as_of reads cannot go through a transaction")
+        self._as_of = timestamp
+        return self
+
+    def iter(self) -> Iterator[Dict[str, Any]]:
+        """
+        Stream matching documents, honouring ``offset`` and ``limit``.
+        
+        Storage is read only as far as needed to produce the requested
+        rows; abandoning the iterator stops the scan. Equality and "in"
+        filters on the primary key or an indexed field, and range filters
+        on an ordered-indexed field, are answered from the indexes (see
+        ``explain``); otherwise data.bin is read sequentially through
+        ``KTable.scan``. Sorting by a field without an ordered index reads
+        all matches before yielding the first one.
+        
+        Yields:
+            Matching documents
+            
+        Example:
+            >>> for doc in users.query().where("age", ">", 30).iter():
+            ...     print(doc["name"])
+        """
+        stop = None if self._limit is None else self._offset + self._limit
+        return islice(self._matching(), self._offset, stop)
+
+    def _matching(self) -> Iterator[Dict[str, Any]]:
+        """
+        Plan on first use and stream the matches. The plan is made, and the
+        cursor registered with the table, under one read lock, so a
+        background compaction either finishes first or waits for the cursor.
+        """
+        table = self.table
+        table._poll()
+        with table._lock.read():
+            plan = self._plan()
+            changes = table._visible_changes(self.transaction_id)
+            epoch = table._cache_epoch
+            with table._cursor_lock:
+                table._cursors += 1
+        try:
+            records = self._records(plan, epoch)
+            if changes:
+                records = self._overlay(records, changes)
+            matches = (rec for rec in records if rec is not None and self._matches(rec))
+            if plan["order"] and (plan["order"][0] == "sort" or changes):
+                matches = iter(self._sorted(matches))
+            yield from matches
+        finally:
+            with table._cursor_lock:
+                table._cursors -= 1
+
+    def _overlay(self, records: Iterator[Optional[Dict[str, Any]]],
+                 changes: Dict[Any, Optional[Dict[str, Any]]]) -> Iterator[Optional[Dict[str, Any]]]:
+        """Replace stored records by the versions the transaction sees."""
+        pk = self.table.pk
+        for rec in records:
+            if rec is not None and rec.get(pk) not in changes:
+                yield rec
+        for doc in changes.values():
+            if doc is not None:
+                yield dict(doc)
+
+    def _sorted(self, matches: Iterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Sort matches by the order_by field; unorderable values come last."""
+        field, desc = self._order
+        ordered, rest = [], []
+        for rec in matches:
+            (ordered if sort_key(rec.get(field)) is not None else rest).append(rec)
+        ordered.sort(key=lambda rec: sort_key(rec[field]), reverse=desc)
+        return ordered + rest
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self.iter()
+
+    def first(self) -> Optional[Dict[str, Any]]:
+        """
+        Return the first matching document (after ``offset``), or None.
+        
+        Example:
+            >>> admin = users.query().where("role", "==", "admin").first()
+        """
+        return next(self.iter(), None)
+
+    def exists(self) -> bool:
+        """
+        Check whether any document matches, stopping at the first hit.
+        
+        Example:
+            >>> if users.query().where("role", "==", "admin").exists():
+            ...     print("At least one admin")
+        """
+        return self.first() is not None
+
     def execute(self) -> List[Dict[str, Any]]:
         """
         Execute the query and return matching documents.
         
-        Note: Currently performs a full table scan. Future versions will
-        utilize secondary indexes for optimization.
+        Materializes ``iter()`` into a list; prefer iterating the query
+        directly for large result sets.
         
         Returns:
             List of matching documents
@@ -336,12 +1445,230 @@ class QueryBuilder:
             >>> results = users.query().where("active", "==", True).execute()
             >>> print(f"Found {len(results)} active users")
         """
-        results = []
-        for pk, offset in self.table.id_index.data.items():
-            rec = self.table.storage.read_record(offset)
-            if rec and self._matches(rec):
-                results.append(rec)
-        return results
+        return list(self.iter())
+
+    def explain(self) -> Dict[str, Any]:
+        """
+        Describe how the query will be executed.
+        
+        Returns:
+            Dictionary with the chosen ``strategy`` ("full_scan",
+            "primary_key", "index", "ordered_index" or, for ``as_of``
+            queries, "history"), the indexed
+            ``predicates`` used to fetch candidates (most selective first),
+            ``estimated_rows`` (candidates to read, None when streaming a
+            scan or an ordered index), the ``residual_filters`` evaluated on
+            each candidate and the result ``order``: None or
+            ("index" | "sort", field, "asc" | "desc")
+            
+        Example:
+            >>> users.query().where("email", "==", "a@x.io").explain()
+            {'strategy': 'index', 'predicates': [('email', '==', 'a@x.io')], ...}
+        """
+        plan = self._plan()
+        offsets = plan.pop("offsets")
+        keys = plan.pop("keys", None)
+        plan.pop("bounds", None)
+        candidates = offsets if keys is None else keys
+        plan["estimated_rows"] = None if candidates is None else len(candidates)
+        return plan
+
+    def _plan(self) -> Dict[str, Any]:
+        """
+        Pick candidate offsets and the result order from the indexes.
+        
+        Every "==" / "in" filter on the primary key or a secondary indexed
+        field, and the combined range filters on each ordered-indexed
+        field, yield an offset set; the sets are intersected smallest first.
+        All filters are still checked on the fetched records, so indexes
+        only ever narrow the candidates.
+        
+        With ``order_by`` on an ordered-indexed field and no candidate set,
+        results are streamed in index order; otherwise they are sorted.
+        """
+        if self._as_of is not None:
+            return self._history_plan()
+
+        table = self.table
+        lookups = []
+        for field, op, val in self.filters:
+            if op not in ("==", "in") or (op == "in" and isinstance(val, (str, bytes))):
+                continue # Substring "in" cannot be answered from an index
+            values = [val] if op == "==" else val
+            try:
+                if field == table.pk:
+                    offsets = {table.id_index.get(v) for v in values}
+                    offsets.discard(None)
+                elif field in table.secondary_indexes:
+                    idx = table.secondary_indexes[field]
+                    offsets = set()
+                    for v in values:
+                        offsets.update(idx.get(v) or ())
+                else:
+                    continue
+            except TypeError:
+                continue # Unhashable or non-iterable value: leave it to the scan
+            lookups.append(([(field, op, val)], offsets))
+
+        ranges = self._range_bounds()
+        order_field, desc = self._order if self._order else (None, False)
+        index_order = (
+            order_field is not None
+            and isinstance(table.secondary_indexes.get(order_field), OrderedIndex)
+            and not lookups
+            and all(field == order_field for field in ranges)
+        )
+
+        for field, (predicates, bounds) in ranges.items():
+            if index_order:
+                continue # Applied while walking the index in order
+            idx = table.secondary_indexes[field]
+            offsets = set()
+            for _, postings in idx.range(*bounds):
+                offsets.update(postings)
+            lookups.append((predicates, offsets))
+
+        plan: Dict[str, Any] = {"order": None}
+        if order_field is not None:
+            plan["order"] = ("index" if index_order else "sort", order_field, "desc" if desc else "asc")
+
+        if index_order:
+            used = ranges.get(order_field, ([], None))[0]
+            plan.update({
+                "strategy": "ordered_index",
+                "predicates": used,
+                "residual_filters": [f for f in self.filters if f not in used],
+                "offsets": None,
+                "bounds": ranges.get(order_field, (None, (None, None, True, True)))[1],
+            })
+            return plan
+
+        if not lookups:
+            plan.update({
+                "strategy": "full_scan",
+                "predicates": [],
+                "residual_filters": list(self.filters),
+                "offsets": None,
+            })
+            return plan
+
+        lookups.sort(key=lambda lookup: len(lookup[1]))
+        candidates = set(lookups[0][1])
+        for _, offsets in lookups[1:]:
+            if not candidates:
+                break
+            candidates &= offsets
+
+        used = [predicate for predicates, _ in lookups for predicate in predicates]
+        plan.update({
+            "strategy": "primary_key" if used[0][0] == table.pk else "index",
+            "predicates": used,
+            "residual_filters": [f for f in self.filters if f not in used],
+            # Ascending offsets read the file front to back
+            "offsets": sorted(candidates),
+        })
+        return plan
+
+    def _history_plan(self) -> Dict[str, Any]:
+        """
+        Plan an ``as_of`` query: the primary keys named by "==" / "in"
+        filters on the primary key (intersected), or None to stream the
+        whole table's history.
+        """
+        pk = self.table.pk
+        keys: Optional[List[Any]] = None
+        used = []
+        for field, op, val in self.filters:
+            if field != pk or op not in ("==", "in") or (op == "in" and isinstance(val, (str, bytes))):
+                continue
+            try:
+                values = list(dict.fromkeys([val] if op == "==" else val))
+            except TypeError:
+                continue
+            keys = values if keys is None else [key for key in keys if key in values]
+            used.append((field, op, val))
+
+        order = None
+        if self._order:
+            field, desc = self._order
+            order = ("sort", field, "desc" if desc else "asc")
+        return {
+            "strategy": "history",
+            "order": order,
+            "predicates": used,
+            "residual_filters": [f for f in self.filters if f not in used],
+            "offsets": None,
+            "keys": keys,
+        }
+
+    def _range_bounds(self) -> Dict[str, Tuple[List[tuple], tuple]]:
+        """
+        Combine range filters per ordered-indexed field into
+        (predicates, (low, high, include_low, include_high)).
+        """
+        ranges: Dict[str, Tuple[List[tuple], list]] = {}
+        for field, op, val in self.filters:
+            if op not in (">", ">=", "<", "<=") or sort_key(val) is None:
+                continue
+            if not isinstance(self.table.secondary_indexes.get(field), OrderedIndex):
+                continue
+            predicates, bounds = ranges.setdefault(field, ([], [None, None, True, True]))
+            predicates.append((field, op, val))
+            if op in (">", ">="):
+                if bounds[0] is None or sort_key(val) > sort_key(bounds[0]) or (val == bounds[0] and op == ">"):
+                    bounds[0], bounds[2] = val, op == ">="
+            else:
+                if bounds[1] is None or sort_key(val) < sort_key(bounds[1]) or (val == bounds[1] and op == "<"):
+                    bounds[1], bounds[3] = val, op == "<="
+        return {field: (predicates, tuple(bounds)) for field, (predicates, bounds) in ranges.items()}
+
+    def _records(self, plan: Dict[str, Any], epoch: int) -> Iterator[Optional[Dict[str, Any]]]:
+        """Yield candidate records for a plan, in the order it prescribes."""
+        table = self.table
+        if plan["strategy"] == "history":
+            versions = table.db.version_manager
+            if plan["keys"] is None:
+                yield from versions.scan_at(table.name, self._as_of)
+            else:
+                for key in plan["keys"]:
+                    yield versions.get_version_at(table.name, key, self._as_of)
+        elif plan["strategy"] == "ordered_index":
+            _, field, direction = plan["order"]
+            # One index key per read lock, so the first rows come without
+            # walking the whole range and writers proceed in between
+            keys = table.secondary_indexes[field].range(*plan["bounds"], reverse=direction == "desc")
+            while True:
+                with table._lock.read():
+                    if table._cache_epoch != epoch:
+                        raise RuntimeError(f"Table {table.name} was compacted during the query")
+                    entry = next(keys, None)
+                    offsets = None if entry is None else list(entry[1])
+                if offsets is None:
+                    break
+                yield from self._fetch(offsets, epoch)
+            if not plan["predicates"]:
+                # Documents the index cannot order (missing field, None, ...) come last
+                for rec in table.scan():
+                    if sort_key(rec.get(field)) is None:
+                        yield rec
+        elif plan["offsets"] is None:
+            yield from table.scan()
+        else:
+            yield from self._fetch(plan["offsets"], epoch)
+
+    def _fetch(self, offsets: List[int], epoch: int) -> Iterator[Optional[Dict[str, Any]]]:
+        """
+        Read records at index offsets, taking the read lock per record so
+        writers can proceed between them. Background compaction waits for
+        open cursors; an explicit ``compact`` meanwhile ends the query.
+        """
+        table = self.table
+        for offset in offsets:
+            with table._lock.read():
+                if table._cache_epoch != epoch:
+                    raise RuntimeError(f"Table {table.name} was compacted during the query")
+                doc = table._read(offset)
+            yield doc
 
     def _matches(self, rec: Dict[str, Any]) -> bool:
         """Check if a record matches all filter conditions."""
@@ -349,12 +1676,25 @@ class QueryBuilder:
             if field not in rec: 
                 return False
             v = rec[field]
-            if op == "==" and v != val: 
-                return False
-            if op == ">" and not v > val: 
-                return False
-            if op == "<" and not v < val: 
-                return False
+            try:
+                if op == "==" and v != val: 
+                    return False
+                if op == "!=" and v == val: 
+                    return False
+                if op == ">" and not v > val: 
+                    return False
+                if op == "<" and not v < val: 
+                    return False
+                if op == ">=" and not v >= val: 
+                    return False
+                if op == "<=" and not v <= val: 
+                    return False
+                if op == "in" and v not in val: 
+                    return False
+                if op == "contains" and val not in v: 
+                    return False
+            except TypeError:
+                return False # Incomparable types never match
         return True
 
 class SmartKDB:
@@ -368,8 +1708,12 @@ class SmartKDB:
         db_path: Path to the database directory
         tables: Dictionary of loaded tables
         tx_manager: Transaction manager for ACID operations
+        last_recovery: Changes redone / undone from the write-ahead log on open
+        cache: Decoded-record LRU cache shared by all tables
         version_manager: Versioning system for time-travel queries
         node_manager: Distributed cluster manager
+        post_commit: Background queue applying history appends and
+            replication of committed writes; see ``post_commit.stats()``
         brain: AI Brain for query optimization
         auth: Authentication and authorization manager
         
@@ -380,7 +1724,8 @@ class SmartKDB:
         >>> users = db.create_table("users")
     """
     
-    def __init__(self, path: str = "mydb.kdb"):
+    def __init__(self, path: str = "mydb.kdb", durability: str = "none", fsync_interval_ms: int = 100,
+                 cache_bytes: int = 32 << 20, multiprocess: bool = False, post_commit_queue: int = 10000):
         """
         Initialize a new SmartKDB database instance.
         
@@ -389,24 +1734,63 @@ class SmartKDB:
         
         Args:
             path: Path to the database directory (default: "mydb.kdb")
+            durability: When committed writes are fsynced: "none" (never),
+                "on_commit" (once per committed operation or transaction),
+                "every_n_ms" (at most ``fsync_interval_ms`` later) or
+                "always" (after every record)
+            fsync_interval_ms: fsync delay for the "every_n_ms" policy
+            cache_bytes: Memory budget of the decoded-record cache used by
+                ``KTable.get`` (0 disables it); see ``cache.stats()``
+            multiprocess: Share the database with other processes (e.g.
+                several server workers) that also open it this way. Writers
+                of all processes are serialized per table with advisory file
+                locks, and each process catches up with the changes the
+                others made by replaying only the new part of the index
+                journals. Snapshot transactions only see this process's
+                writes as versions. Needs POSIX ``fcntl``.
+            post_commit_queue: Committed writes whose history and
+                replication the background worker may still have to apply;
+                writers wait once that many are pending. History reads wait
+                for the queue, and so see every earlier write of this
+                handle. 0 applies them synchronously, inside each write
+            
+        Raises:
+            ValueError: If the durability policy is unknown, or multiprocess
+                mode is requested where file locks are unavailable
             
         Example:
-            >>> db = SmartKDB("production.kdb")
+            >>> db = SmartKDB("production.kdb", durability="on_commit")
+            >>> db = SmartKDB("shared.kdb", multiprocess=True)  # in each worker
         """
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy: {durability}")
+        if multiprocess and not HAVE_FILE_LOCKS:
+            raise ValueError("Multiprocess mode needs fcntl file locks (POSIX systems)")
+
         self.db_path = path
+        self.durability = durability
+        self.fsync_interval_ms = fsync_interval_ms
+        self.multiprocess = multiprocess
         if not os.path.exists(path):
             os.makedirs(path)
             
         self.tables: Dict[str, KTable] = {}
+        self._tables_lock = threading.RLock()
+        self.cache = RecordCache(cache_bytes)
         self.tx_manager = TransactionManager(self)
-        self.version_manager = VersionManager(path)
+        self.version_manager = VersionManager(path, multiprocess=multiprocess)
         self.node_manager = NodeManager("localhost:8000")
+        self.post_commit = PostCommitPipeline(self.version_manager, self.node_manager, post_commit_queue)
+        self.version_manager.drain = self.post_commit.flush
         
         # Lazy-load brain to avoid circular imports
         self._brain: Optional['Brain'] = None
         
         # Auth stub
         self.auth = AuthManager(self)
+
+        # Redo / undo transactions interrupted by a crash
+        self.last_recovery = self.tx_manager.recover()
     
     @property
     def brain(self) -> 'Brain':
@@ -423,24 +1807,36 @@ class SmartKDB:
             self._brain = Brain(self.db_path)
         return self._brain
 
-    def create_table(self, name: str, pk: str = "id", indexes: Optional[List[str]] = None) -> KTable:
+    def create_table(self, name: str, pk: str = "id", indexes: Optional[List[Any]] = None,
+                     codec: str = "json", pk_index: str = "hash") -> KTable:
         """
         Create a new table in the database.
         
         Args:
             name: Table name
             pk: Primary key field name (default: "id")
-            indexes: List of fields to create secondary indexes on
+            indexes: Fields to create secondary indexes on. A plain field
+                name creates a hash index (equality / "in" lookups); use
+                ``{"field": name, "type": "ordered"}`` for an ordered index
+                that also serves range filters and ``order_by``
+            codec: Record encoding, "json" (default) or "binary"
+            pk_index: Primary key index, "hash" (default) or "compact" for
+                tables too large to keep a dict of every key in memory
             
         Returns:
             KTable instance representing the created table
             
+        Raises:
+            ValueError: If the codec, an index spec or the pk index type is unknown
+            
         Example:
             >>> users = db.create_table("users", pk="user_id", indexes=["email", "role"])
             >>> users.insert({"user_id": "u001", "email": "alice@example.com"})
+            >>> events = db.create_table("events", indexes=[{"field": "created_at", "type": "ordered"}])
         """
-        table = KTable(self, name, pk, indexes)
-        self.tables[name] = table
+        with self._tables_lock:
+            table = KTable(self, name, pk, indexes, codec=codec, pk_index=pk_index)
+            self.tables[name] = table
         return table
 
     def get_table(self, name: str) -> KTable:
@@ -462,15 +1858,63 @@ class SmartKDB:
             >>> users = db.get_table("users")
             >>> user = users.get("u001")
         """
-        if name not in self.tables:
-            table_dir = os.path.join(self.db_path, "tables", name)
-            if os.path.exists(table_dir):
-                # Load metadata
-                pk, indexes = KTable._load_metadata(table_dir)
-                self.tables[name] = KTable(self, name, pk, indexes)
-            else:
-                raise ValueError(f"Table {name} not found")
-        return self.tables[name]
+        table = self.tables.get(name)
+        if table is not None:
+            return table
+        with self._tables_lock:
+            if name not in self.tables:
+                table_dir = os.path.join(self.db_path, "tables", name)
+                if os.path.exists(table_dir):
+                    # Load metadata
+                    options = KTable._load_metadata(table_dir)
+                    self.tables[name] = KTable(self, name, create=False, **options)
+                else:
+                    raise ValueError(f"Table {name} not found")
+            return self.tables[name]
+
+    @contextmanager
+    def _write_section(self, tables: List[KTable]) -> Iterator[None]:
+        """
+        Hold the write locks of several tables (and in multiprocess mode
+        their file locks) as one change on the transaction clock. The locks
+        are taken in table name order, so concurrent commits cannot
+        deadlock; KTable methods called inside run without locking again.
+        """
+        tables = sorted(tables, key=lambda table: table.name)
+        with ExitStack() as stack:
+            for table in tables:
+                table._lock.acquire_write()
+                stack.callback(table._lock.release_write)
+            self.tx_manager.begin_change()
+            stack.callback(self.tx_manager.end_change)
+            for table in tables:
+                table._in_change = True
+                stack.callback(setattr, table, "_in_change", False)
+                stack.enter_context(table._cross_process_write())
+            yield
+
+    def close(self) -> None:
+        """
+        Flush pending writes of all loaded tables, apply their queued
+        history and replication, and release their files.
+        
+        Example:
+            >>> with SmartKDB("app.kdb") as db:
+            ...     db.create_table("users").insert({"name": "Alice"})
+        """
+        self.tx_manager.close()
+        with self._tables_lock:
+            for table in self.tables.values():
+                table.close()
+            self.tables.clear()
+        self.post_commit.close()
+        self.version_manager.close()
+
+    def __enter__(self) -> 'SmartKDB':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
 
     def login(self, user: str, password: str) -> None:
         """
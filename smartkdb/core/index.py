@@ -1,27 +1,256 @@
 import os
+import mmap
 import pickle
-from typing import Dict, List, Any
+import struct
+import uuid
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Any, Iterator, Optional, Tuple
+
+# Snapshot files hold (SNAPSHOT_TAG, generation, data). Older databases
+# store a bare pickled dict, which is still accepted as generation 0.
+SNAPSHOT_TAG = "kdb-index"
+
+# Journal records are length-prefixed pickles; the first one is the
+# generation of the snapshot the journal applies to.
+RECORD_HEADER = struct.Struct("<I")
+
 
 class Index:
-    def __init__(self, path: str):
+    """
+    Key -> value index persisted as a snapshot plus an append-only journal.
+
+    Mutations are applied in memory and queued; ``save`` appends the queued
+    changes to ``<path>.log`` in one write instead of re-pickling the whole
+    index. Once the journal has at least ``checkpoint_min`` entries and has
+    grown as large as the snapshot it is folded into a fresh snapshot. The
+    journal so never outgrows the snapshot, whether the index is being
+    updated or only growing, and the snapshots written while it grows get
+    geometrically larger, which keeps the amortized cost of a save constant.
+    """
+
+    def __init__(self, path: str, checkpoint_min: int = 1024):
         self.path = path
-        self.data: Dict[Any, Any] = {} # Key -> Offset or List[Offset]
+        self.log_path = path + ".log"
+        self.checkpoint_min = checkpoint_min
+        self.generation = 0
+        self._pending: List[Tuple] = []
+        self._log_entries = 0
+        self._log_valid = False
+        self._log_pos = 0 # Journal bytes already applied or written
+        self._snapshot_bytes = 0
+        self._log = None
+        self._unsynced = False # Journal writes not forced to disk yet
         self.load()
 
     def load(self):
-        if os.path.exists(self.path):
+        self._load_snapshot()
+        self._snapshot_bytes = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self._close_log()
+        self._log_valid = False
+        self._log_entries = 0
+        self._log_pos = 0
+        for op in self._read_log():
+            self._apply(op)
+            self._log_entries += 1
+
+    def _load_snapshot(self):
+        self.generation, self.data = self._read_pickle_snapshot()
+
+    def _read_pickle_snapshot(self) -> Tuple[int, Dict[Any, Any]]:
+        """Return (generation, data) from a pickled snapshot, if any."""
+        if not os.path.exists(self.path):
+            return 0, {}
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # Snapshots are replaced atomically, so this is real damage;
+            # refuse to start from an empty index rather than hide it.
+            raise ValueError(f"Corrupt index snapshot {self.path}: {e}")
+
+        if isinstance(snapshot, tuple) and snapshot and snapshot[0] == SNAPSHOT_TAG:
+            return snapshot[1], snapshot[2]
+        return 0, snapshot
+
+    def _write_snapshot(self, f):
+        pickle.dump((SNAPSHOT_TAG, self.generation, self.data), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _read_log(self):
+        """Yield journal entries for the current snapshot generation."""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "rb") as f:
+            blob = f.read()
+
+        valid_end = 0
+        first = True
+        for valid_end, entry in self._parse_log(blob):
+            if first:
+                first = False
+                if entry != ("gen", self.generation):
+                    # Journal belongs to an older snapshot (crash during checkpoint)
+                    self._reset_log()
+                    return
+                self._log_valid = True
+                continue
+            yield entry
+
+        self._log_pos = valid_end
+        self._drop_torn_tail(valid_end, len(blob))
+
+    @staticmethod
+    def _parse_log(blob: bytes) -> Iterator[Tuple[int, Tuple]]:
+        """Yield (end position, entry) for each complete journal record in ``blob``."""
+        pos = 0
+        while pos + RECORD_HEADER.size <= len(blob):
+            (length,) = RECORD_HEADER.unpack_from(blob, pos)
+            end = pos + RECORD_HEADER.size + length
+            if end > len(blob):
+                return # Torn final write
             try:
-                with open(self.path, "rb") as f:
-                    self.data = pickle.load(f)
-            except:
-                self.data = {}
+                entry = pickle.loads(blob[pos + RECORD_HEADER.size:end])
+            except Exception:
+                return
+            yield end, entry
+            pos = end
+
+    def _drop_torn_tail(self, valid_end: int, size: int):
+        """Truncate a torn tail so later appends start on a record boundary."""
+        if valid_end < size:
+            with open(self.log_path, "r+b") as f:
+                f.truncate(valid_end)
+
+    def refresh(self):
+        """
+        Catch up with journal entries appended through other handles (other
+        processes) since this index last read or wrote its journal. Only the
+        new tail is read; if the journal was started over for a newer
+        snapshot, the index is reloaded. The caller must keep writers out
+        and have no unsaved changes.
+        """
+        try:
+            f = open(self.log_path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            blob = f.read(RECORD_HEADER.size)
+            if len(blob) == RECORD_HEADER.size:
+                blob += f.read(RECORD_HEADER.unpack(blob)[0])
+            header = next(self._parse_log(blob), None)
+            if header is None or header[1] != ("gen", self.generation):
+                self.load()
+                return
+            start = max(self._log_pos, header[0])
+            f.seek(start)
+            tail = f.read()
+
+        end = 0
+        for end, entry in self._parse_log(tail):
+            self._apply(entry)
+            self._log_entries += 1
+        self._log_pos = start + end
+        self._log_valid = True
+        self._drop_torn_tail(self._log_pos, start + len(tail))
+
+    def _apply(self, op: Tuple):
+        kind = op[0]
+        if kind == "set":
+            self.data[op[1]] = op[2]
+        elif kind == "del":
+            self.data.pop(op[1], None)
+
+    def _encode(self, op: Tuple) -> bytes:
+        payload = pickle.dumps(op, protocol=pickle.HIGHEST_PROTOCOL)
+        return RECORD_HEADER.pack(len(payload)) + payload
+
+    def _reset_log(self):
+        """Start an empty journal for the current generation."""
+        self._close_log()
+        header = self._encode(("gen", self.generation))
+        with open(self.log_path, "wb") as f:
+            f.write(header)
+        self._log_pos = len(header)
+        self._log_entries = 0
+        self._log_valid = True
+        self._unsynced = False # Everything before is in the (fsynced) snapshot
+
+    def _close_log(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
 
     def save(self):
-        with open(self.path, "wb") as f:
-            pickle.dump(self.data, f)
+        if not self._pending:
+            return
+        blob = b"".join(self._encode(op) for op in self._pending)
+        if self._should_checkpoint(len(blob)):
+            self.checkpoint()
+            return
+
+        if self._log is None:
+            if not self._log_valid:
+                self._reset_log()
+            self._log = open(self.log_path, "ab")
+        self._log.write(blob)
+        self._log.flush()
+        self._unsynced = True
+        self._log_pos += len(blob)
+        self._log_entries += len(self._pending)
+        self._pending = []
+
+    def _should_checkpoint(self, pending_bytes: int) -> bool:
+        """Whether saving ``pending_bytes`` more of journal should start a new snapshot instead."""
+        if self._log_entries + len(self._pending) < self.checkpoint_min:
+            return False
+        return self._log_pos + pending_bytes >= self._snapshot_bytes
+
+    def sync(self):
+        """Save queued changes and force the journal to disk, if it has writes that are not there yet."""
+        self.save()
+        if not self._unsynced:
+            return
+        if self._log is not None:
+            os.fsync(self._log.fileno())
+        elif os.path.exists(self.log_path):
+            fd = os.open(self.log_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._unsynced = False
+
+    def checkpoint(self):
+        """Write a compact snapshot atomically and start a new journal."""
+        self.prepare_checkpoint()
+        self.commit_checkpoint()
+
+    def prepare_checkpoint(self):
+        """Write the next snapshot to ``<path>.tmp`` without installing it."""
+        self.generation += 1
+        with open(self.path + ".tmp", "wb") as f:
+            self._write_snapshot(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def commit_checkpoint(self):
+        """Install the snapshot written by ``prepare_checkpoint``."""
+        os.replace(self.path + ".tmp", self.path)
+        self._snapshot_bytes = os.path.getsize(self.path)
+        self._reset_log()
+        self._pending = []
+
+    def remap_offsets(self, mapping: Dict[int, int]):
+        """Rewrite stored offsets after the data file has been compacted."""
+        self.data = {key: mapping[offset] for key, offset in self.data.items()}
+
+    def close(self):
+        self.save()
+        self._close_log()
 
     def set(self, key: Any, value: Any):
         self.data[key] = value
+        self._pending.append(("set", key, value))
 
     def get(self, key: Any) -> Any:
         return self.data.get(key)
@@ -29,16 +258,449 @@ class Index:
     def remove(self, key: Any):
         if key in self.data:
             del self.data[key]
+            self._pending.append(("del", key))
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        return iter(self.data.items())
+
+    def values(self) -> Iterator[Any]:
+        return iter(self.data.values())
+
+    def __len__(self) -> int:
+        return len(self.data)
 
 class SecondaryIndex(Index):
+    """
+    Value -> offsets index. Each posting list is a sorted ``array('q')``:
+    8 bytes per entry, O(log n) membership checks, and appends of new
+    (always increasing) offsets are O(1), so adding to or removing from a
+    low-cardinality value no longer costs a linear list scan.
+    """
+
+    def load(self):
+        super().load()
+        for key, offsets in self.data.items():
+            if not isinstance(offsets, array):
+                # Snapshots written before posting lists were arrays
+                self.data[key] = array("q", sorted(offsets))
+
+    def _apply(self, op: Tuple):
+        kind = op[0]
+        if kind == "add":
+            self._add(op[1], op[2])
+        elif kind == "rm":
+            self._remove_val(op[1], op[2])
+        else:
+            super()._apply(op)
+
+    def _add(self, key: Any, value: Any) -> bool:
+        offsets = self.data.get(key)
+        if offsets is None:
+            self.data[key] = array("q", (value,))
+            return True
+        if not offsets or offsets[-1] < value:
+            offsets.append(value)
+            return True
+        pos = bisect_left(offsets, value)
+        if offsets[pos] == value:
+            return False
+        offsets.insert(pos, value)
+        return True
+
+    def _remove_val(self, key: Any, value: Any) -> bool:
+        offsets = self.data.get(key)
+        if offsets is None:
+            return False
+        pos = bisect_left(offsets, value)
+        if pos == len(offsets) or offsets[pos] != value:
+            return False
+        del offsets[pos]
+        if not offsets:
+            del self.data[key]
+        return True
+
+    def remap_offsets(self, mapping: Dict[int, int]):
+        # Compaction preserves file order, so the remapped lists stay sorted
+        self.data = {key: array("q", [mapping[offset] for offset in offsets]) for key, offsets in self.data.items()}
+
     def add(self, key: Any, value: Any):
-        if key not in self.data:
-            self.data[key] = []
-        if value not in self.data[key]:
-            self.data[key].append(value)
+        if self._add(key, value):
+            self._pending.append(("add", key, value))
 
     def remove_val(self, key: Any, value: Any):
-        if key in self.data and value in self.data[key]:
-            self.data[key].remove(value)
-            if not self.data[key]:
-                del self.data[key]
+        if self._remove_val(key, value):
+            self._pending.append(("rm", key, value))
+
+
+def sort_key(value: Any) -> Optional[Tuple]:
+    """
+    Total order used by ordered indexes and ``order_by``: numbers, then
+    strings. Other values (None, lists, NaN, ...) are not orderable.
+    """
+    if isinstance(value, (int, float)):
+        if value != value: # NaN
+            return None
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return None
+
+
+class OrderedIndex(SecondaryIndex):
+    """
+    Secondary index that also keeps its keys sorted, for range lookups,
+    min/max and index-ordered results. Uses the same on-disk format as
+    SecondaryIndex; the sorted key list is rebuilt on load.
+    """
+
+    def load(self):
+        self._sorted: List[Tuple] = []
+        super().load()
+        self._sorted = sorted(filter(None, map(sort_key, self.data)))
+
+    def _add(self, key: Any, value: Any) -> bool:
+        is_new = key not in self.data
+        added = super()._add(key, value)
+        if is_new:
+            sk = sort_key(key)
+            if sk is not None:
+                insort(self._sorted, sk)
+        return added
+
+    def _remove_val(self, key: Any, value: Any) -> bool:
+        removed = super()._remove_val(key, value)
+        if removed and key not in self.data:
+            sk = sort_key(key)
+            if sk is not None:
+                pos = bisect_left(self._sorted, sk)
+                if pos < len(self._sorted) and self._sorted[pos] == sk:
+                    del self._sorted[pos]
+        return removed
+
+    def range(self, low: Any = None, high: Any = None, include_low: bool = True,
+              include_high: bool = True, reverse: bool = False) -> Iterator[Tuple[Any, List[int]]]:
+        """
+        Yield (key, offsets) for keys between ``low`` and ``high`` in order.
+
+        A bound of None is open. Keys are only compared with bounds of the
+        same kind (number or string), mirroring Python's own comparisons.
+
+        Each key is found by bisecting from the previous one, so nothing is
+        copied up front and the index may change between steps (the caller
+        holds a lock around each step, not the whole walk). Keys added
+        meanwhile are visited if they fall inside the keys the range held
+        when the walk began.
+        """
+        bounds = [sort_key(b) for b in (low, high) if b is not None]
+        if any(b is None for b in bounds) or len({b[0] for b in bounds}) > 1:
+            return
+        lo, hi = 0, len(self._sorted)
+        if bounds:
+            rank = bounds[0][0]
+            lo = bisect_left(self._sorted, (rank,))
+            hi = bisect_left(self._sorted, (rank + 1,))
+        if low is not None:
+            find = bisect_left if include_low else bisect_right
+            lo = max(lo, find(self._sorted, sort_key(low)))
+        if high is not None:
+            find = bisect_right if include_high else bisect_left
+            hi = min(hi, find(self._sorted, sort_key(high)))
+
+        if lo >= hi:
+            return
+        first, last = self._sorted[lo], self._sorted[hi - 1]
+        current = last if reverse else first
+        while True:
+            offsets = self.data.get(current[1])
+            if offsets:
+                yield current[1], offsets
+            if reverse:
+                i = bisect_left(self._sorted, current) - 1
+                if i < 0 or self._sorted[i] < first:
+                    return
+            else:
+                i = bisect_right(self._sorted, current)
+                if i >= len(self._sorted) or self._sorted[i] > last:
+                    return
+            current = self._sorted[i]
+
+    def min(self) -> Any:
+        """Smallest orderable key, or None for an empty index."""
+        return self._sorted[0][1] if self._sorted else None
+
+    def max(self) -> Any:
+        """Largest orderable key, or None for an empty index."""
+        return self._sorted[-1][1] if self._sorted else None
+
+
+COMPACT_MAGIC = b"KDBCIX1\0"
+# The overlay of a compact index is folded into the base once it holds
+# more than 1/OVERLAY_FRACTION as many keys as the base
+OVERLAY_FRACTION = 8
+# magic, generation, entry count, key blob size
+COMPACT_HEADER = struct.Struct("<8sQQQ")
+
+
+def encode_key(key: Any) -> bytes:
+    """
+    Byte encoding of a primary key for CompactIndex. Canonical UUID
+    strings (the default generated keys) shrink to 16 bytes.
+    """
+    if isinstance(key, str):
+        if len(key) == 36 and key[8] == "-":
+            try:
+                parsed = uuid.UUID(key)
+            except ValueError:
+                parsed = None
+            if parsed is not None and str(parsed) == key:
+                return b"u" + parsed.bytes
+        return b"s" + key.encode("utf-8")
+    if isinstance(key, float) and key.is_integer():
+        key = int(key) # 1.0 and 1 are the same dict key
+    if isinstance(key, int):
+        return b"i" + str(int(key)).encode("ascii")
+    if isinstance(key, float):
+        return b"f" + repr(key).encode("ascii")
+    raise TypeError(f"Unsupported key type for a compact index: {type(key).__name__}")
+
+
+def decode_key(encoded: bytes) -> Any:
+    tag, body = encoded[:1], encoded[1:]
+    if tag == b"u":
+        return str(uuid.UUID(bytes=body))
+    if tag == b"s":
+        return body.decode("utf-8")
+    if tag == b"i":
+        return int(body)
+    return float(body)
+
+
+class CompactIndex(Index):
+    """
+    Memory-lean primary key index.
+
+    The snapshot is a sorted run of encoded keys stored as one blob, plus
+    ``int64`` arrays of key end positions and offsets. It is memory-mapped
+    and binary-searched in place (O(log n)), so it costs page cache rather
+    than Python objects: roughly 33 bytes per UUID key instead of 150+.
+    Changes since the snapshot live in a small overlay dict and a set of
+    removed keys, and are merged into the next snapshot at checkpoint time;
+    a checkpoint is also taken once they reach 1/``OVERLAY_FRACTION`` of the
+    base, so most keys stay in the mapped snapshot even while the index only
+    grows. Keys must be str, int or float.
+    """
+
+    def _load_snapshot(self):
+        self._overlay: Dict[Any, int] = {}
+        self._removed: set = set()
+        self._extra = 0 # Overlay keys that are not in the base
+        self._set_base(b"", 0, array("q"), array("q"))
+        if not os.path.exists(self.path):
+            self.generation = 0
+            return
+
+        with open(self.path, "rb") as f:
+            magic = f.read(len(COMPACT_MAGIC))
+        if magic == COMPACT_MAGIC:
+            self._map_snapshot()
+            return
+
+        # Pickled snapshot from a hash index: convert it in memory
+        self.generation, data = self._read_pickle_snapshot()
+        entries = sorted((encode_key(key), value) for key, value in data.items())
+        self._set_base(*self._build(entries))
+
+    def _map_snapshot(self):
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, count, blob_size = COMPACT_HEADER.unpack_from(mapped, 0)
+        pos = COMPACT_HEADER.size
+        view = memoryview(mapped)
+        ends = view[pos:pos + 8 * count].cast("q")
+        pos += 8 * count
+        values = view[pos:pos + 8 * count].cast("q")
+        pos += 8 * count
+        self._set_base(mapped, pos, ends, values)
+
+    def _set_base(self, blob, blob_start: int, ends, values):
+        self._blob = blob
+        self._blob_start = blob_start
+        self._ends = ends
+        self._values = values
+        self._count = len(values)
+
+    @staticmethod
+    def _build(entries) -> tuple:
+        """Base arrays from sorted (encoded key, value) pairs."""
+        blob = bytearray()
+        ends = array("q")
+        values = array("q")
+        for encoded, value in entries:
+            blob += encoded
+            ends.append(len(blob))
+            values.append(value)
+        return bytes(blob), 0, ends, values
+
+    def _key_at(self, i: int) -> bytes:
+        start = self._ends[i - 1] if i else 0
+        return self._blob[self._blob_start + start:self._blob_start + self._ends[i]]
+
+    def _find(self, encoded: bytes) -> int:
+        """Position of ``encoded`` in the base, or -1."""
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self._key_at(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._count and self._key_at(lo) == encoded:
+            return lo
+        return -1
+
+    def _in_base(self, encoded: bytes) -> bool:
+        return encoded not in self._removed and self._find(encoded) >= 0
+
+    def _apply(self, op: Tuple):
+        if op[0] == "set":
+            self._set(op[1], op[2])
+        elif op[0] == "del":
+            self._remove(op[1])
+
+    def _set(self, key: Any, value: int):
+        encoded = encode_key(key)
+        if key not in self._overlay:
+            if encoded in self._removed:
+                self._removed.discard(encoded)
+            elif self._find(encoded) < 0:
+                self._extra += 1
+        self._overlay[key] = value
+
+    def _remove(self, key: Any) -> bool:
+        encoded = encode_key(key)
+        in_base = self._in_base(encoded)
+        if key in self._overlay:
+            del self._overlay[key]
+            if in_base:
+                self._removed.add(encoded)
+            else:
+                self._extra -= 1
+            return True
+        if in_base:
+            self._removed.add(encoded)
+            return True
+        return False
+
+    def _should_checkpoint(self, pending_bytes: int) -> bool:
+        changed = len(self._overlay) + len(self._removed)
+        if changed >= max(self.checkpoint_min, self._count // OVERLAY_FRACTION):
+            return True
+        return super()._should_checkpoint(pending_bytes)
+
+    def set(self, key: Any, value: Any):
+        self._set(key, value)
+        self._pending.append(("set", key, value))
+
+    def get(self, key: Any) -> Any:
+        if key in self._overlay:
+            return self._overlay[key]
+        try:
+            encoded = encode_key(key)
+        except TypeError:
+            return None
+        if encoded in self._removed:
+            return None
+        pos = self._find(encoded)
+        return self._values[pos] if pos >= 0 else None
+
+    def remove(self, key: Any):
+        try:
+            removed = self._remove(key)
+        except TypeError:
+            return
+        if removed:
+            self._pending.append(("del", key))
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        shadowed = set()
+        for i in range(self._count):
+            encoded = self._key_at(i)
+            if encoded in self._removed:
+                continue
+            key = decode_key(encoded)
+            if key in self._overlay:
+                shadowed.add(key)
+                yield key, self._overlay[key]
+            else:
+                yield key, self._values[i]
+        for key, value in list(self._overlay.items()):
+            if key not in shadowed:
+                yield key, value
+
+    def values(self) -> Iterator[Any]:
+        for _, value in self.items():
+            yield value
+
+    def __len__(self) -> int:
+        return self._count - len(self._removed) + self._extra
+
+    @property
+    def data(self) -> Dict[Any, Any]:
+        """Materialized copy of the index; prefer ``get`` and ``items``."""
+        return dict(self.items())
+
+    def _merge(self, mapping: Optional[Dict[int, int]] = None):
+        """Fold the overlay into a new in-memory base, optionally remapping offsets."""
+        updates = sorted((encode_key(key), value) for key, value in self._overlay.items())
+
+        def entries():
+            j = 0
+            for i in range(self._count):
+                encoded = self._key_at(i)
+                while j < len(updates) and updates[j][0] < encoded:
+                    yield updates[j]
+                    j += 1
+                if j < len(updates) and updates[j][0] == encoded:
+                    yield updates[j]
+                    j += 1
+                elif encoded not in self._removed:
+                    yield encoded, self._values[i]
+            yield from updates[j:]
+
+        merged = entries()
+        if mapping is not None:
+            merged = ((encoded, mapping[value]) for encoded, value in merged)
+        base = self._build(merged)
+        self._overlay = {}
+        self._removed = set()
+        self._extra = 0
+        self._set_base(*base)
+
+    def remap_offsets(self, mapping: Dict[int, int]):
+        self._merge(mapping)
+
+    def _write_snapshot(self, f):
+        if self._overlay or self._removed or not isinstance(self._values, array):
+            self._merge()
+        f.write(COMPACT_HEADER.pack(COMPACT_MAGIC, self.generation, self._count, len(self._blob)))
+        f.write(self._ends.tobytes())
+        f.write(self._values.tobytes())
+        f.write(self._blob)
+
+    def commit_checkpoint(self):
+        super().commit_checkpoint()
+        # Serve the new snapshot from the page cache instead of the heap
+        self._map_snapshot()
+
+
+# Primary key index types selectable with ``create_table(pk_index=...)``
+PK_INDEX_TYPES = {
+    "hash": Index,
+    "compact": CompactIndex,
+}
+
+# Index types selectable per field in ``create_table(indexes=...)``
+INDEX_TYPES = {
+    "hash": SecondaryIndex,
+    "ordered": OrderedIndex,
+}
@@ -0,0 +1,185 @@
+"""
+Locking primitives for the core engine, within and across processes.
+"""
+
+import os
+import mmap
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: multiprocess mode is unavailable
+    fcntl = None
+
+HAVE_FILE_LOCKS = fcntl is not None
+
+_get_ident = threading.get_ident
+
+
+class RWLock:
+    """
+    Readers-writer lock: any number of readers or one writer.
+
+    Both sides are reentrant per thread, and the thread holding the write
+    lock may also take the read lock. Waiting writers keep new readers out
+    so a steady stream of reads cannot starve them. A read lock cannot be
+    upgraded to a write lock (two upgrading readers would deadlock).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer: Optional[int] = None
+        self._writes = 0
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    def acquire_read(self) -> None:
+        if self._writer == _get_ident():
+            return  # Reads inside the write lock need no bookkeeping
+        local = self._local
+        depth = getattr(local, "reads", 0)
+        if not depth:
+            with self._cond:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        local.reads = depth + 1
+
+    def release_read(self) -> None:
+        if self._writer == _get_ident():
+            return
+        local = self._local
+        local.reads -= 1
+        if not local.reads:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self) -> None:
+        me = _get_ident()
+        if self._writer == me:
+            self._writes += 1
+            return
+        if getattr(self._local, "reads", 0):
+            raise RuntimeError("Cannot upgrade a read lock to a write lock")
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self) -> None:
+        self._writes -= 1
+        if not self._writes:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class FileLock:
+    """
+    Advisory lock shared with other processes (``flock`` on ``path``).
+
+    Reentrant within the process: while it is held, further acquisitions
+    only count (a shared request is satisfied by an exclusive hold, the
+    reverse raises). The lock belongs to the process, not to a thread, so
+    callers must keep their own threads from using it concurrently.
+    """
+
+    def __init__(self, path: str):
+        if fcntl is None:
+            raise RuntimeError("File locks need fcntl (POSIX systems)")
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._depth = 0
+        self._exclusive = False
+
+    def acquire(self, exclusive: bool = True, blocking: bool = True) -> bool:
+        """Take the lock; without ``blocking``, return False instead of waiting."""
+        if self._depth:
+            if exclusive and not self._exclusive:
+                raise RuntimeError("Cannot upgrade a shared file lock")
+            self._depth += 1
+            return True
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            return False
+        self._depth = 1
+        self._exclusive = exclusive
+        return True
+
+    def release(self) -> None:
+        self._depth -= 1
+        if not self._depth:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def shared(self) -> Iterator[None]:
+        self.acquire(exclusive=False)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        """Release the lock (if held) and the file."""
+        os.close(self._fd)
+        self._depth = 0
+
+
+class SharedCounters:
+    """
+    Unsigned 64-bit counters in a small memory-mapped file, visible to every
+    process that maps it. Reading ``values[i]`` costs no system call, which
+    makes them cheap change detectors; updates should be serialized with a
+    FileLock.
+    """
+
+    def __init__(self, path: str, count: int):
+        size = 8 * count
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)  # Zero-filled; a no-op if another process won the race
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.values = memoryview(self._map).cast("Q")
+
+    def close(self) -> None:
+        self.values.release()
+        self._map.close()
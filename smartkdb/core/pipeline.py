@@ -0,0 +1,197 @@
+"""
+Post-commit side effects (history and replication) applied off the write path.
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from .distributed import NodeManager
+from .versioning import VersionManager
+
+# Seconds the worker lets a batch build up before applying it, unless the
+# batch is full or someone waits in flush
+LINGER = 0.002
+
+
+class PostCommitPipeline:
+    """
+    Applies the side effects of committed writes in the background.
+
+    A write submits its records once it is committed; a worker thread
+    drains the queue in batches, appending the versions of each table to
+    its history in one go and sending each table's replicated records to
+    the peers in one message. Versions keep the time they were submitted
+    at, so as-of reads are not affected by the delay.
+
+    The queue holds at most ``max_pending`` submissions: once it is full,
+    writers wait for the worker (backpressure). ``max_pending=0`` applies
+    everything synchronously, inside the write. History reads through the
+    ``VersionManager`` call ``flush`` first, so they see every write
+    submitted before them.
+    """
+
+    def __init__(self, version_manager: VersionManager, node_manager: NodeManager,
+                 max_pending: int = 10000, batch_size: int = 1024):
+        self.version_manager = version_manager
+        self.node_manager = node_manager
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.last_error: Optional[str] = None
+        self._events: deque = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+        self._idle = False
+        self._flushing = 0
+        self._enqueued = 0
+        self._processed = 0
+        self._batches = 0
+        self._blocked = 0
+        self._errors = 0
+        self._last_lag = 0.0
+
+    def submit(self, table: str, records: List[Tuple[Any, Optional[Dict[str, Any]]]],
+               replicate: bool = False) -> None:
+        """
+        Queue the side effects of a committed write.
+
+        Args:
+            table: Table name
+            records: ``(key, document)`` pairs to archive, document None
+                for a deletion
+            replicate: Also send the written (not deleted) documents to the
+                cluster peers
+        """
+        if not records:
+            return
+        # Like the record cache, keep private copies: callers get the documents back
+        event = (table, [(key, None if doc is None else dict(doc)) for key, doc in records],
+                 replicate, time.time())
+        with self._lock:
+            if self.max_pending and not self._closed:
+                if len(self._events) >= self.max_pending:
+                    self._blocked += 1
+                    self._not_empty.notify()
+                    while len(self._events) >= self.max_pending:
+                        self._not_full.wait()
+                self._events.append(event)
+                self._enqueued += 1
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="smartkdb-post-commit", daemon=True)
+                    self._worker.start()
+                if self._idle or len(self._events) >= self.batch_size:
+                    self._not_empty.notify()
+                return
+            self._enqueued += 1
+        self._apply([event])
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                self._idle = True
+                while not self._events and not self._closed:
+                    self._not_empty.wait()
+                self._idle = False
+                if not self._events:
+                    return
+                if len(self._events) < self.batch_size and not self._closed and not self._flushing:
+                    self._not_empty.wait(LINGER)
+                batch = [self._events.popleft() for _ in range(min(len(self._events), self.batch_size))]
+                self._not_full.notify_all()
+            self._apply(batch)
+
+    def _apply(self, batch: List[Tuple[str, list, bool, float]]) -> None:
+        """Archive and replicate a batch of submissions, one call per table for each."""
+        history: Dict[str, list] = {}
+        replicated: Dict[str, list] = {}
+        for table, records, replicate, timestamp in batch:
+            history.setdefault(table, []).extend((key, timestamp, doc) for key, doc in records)
+            if replicate:
+                replicated.setdefault(table, []).extend((key, doc) for key, doc in records if doc is not None)
+
+        errors = []
+        for table, entries in history.items():
+            try:
+                self.version_manager.store(table).append(entries)
+            except Exception as e:
+                errors.append(f"history of {table}: {e}")
+        for table, records in replicated.items():
+            try:
+                self.node_manager.broadcast_updates(table, records)
+            except Exception as e:
+                errors.append(f"replication of {table}: {e}")
+
+        with self._lock:
+            self._processed += len(batch)
+            self._batches += 1
+            self._last_lag = time.time() - batch[0][3]
+            if errors:
+                self._errors += len(errors)
+                self.last_error = errors[-1]
+            self._drained.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until everything submitted so far has been applied.
+
+        Args:
+            timeout: Seconds to wait at most (None: no limit)
+
+        Returns:
+            False if the timeout expired first
+
+        Example:
+            >>> db.post_commit.flush()
+        """
+        if threading.current_thread() is self._worker:
+            return True
+        with self._lock:
+            target = self._enqueued
+            if self._processed >= target:
+                return True
+            self._flushing += 1
+            self._not_empty.notify()
+            try:
+                return self._drained.wait_for(lambda: self._processed >= target, timeout)
+            finally:
+                self._flushing -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Queue metrics.
+
+        Returns:
+            ``pending`` submissions and ``max_pending``; ``lag``, seconds the
+            oldest pending submission has waited, and ``last_lag``, the
+            commit-to-applied delay of the last batch's oldest one;
+            ``enqueued`` and ``processed`` submissions, ``batches`` applied,
+            ``blocked`` submissions that waited for room, and ``errors``
+            (the last one in ``last_error``)
+        """
+        with self._lock:
+            return {
+                "pending": len(self._events),
+                "max_pending": self.max_pending,
+                "lag": time.time() - self._events[0][3] if self._events else 0.0,
+                "last_lag": self._last_lag,
+                "enqueued": self._enqueued,
+                "processed": self._processed,
+                "batches": self._batches,
+                "blocked": self._blocked,
+                "errors": self._errors,
+                "last_error": self.last_error,
+            }
+
+    def close(self) -> None:
+        """Apply the pending submissions and stop the worker; later ones are applied synchronously."""
+        with self._lock:
+            self._closed = True
+            worker = self._worker
+            self._not_empty.notify_all()
+        if worker is not None:
+            worker.join()
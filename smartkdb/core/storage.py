@@ -1,107 +1,551 @@
 import os
-import json
+import mmap
 import struct
-from typing import Dict, Any, Optional
+import threading
+from typing import Callable, Dict, List, Any, Optional, Set, Iterator, Tuple
+
+from .codec import CODECS_BY_TAG, get_codec
+
+# Header: 1 byte status + 4 bytes length
+# Format: <BL = little-endian, unsigned char (1) + unsigned long (4)
+HEADER = struct.Struct("<BL")
+HEADER_SIZE = HEADER.size
+
+# Status byte: bit 0 is the deleted flag, the high nibble holds the tag of
+# the codec that wrote the payload (0 = JSON, so pre-codec files read as-is).
+STATUS_DELETED = 0x01
+CODEC_SHIFT = 4
+
+# When appended records reach the disk:
+#   none        - handed to the OS at commit boundaries, never fsynced
+#   on_commit   - fsynced once per committed operation / transaction
+#   every_n_ms  - fsynced by a timer at most ``fsync_interval_ms`` after a commit
+#   always      - fsynced after every record
+DURABILITY_POLICIES = ("none", "on_commit", "every_n_ms", "always")
+
 
 class BlockStorage:
     """
     Append-only block storage for database records.
-    
+
     Each record is stored as:
-    - 1 byte status (0=Active, 1=Deleted)
+    - 1 byte status (bit 0: 0=Active, 1=Deleted; bits 4-7: codec tag)
     - 4 bytes length (unsigned long, little-endian)
-    - N bytes JSON data
-    
+    - N bytes payload encoded by the codec (JSON by default)
+
     Format: "<BL" = little-endian, 1 byte + 4 bytes unsigned long
+
+    Reads go through a long-lived read-only memory map of the data file,
+    so a lookup costs no syscalls once the pages are resident. The map is
+    re-created lazily when a read lands past its end (the file has been
+    appended to since it was mapped).
+
+    Writes are collected in an in-memory buffer behind a persistent file
+    handle and reach the file at commit boundaries (see ``commit``). When
+    they are fsynced is governed by the durability policy; concurrent
+    callers of ``sync`` share a single fsync (group commit). Appends
+    started with an empty buffer go to the real end of the file, so
+    handles taking turns (under a lock of the caller's) do not overwrite
+    each other; a flush finding the end moved under its buffer raises.
+
+    ``before_sync``, if set, is called ahead of every fsync of the file,
+    for files that must reach the disk first (the index journals of the
+    table the records belong to).
     """
-    
-    def __init__(self, path: str):
+
+    def __init__(self, path: str, durability: str = "none", fsync_interval_ms: int = 100,
+                 buffer_size: int = 1 << 20, codec: str = "json"):
         """
         Initialize block storage.
-        
+
         Args:
             path: Path to the storage file
+            durability: One of "none", "on_commit", "every_n_ms", "always"
+            fsync_interval_ms: Maximum fsync delay for the "every_n_ms" policy
+            buffer_size: Buffered bytes that force a write to the OS
+            codec: Codec used for new records ("json" or "binary")
+
+        Raises:
+            ValueError: If the durability policy or codec is unknown
         """
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy: {durability}")
+
         self.path = path
+        self.codec = get_codec(codec)
+        self._status = self.codec.tag << CODEC_SHIFT
+        self.durability = durability
+        self.fsync_interval = fsync_interval_ms / 1000.0
+        self.buffer_size = buffer_size
         if not os.path.exists(path):
             with open(path, "wb") as f:
                 pass
 
+        self._reader = open(path, "rb")
+        self._map: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+
+        # Append path: everything below _flushed is in the file, the rest
+        # of the logical file (up to _size) still sits in _buffer.
+        self._file = open(path, "r+b", buffering=0)
+        self._flushed = os.fstat(self._file.fileno()).st_size
+        self._size = self._flushed
+        self._buffer = bytearray()
+        self._lock = threading.RLock()
+
+        # Group commit bookkeeping: every append or status patch bumps
+        # _write_gen, an fsync covers everything up to the gen it observed.
+        self._write_gen = 0
+        self._synced_gen = 0
+        self._syncing = False
+        self._sync_cond = threading.Condition()
+        self._timer: Optional[threading.Timer] = None
+        self.before_sync: Optional[Callable[[], None]] = None
+
+        # Bytes held by deleted records; computed on first use
+        self._dead_bytes: Optional[int] = None
+
+    @property
+    def size(self) -> int:
+        """Logical size of the data file, including buffered appends."""
+        return self._size
+
+    @property
+    def dead_bytes(self) -> int:
+        """Bytes occupied by deleted records (headers included)."""
+        if self._dead_bytes is None:
+            dead = 0
+            for _, status, length in self._walk():
+                if status & STATUS_DELETED:
+                    dead += HEADER_SIZE + length
+            self._dead_bytes = dead
+        return self._dead_bytes
+
+    @property
+    def counted_dead_bytes(self) -> Optional[int]:
+        """``dead_bytes`` if already known, else None (never walks the file)."""
+        return self._dead_bytes
+
+    def _walk(self, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+        """Yield (offset, status, length) for every record header in [start, end)."""
+        self.flush()
+        if end is None:
+            end = self._flushed
+        view = self._view(end)
+        offset = start
+        while view is not None and offset + HEADER_SIZE <= end:
+            status, length = HEADER.unpack_from(view, offset)
+            yield offset, status, length
+            offset += HEADER_SIZE + length
+
+    def _remap(self) -> None:
+        """Map the current extent of the data file."""
+        size = os.fstat(self._reader.fileno()).st_size
+        if size == self._mapped_size:
+            return
+        # The previous map is simply dropped, not closed: a slice taken from
+        # it by a concurrent reader stays valid until it is garbage collected.
+        self._map = mmap.mmap(self._reader.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        self._mapped_size = size
+
+    def _view(self, end: int) -> Optional[mmap.mmap]:
+        """Return a map covering at least ``end`` bytes, or None if the file is shorter."""
+        if end > self._mapped_size:
+            self._remap()
+            if end > self._mapped_size:
+                return None
+        return self._map
+
     def write_record(self, data: Dict[str, Any]) -> int:
         """
         Write a record to the end of the file.
-        
+
         Args:
             data: Record data as dictionary
-            
+
         Returns:
             Offset (address) of the written record
         """
-        serialized = json.dumps(data).encode("utf-8")
-        length = len(serialized)
-        
-        with open(self.path, "ab") as f:
-            offset = f.tell()
-            # Header: 1 byte status + 4 bytes length
-            # Format: <BL = little-endian, unsigned char (1) + unsigned long (4)
-            header = struct.pack("<BL", 0, length)
-            f.write(header)
-            f.write(serialized)
-            
+        serialized = self.codec.encode(data)
+
+        with self._lock:
+            self._adopt_end_locked()
+            offset = self._size
+            self._buffer += HEADER.pack(self._status, len(serialized))
+            self._buffer += serialized
+            self._size += HEADER_SIZE + len(serialized)
+            self._write_gen += 1
+            if len(self._buffer) >= self.buffer_size:
+                self._flush_locked()
+
+        if self.durability == "always":
+            self.sync()
+
         return offset
 
-    def read_record(self, offset: int) -> Optional[Dict[str, Any]]:
+    def write_records(self, records: List[Dict[str, Any]]) -> List[int]:
+        """
+        Append several records as one contiguous block.
+
+        Args:
+            records: Record data as dictionaries
+
+        Returns:
+            Offsets of the written records, in input order
+        """
+        block = bytearray()
+        sizes = []
+        for data in records:
+            serialized = self.codec.encode(data)
+            block += HEADER.pack(self._status, len(serialized))
+            block += serialized
+            sizes.append(HEADER_SIZE + len(serialized))
+
+        offsets = []
+        with self._lock:
+            self._adopt_end_locked()
+            offset = self._size
+            for size in sizes:
+                offsets.append(offset)
+                offset += size
+            self._buffer += block
+            self._size = offset
+            self._write_gen += 1
+            if len(self._buffer) >= self.buffer_size:
+                self._flush_locked()
+
+        if self.durability == "always":
+            self.sync()
+
+        return offsets
+
+    def _adopt_end_locked(self) -> None:
+        """
+        Place the next appends at the real end of the file, which another
+        handle may have moved. Caller holds ``_lock``.
+        """
+        if not self._buffer:
+            self._flushed = self._size = os.fstat(self._file.fileno()).st_size
+
+    def _flush_locked(self) -> None:
+        """
+        Hand buffered appends to the OS. Caller holds ``_lock``.
+
+        Raises:
+            OSError: If another handle appended to the file after the
+                buffered records were placed; they are dropped rather than
+                written over its records
+        """
+        if self._buffer:
+            end = os.fstat(self._file.fileno()).st_size
+            if end != self._flushed:
+                dropped = len(self._buffer)
+                self._buffer = bytearray()
+                self._flushed = self._size = end
+                raise OSError(f"{self.path} was written through another handle; "
+                              f"{dropped} buffered bytes were dropped")
+            self._file.seek(self._flushed)
+            self._file.write(self._buffer)
+            self._flushed = self._size
+            self._buffer = bytearray()
+
+    def flush(self) -> None:
+        """Write buffered appends to the file without forcing them to disk."""
+        with self._lock:
+            self._flush_locked()
+
+    def sync(self) -> None:
+        """
+        Flush and fsync everything written so far.
+
+        Callers arriving while another thread is inside fsync wait for it and
+        then issue at most one more fsync on behalf of all of them, so N
+        concurrent committers cost O(1) fsyncs rather than N.
+        """
+        if self.before_sync is not None:
+            self.before_sync()
+        with self._lock:
+            self._flush_locked()
+            target = self._write_gen
+
+        with self._sync_cond:
+            while self._synced_gen < target:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+
+                self._syncing = True
+                with self._lock:
+                    self._flush_locked()
+                    upto = self._write_gen
+                self._sync_cond.release()
+                try:
+                    os.fsync(self._file.fileno())
+                finally:
+                    self._sync_cond.acquire()
+                    self._syncing = False
+                    self._sync_cond.notify_all()
+                self._synced_gen = max(self._synced_gen, upto)
+
+    def commit(self) -> None:
+        """
+        Mark a commit boundary: make pending appends visible in the file and
+        apply the durability policy to them.
+        """
+        if self.durability in ("on_commit", "always"):
+            self.sync()
+            return
+
+        self.flush()
+        if self.durability == "every_n_ms":
+            self._schedule_sync()
+
+    def _schedule_sync(self) -> None:
+        with self._lock:
+            if self._timer is not None or self._synced_gen >= self._write_gen:
+                return
+            self._timer = threading.Timer(self.fsync_interval, self._timed_sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_sync(self) -> None:
+        with self._lock:
+            self._timer = None
+            if self._file.closed:
+                return
+        self.sync()
+
+    def read_record(self, offset: int, include_deleted: bool = False) -> Optional[Dict[str, Any]]:
         """
         Read a record at the given offset.
-        
+
         Args:
             offset: Byte offset in the file
-            
+            include_deleted: Also decode records marked deleted (superseded
+                versions stay in the file until compaction)
+
         Returns:
             Record data as dictionary, or None if not found/deleted
         """
         if offset < 0:
             return None
 
+        if offset + HEADER_SIZE > self._flushed:
+            # The record may still be in the write buffer
+            self.flush()
+
         try:
-            with open(self.path, "rb") as f:
-                f.seek(offset)
-                header = f.read(5)
-                
-                # Check if we read enough bytes
-                if len(header) < 5:
-                    return None
-                
-                # Unpack: 1 byte status + 4 bytes length
-                status, length = struct.unpack("<BL", header)
-                
-                if status == 1:  # Deleted
-                    return None
-                
-                data_bytes = f.read(length)
-                
-                # Check if we read the complete data
-                if len(data_bytes) < length:
-                    return None
-                    
-                return json.loads(data_bytes.decode("utf-8"))
-                
-        except (IOError, json.JSONDecodeError, struct.error):
+            start = offset + HEADER_SIZE
+            view = self._view(start)
+            if view is None:
+                return None
+
+            # Unpack: 1 byte status + 4 bytes length
+            status, length = HEADER.unpack_from(view, offset)
+            if status & STATUS_DELETED and not include_deleted:
+                return None
+
+            end = start + length
+            view = self._view(end)
+            if view is None:
+                return None
+
+            return CODECS_BY_TAG[status >> CODEC_SHIFT].decode(view[start:end])
+
+        except (OSError, ValueError, EOFError, KeyError, TypeError, struct.error):
+            # Decode errors of either codec, unknown codec tags and closed maps
             return None
 
+    def scan(self, start: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Yield (offset, record) for every live record, in file order.
+
+        Walks the memory map sequentially (hinting the kernel to read ahead
+        in large chunks) and skips deleted records by their status byte
+        without decoding them. Records appended after the scan started are
+        not included.
+
+        Args:
+            start: Offset of the first record header to visit
+        """
+        self.flush()
+        end = self._flushed
+        view = self._view(end)
+        if view is None:
+            return
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            view.madvise(mmap.MADV_SEQUENTIAL)
+
+        unpack = HEADER.unpack_from
+        offset = start
+        while offset + HEADER_SIZE <= end:
+            status, length = unpack(view, offset)
+            payload = offset + HEADER_SIZE
+            if not status & STATUS_DELETED:
+                try:
+                    doc = CODECS_BY_TAG[status >> CODEC_SHIFT].decode(view[payload:payload + length])
+                except (ValueError, EOFError, KeyError, TypeError):
+                    doc = None # Skip undecodable records, as read_record does
+                if doc is not None:
+                    yield offset, doc
+            offset = payload + length
+
     def mark_deleted(self, offset: int) -> None:
         """
         Mark a record as deleted.
-        
+
         Args:
             offset: Byte offset of the record to delete
         """
-        try:
-            with open(self.path, "r+b") as f:
-                f.seek(offset)
-                # Status 1 = Deleted (only first byte)
-                f.write(struct.pack("B", 1))
-        except IOError:
-            pass  # File might not exist or be accessible
+        with self._lock:
+            if offset < 0 or offset >= self._size:
+                return
+            # Set the deleted bit, keeping the codec tag (only first byte)
+            if offset >= self._flushed:
+                status, length = HEADER.unpack_from(self._buffer, offset - self._flushed)
+                self._buffer[offset - self._flushed] = status | STATUS_DELETED
+            else:
+                view = self._view(offset + HEADER_SIZE)
+                if view is None:
+                    return
+                status, length = HEADER.unpack_from(view, offset)
+                try:
+                    self._file.seek(offset)
+                    self._file.write(bytes((status | STATUS_DELETED,)))
+                except (OSError, ValueError):
+                    return  # File might have been closed
+            self._write_gen += 1
+            if not status & STATUS_DELETED and self._dead_bytes is not None:
+                self._dead_bytes += HEADER_SIZE + length
+
+    def copy_live(self, live: Set[int], upto: Optional[int] = None) -> "Compaction":
+        """
+        First compaction phase: copy the records at the ``live`` offsets into
+        a new segment next to the data file, in file order.
+
+        Only reads the current file, so it can run alongside readers and
+        writers. Records from ``upto`` (default: the current end of the
+        file, which must match when ``live`` was taken) onwards and status
+        changes made meanwhile are picked up by ``finish_compaction``.
+        """
+        self.flush()
+        plan = Compaction(self.path + ".compact", self._flushed if upto is None else upto)
+        view = self._view(plan.upto)
+        with open(plan.path, "wb") as out:
+            new_offset = 0
+            for offset, status, length in self._walk(0, plan.upto):
+                if offset in live:
+                    end = offset + HEADER_SIZE + length
+                    out.write(view[offset:end])
+                    plan.remap[offset] = new_offset
+                    new_offset += HEADER_SIZE + length
+        return plan
+
+    def finish_compaction(self, plan: "Compaction", referenced: Set[int]) -> Dict[int, int]:
+        """
+        Second compaction phase, to be run while writers are excluded:
+        append whatever was written after ``copy_live`` started, mark copied
+        records that are no longer ``referenced`` as deleted, and fsync the
+        new segment.
+
+        Returns:
+            Mapping of old offsets to offsets in the new segment
+        """
+        self.flush()
+        tail_end = self._flushed
+        view = self._view(tail_end)
+        with open(plan.path, "r+b") as out:
+            out.seek(0, os.SEEK_END)
+            base = out.tell()
+            dead = 0
+            for old, new in plan.remap.items():
+                if old not in referenced:
+                    status, length = HEADER.unpack_from(view, old)
+                    out.seek(new)
+                    out.write(bytes((status | STATUS_DELETED,)))
+                    dead += HEADER_SIZE + length
+
+            out.seek(base)
+            if tail_end > plan.upto:
+                out.write(view[plan.upto:tail_end])
+                for offset, status, length in self._walk(plan.upto, tail_end):
+                    plan.remap[offset] = base + offset - plan.upto
+                    if status & STATUS_DELETED:
+                        dead += HEADER_SIZE + length
+            out.flush()
+            os.fsync(out.fileno())
+        plan.dead_bytes = dead
+        return plan.remap
+
+    def install(self, plan: "Compaction") -> None:
+        """Atomically replace the data file with a finished compaction segment."""
+        with self._lock:
+            self._flush_locked()
+            self._close_handles()
+            os.replace(plan.path, self.path)
+            self._open_handles()
+            self._dead_bytes = plan.dead_bytes
+            self._write_gen += 1
 
+    def refresh(self, dead_bytes: Optional[int] = None) -> bool:
+        """
+        Catch up with appends made through other handles of the data file
+        (other processes), so the next append lands at the real end of the
+        file. The caller must keep those writers out meanwhile.
+
+        Args:
+            dead_bytes: Dead bytes as counted by the last writer, if known
+
+        Returns:
+            True if the data file was replaced (compacted) meanwhile; it has
+            been reopened and offsets taken before are meaningless
+        """
+        with self._lock:
+            self._flush_locked()
+            replaced = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+            if replaced:
+                self._close_handles()
+                self._open_handles()
+            else:
+                self._flushed = self._size = os.fstat(self._file.fileno()).st_size
+            self._dead_bytes = dead_bytes
+            return replaced
 
+    def _close_handles(self) -> None:
+        self._map = None
+        self._mapped_size = 0
+        self._reader.close()
+        self._file.close()
+
+    def _open_handles(self) -> None:
+        self._reader = open(self.path, "rb")
+        self._file = open(self.path, "r+b", buffering=0)
+        self._flushed = os.fstat(self._file.fileno()).st_size
+        self._size = self._flushed
+
+    def close(self) -> None:
+        """Flush pending writes and release the map and file handles."""
+        if self._file.closed:
+            return
+        if self.durability == "none":
+            self.flush()
+        else:
+            self.sync()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._file.close()
+        self._map = None
+        self._mapped_size = 0
+        self._reader.close()
+
+
+class Compaction:
+    """State of an in-progress BlockStorage compaction."""
+
+    def __init__(self, path: str, upto: int):
+        self.path = path
+        self.upto = upto
+        self.remap: Dict[int, int] = {}
+        self.dead_bytes = 0
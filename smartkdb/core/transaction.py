@@ -1,32 +1,55 @@
+import os
+import threading
 import uuid
 import time
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional, Set, Tuple
 from enum import Enum
 
+from .locks import FileLock
+from .wal import WriteAheadLog
+
 class TransactionState(Enum):
     ACTIVE = "ACTIVE"
     COMMITTED = "COMMITTED"
     ROLLED_BACK = "ROLLED_BACK"
 
+class WriteConflictError(ValueError):
+    """A snapshot transaction wrote a key that another writer changed after its snapshot."""
+
+
 class Transaction:
-    def __init__(self, tx_id: str):
+    def __init__(self, tx_id: str, deferred: bool = False, snapshot_ts: Optional[int] = None):
         self.id = tx_id
         self.state = TransactionState.ACTIVE
         self.start_time = time.time()
         self.operations: List[Dict[str, Any]] = []
         self.savepoints: Dict[str, int] = {}
+        # Deferred transactions stage their writes here until commit:
+        # table -> {key: document, or None for a delete}
+        self.deferred = deferred
+        self.write_set: Dict[str, Dict[Any, Optional[Dict[str, Any]]]] = {}
+        # Keys staged as new records, table -> keys: the commit fails if
+        # one of them has been inserted by someone else meanwhile
+        self.created: Dict[str, Set[Any]] = {}
+        # History and replication of the writes, (table, records, replicate),
+        # handed to the post-commit pipeline once the transaction commits
+        self.post_commit: List[Tuple[str, List[Tuple[Any, Any]], bool]] = []
+        # Clock value the transaction reads at (snapshot transactions only)
+        self.snapshot_ts = snapshot_ts
 
-    def add_operation(self, table: str, op_type: str, data: Any, original_data: Any = None):
+    def add_operation(self, table: str, op_type: str, data: Any, original_data: Any = None, key: Any = None):
         """
         Log an operation for potential rollback.
         :param table: Table name
         :param op_type: 'INSERT', 'UPDATE', 'DELETE'
         :param data: The data involved (new data for insert/update, old data for delete)
-        :param original_data: The state before the operation (for rollback of updates)
+        :param original_data: The record before the operation (None if it did not exist)
+        :param key: Primary key of the record; rollback restores ``original_data`` under it
         """
         self.operations.append({
             "table": table,
             "type": op_type,
+            "key": key,
             "data": data,
             "original_data": original_data,
             "timestamp": time.time()
@@ -46,72 +69,319 @@ class Transaction:
         return ops_to_undo
 
 class TransactionManager:
+    """
+    Tracks transactions, the write-ahead log and the snapshot clock.
+
+    Safe to share between threads: bookkeeping is guarded by a lock, the
+    commit of buffered write sets is serialized (first committer wins),
+    and the log fsync is left outside every lock so that concurrent
+    commits share it.
+
+    In multiprocess mode every process logs to a ``wal-*.log`` of its own
+    and holds a file lock on it while the database is open. A log nobody
+    holds was left behind by a crashed process; the next process to open
+    the database recovers it.
+    """
+
+    # Empty the write-ahead log at the end of a transaction once it has
+    # grown past this size and no other transaction is running
+    checkpoint_bytes = 4 << 20
+
     def __init__(self, storage_engine):
         self.storage = storage_engine
         self.active_transactions: Dict[str, Transaction] = {}
+        self._wal_lock: Optional[FileLock] = None
+        wal_path = os.path.join(storage_engine.db_path, "wal.log")
+        if storage_engine.multiprocess:
+            # Lock the log under a name recovery ignores, then give it its
+            # real one, so no other process can take it for an orphan
+            wal_path = os.path.join(storage_engine.db_path, f"wal-{os.getpid()}-{uuid.uuid4().hex[:8]}.log")
+            self._wal_lock = FileLock(wal_path + ".new")
+            self._wal_lock.acquire()
+            os.rename(wal_path + ".new", wal_path)
+        self.wal = self._open_log(wal_path)
+        # Tables with transactional writes not yet forced to disk
+        self._dirty_tables: Set[str] = set()
+        # Logical clock, advanced by every change to a table, and the
+        # snapshot timestamps of open snapshot transactions
+        self.clock = 0
+        self.snapshots: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._commit_lock = threading.Lock()
+        self._ending: Set[str] = set()
+        # Table changes in progress; a snapshot is only taken between them
+        self._clock_cond = threading.Condition()
+        self._changes = 0
+        self._snapshot_waiters = 0
+
+    def begin(self, deferred: bool = False, snapshot: bool = False) -> str:
+        """
+        Start a transaction.
 
-    def begin(self) -> str:
+        By default writes go to the tables immediately and rollback undoes
+        them. With ``deferred=True`` they are buffered in the transaction
+        (visible to ``get``/``query`` calls that pass its ID) and applied at
+        commit with one append and one index save per table; rollback just
+        drops the buffer.
+
+        ``snapshot=True`` also buffers writes, and reads through the
+        transaction see the tables as they were when it began, whatever is
+        written meanwhile. Commit fails with ``WriteConflictError`` if a
+        key it wrote was changed by someone else after that point.
+        """
         tx_id = str(uuid.uuid4())
-        self.active_transactions[tx_id] = Transaction(tx_id)
+        if not snapshot:
+            with self._lock:
+                self.active_transactions[tx_id] = Transaction(tx_id, deferred=deferred)
+            return tx_id
+
+        with self._clock_cond:
+            # Hold back new changes and wait for those in progress, so the
+            # snapshot never sees half of a change
+            self._snapshot_waiters += 1
+            while self._changes:
+                self._clock_cond.wait()
+            self._snapshot_waiters -= 1
+            with self._lock:
+                self.active_transactions[tx_id] = Transaction(tx_id, deferred=True, snapshot_ts=self.clock)
+                self.snapshots[tx_id] = self.clock
+            self._clock_cond.notify_all()
         return tx_id
 
+    def begin_change(self):
+        """Called by a table before it changes records (under its write lock)."""
+        with self._clock_cond:
+            while self._snapshot_waiters:
+                self._clock_cond.wait()
+            self._changes += 1
+
+    def end_change(self):
+        """Called by a table once a change is applied; advances the clock."""
+        with self._clock_cond:
+            self._changes -= 1
+            self.clock += 1
+            if not self._changes:
+                self._clock_cond.notify_all()
+
+    def _claim(self, tx_id: str) -> Transaction:
+        """Reserve an active transaction for commit or rollback by this thread."""
+        with self._lock:
+            tx = self.active_transactions.get(tx_id)
+            if tx is None:
+                raise ValueError("Invalid Transaction ID")
+            if tx.state != TransactionState.ACTIVE or tx_id in self._ending:
+                raise ValueError("Transaction is not active")
+            self._ending.add(tx_id)
+            return tx
+
     def commit(self, tx_id: str):
-        if tx_id not in self.active_transactions:
-            raise ValueError("Invalid Transaction ID")
-        
-        tx = self.active_transactions[tx_id]
-        if tx.state != TransactionState.ACTIVE:
-            raise ValueError("Transaction is not active")
-
-        # In a real WAL system, we would flush to disk here.
-        # For this implementation, we mark as committed and clear the log.
-        tx.state = TransactionState.COMMITTED
-        del self.active_transactions[tx_id]
+        tx = self._claim(tx_id)
+
+        staged = {name: changes for name, changes in tx.write_set.items() if changes}
+        try:
+            if staged:
+                # Check and apply under the write locks of all the tables, so
+                # no write can land in between
+                tables = [self.storage.get_table(name) for name in staged]
+                with self._commit_lock, self.storage._write_section(tables):
+                    for table in tables:
+                        table._check_write_set(tx, staged[table.name])
+                    try:
+                        for table in tables:
+                            table._apply_write_set(tx_id, staged[table.name])
+                    except BaseException:
+                        # Take back what was applied before anyone sees it
+                        self._undo(tx)
+                        raise
+
+            # The data and index writes only need to reach the OS: the commit
+            # record makes the transaction durable, with one (group) fsync of
+            # the log whatever the number of tables and rows.
+            for table_name in dict.fromkeys(op["table"] for op in tx.operations):
+                table = self.storage.get_table(table_name)
+                table._save_indexes()
+                table.storage.flush()
+        except BaseException:
+            try:
+                self._undo(tx)
+            finally:
+                self._end(tx, TransactionState.ROLLED_BACK)
+            raise
+
+        if tx.operations:
+            self.wal.log_commit(tx_id)
+        for table_name, records, replicate in tx.post_commit:
+            self.storage.post_commit.submit(table_name, records, replicate)
+
+        self._end(tx, TransactionState.COMMITTED)
+        self._maybe_checkpoint()
         return True
 
     def rollback(self, tx_id: str):
-        if tx_id not in self.active_transactions:
-            raise ValueError("Invalid Transaction ID")
-        
-        tx = self.active_transactions[tx_id]
-        if tx.state != TransactionState.ACTIVE:
-            raise ValueError("Transaction is not active")
+        tx = self._claim(tx_id)
+        try:
+            self._undo(tx)
+        finally:
+            self._end(tx, TransactionState.ROLLED_BACK)
+        self._maybe_checkpoint()
+        return True
 
-        # Undo operations in reverse order
-        for op in reversed(tx.operations):
+    def _undo(self, tx: Transaction):
+        """
+        Take back everything ``tx`` has written, newest first, and drop
+        what it still holds for commit. Undone operations are forgotten,
+        so calling it again is harmless.
+        """
+        # A deferred transaction has written nothing before its commit
+        tx.write_set.clear()
+        tx.post_commit.clear()
+        operations, tx.operations = tx.operations, []
+        for op in reversed(operations):
             self._undo_operation(op)
+        self._save_restored(dict.fromkeys(op["table"] for op in operations))
+        if operations:
+            self.wal.log_abort(tx.id)
 
-        tx.state = TransactionState.ROLLED_BACK
-        del self.active_transactions[tx_id]
-        return True
+    def _end(self, tx: Transaction, state: TransactionState):
+        with self._lock:
+            tx.state = state
+            del self.active_transactions[tx.id]
+            self._ending.discard(tx.id)
+            if self.snapshots.pop(tx.id, None) is None:
+                return
+            tables = list(self.storage.tables.values())
+        # Forget versions only the finished snapshot could still read
+        for table in tables:
+            table._prune_versions()
+
+    def oldest_snapshot(self) -> Optional[int]:
+        """Timestamp of the oldest open snapshot, or None."""
+        with self._lock:
+            return min(self.snapshots.values(), default=None)
 
     def _undo_operation(self, op: Dict[str, Any]):
-        table_name = op["table"]
-        op_type = op["type"]
-        
-        # This requires the storage engine to expose internal methods
-        # We will assume the storage engine is passed and has these methods
-        table = self.storage.get_table(table_name)
-        
-        if op_type == "INSERT":
-            # Undo Insert -> Delete
-            # data contains the inserted record with ID
-            doc_id = op["data"].get("_id") or op["data"].get("id")
-            if doc_id:
-                table.delete(doc_id, transaction_id=None) # Pass None to avoid recursive logging
-
-        elif op_type == "DELETE":
-            # Undo Delete -> Insert (Restore original)
-            original = op["original_data"]
-            if original:
-                table.insert(original, transaction_id=None)
-
-        elif op_type == "UPDATE":
-            # Undo Update -> Update back to original
-            doc_id = op["data"].get("_id") or op["data"].get("id")
-            original = op["original_data"]
-            if doc_id and original:
-                table.update(doc_id, original, transaction_id=None)
+        # Put the before-image back, as recovery does: an insert is undone
+        # by removing the record, an update or delete by restoring it
+        table = self.storage.get_table(op["table"])
+        table._restore(op["key"], op["original_data"])
+        self._dirty_tables.add(op["table"])
+
+    def _save_restored(self, table_names: Iterable[str]):
+        """Save the indexes of tables changed by ``_restore`` and commit their storage, once per table."""
+        for table_name in table_names:
+            table = self.storage.get_table(table_name)
+            table._save_indexes()
+            table.storage.commit()
 
     def get_transaction(self, tx_id: str) -> Optional[Transaction]:
         return self.active_transactions.get(tx_id)
+
+    def log_operations(self, tx_id: str, table: str, ops: List[Tuple[str, Any, Any, Any, Any]]):
+        """
+        Record writes of a transaction before they are applied.
+
+        Each op is (op_type, key, data, before, after): the key and
+        ``before`` are kept for rollback, the key with both images goes
+        to the write-ahead log. Unknown transaction IDs are ignored.
+        """
+        tx = self.active_transactions.get(tx_id)
+        if tx is None:
+            return
+        # Before-images were read back from the table, after-images are the caller's documents
+        portable = self.storage.get_table(table)._portable
+        self.wal.log_ops(tx_id, table, [(key, before, portable(after)) for _, key, _, before, after in ops])
+        self._dirty_tables.add(table)
+        for op_type, key, data, before, _ in ops:
+            tx.add_operation(table, op_type, data, original_data=before, key=key)
+
+    def _open_log(self, path: str) -> WriteAheadLog:
+        return WriteAheadLog(path, durability=self.storage.durability,
+                             fsync_interval_ms=self.storage.fsync_interval_ms)
+
+    def _orphaned_logs(self) -> List[Tuple[WriteAheadLog, Optional[FileLock]]]:
+        """Logs of other database handles that are no longer in use, locked for recovery."""
+        orphans = []
+        for name in sorted(os.listdir(self.storage.db_path)):
+            path = os.path.join(self.storage.db_path, name)
+            if path == self.wal.path or not (name == "wal.log" or name.startswith("wal-") and name.endswith(".log")):
+                continue
+            lock = None
+            if self.storage.multiprocess:
+                lock = FileLock(path)
+                if not lock.acquire(blocking=False):
+                    lock.close() # Its process is alive
+                    continue
+            orphans.append((self._open_log(path), lock))
+        return orphans
+
+    def recover(self) -> Dict[str, int]:
+        """
+        Bring the tables in line with the write-ahead log after a crash.
+
+        Changes of committed transactions are redone where the table still
+        holds the before-image; changes of transactions that never
+        committed are undone where it still holds the after-image. Both
+        passes are idempotent, so an interrupted recovery can simply run
+        again. The log, and the logs of crashed processes in multiprocess
+        mode, are emptied afterwards.
+
+        Returns:
+            Number of changes redone and undone
+        """
+        orphans = self._orphaned_logs()
+        report = {"redone": 0, "undone": 0}
+        restored: Dict[str, None] = {}
+        for wal in [self.wal, *(orphan for orphan, _ in orphans)]:
+            redo, undo = wal.analyze()
+            for ops, source, target, counter in ((redo, "before", "after", "redone"),
+                                                 (undo, "after", "before", "undone")):
+                for op in ops:
+                    try:
+                        table = self.storage.get_table(op["table"])
+                    except ValueError:
+                        continue # Table dropped since
+                    current = table.get(op["key"])
+                    if current == op[source] and current != op[target]:
+                        table._restore(op["key"], op[target])
+                        self._dirty_tables.add(op["table"])
+                        restored[op["table"]] = None
+                        report[counter] += 1
+        self._save_restored(restored)
+        if self.wal.size or orphans:
+            self.checkpoint()
+        for wal, lock in orphans:
+            wal.close()
+            os.remove(wal.path)
+            if lock is not None:
+                lock.close()
+        return report
+
+    def _maybe_checkpoint(self):
+        if self.wal.size >= self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self) -> bool:
+        """
+        Force transactional writes to disk and empty the write-ahead log.
+
+        Skipped (returns False) while transactions are running, since their
+        log entries are still needed to undo them.
+        """
+        with self._lock:
+            if self.active_transactions:
+                return False
+            for table_name in self._dirty_tables:
+                table = self.storage.tables.get(table_name)
+                if table is not None:
+                    table._sync()
+            self._dirty_tables.clear()
+            self.wal.reset()
+            return True
+
+    def close(self):
+        emptied = self.checkpoint()
+        self.wal.close()
+        if self._wal_lock is not None:
+            if emptied:
+                os.remove(self.wal.path)
+            self._wal_lock.close()
@@ -1,83 +1,812 @@
+"""
+Record history for time-travel queries.
+"""
+
 import time
 import json
 import os
-from typing import List, Dict, Any, Optional
+import pickle
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import List, Dict, Any, Callable, Iterator, Optional, Set, Tuple
+
+from .codec import get_codec
+from .locks import FileLock
+from .storage import BlockStorage
+
+# A version's position packs the segment number above the byte offset in
+# that segment, so positions sort in append order across segments.
+SEGMENT_SHIFT = 40
+OFFSET_MASK = (1 << SEGMENT_SHIFT) - 1
+
+SEGMENT_SUFFIX = ".seg"
+# Saved index of a sealed segment: (INDEX_TAG, segment size, key -> arrays)
+INDEX_SUFFIX = ".idx"
+INDEX_TAG = "kdb-history-index"
+RETENTION_FILE = "retention.json"
+PRUNED_MARKER = "pruned"
+
+# Versions read per lock acquisition by as-of scans and prune rewrites
+SCAN_BATCH = 256
+
+# Encoded bytes of the last archived versions kept as delta bases
+DELTA_BASE_BYTES = 8 << 20
+
+_data_codec = get_codec("binary")
+
+_MISSING = object()
+
+
+def _safe_id(record_id: Any) -> str:
+    """A record id as it appears in legacy per-record history file names."""
+    return "".join([c if c.isalnum() else "_" for c in str(record_id)])
+
+
+def diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """Top-level changes turning document ``old`` into ``new``."""
+    changed = {}
+    for field, value in new.items():
+        if field in old:
+            prev = old[field]
+            if type(prev) is type(value) and prev == value:
+                # Equal containers may still differ in element types (1 vs 1.0)
+                if not isinstance(value, (dict, list, tuple, set)) or \
+                        _data_codec.encode(prev) == _data_codec.encode(value):
+                    continue
+        changed[field] = value
+    return {"set": changed, "unset": [field for field in old if field not in new]}
+
+
+def patch(doc: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a ``diff`` result to a copy of ``doc``."""
+    doc = dict(doc)
+    doc.update(delta["set"])
+    for field in delta["unset"]:
+        doc.pop(field, None)
+    return doc
+
+
+class HistoryStore:
+    """
+    Append-only history of one table.
+
+    Versions are appended as binary-codec records to numbered segment files
+    (``history/<table>/000001.seg``, ...), a new segment being started once
+    the current one reaches ``segment_bytes`` (or on ``rotate``). A record
+    holds the key, the timestamp and either the document (``data``) or its
+    changes against the key's previous version (``delta``), both kept in
+    encoded form so that indexing a segment never decodes documents. A
+    deletion is archived as a tombstone, a version whose ``data`` is None.
+
+    A delta is written when the store still remembers the key's previous
+    version (the most recently archived ones are kept, up to
+    ``DELTA_BASE_BYTES``) and it is smaller than the document. Every
+    ``snapshot_every``-th version of a key is stored in full, which bounds
+    the records read to rebuild any version.
+
+    Archiving is a single append and does not touch the index. The
+    per-record index (key -> timestamps and positions, as arrays in append
+    order) is built when history is first read, and afterwards only the new
+    tail is indexed. A segment's part of the index is saved next to it
+    (``000001.idx``) when the segment is sealed, so the first read after
+    opening the store only scans the current segment.
+
+    A retention policy (``set_retention``) is enforced by ``prune``, run in
+    the background every ``prune_interval`` seconds while versions are
+    being archived.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = 64 << 20, snapshot_every: int = 16,
+                 prune_interval: Optional[float] = 60.0, multiprocess: bool = False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = snapshot_every
+        self.prune_interval = prune_interval
+        self.multiprocess = multiprocess
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file_lock = FileLock(os.path.join(path, "history.lock")) if multiprocess else None
+        with self._exclusive():
+            for name in os.listdir(path):
+                if name.endswith(".tmp"):
+                    os.remove(os.path.join(path, name)) # Left by an interrupted prune or index save
+        self._segments: Dict[int, BlockStorage] = {}
+        self._seqs: List[int] = []
+        self._index: Optional[Dict[Any, Tuple[array, array]]] = None
+        self._indexed = (1, 0)
+        self._epoch = 0
+        # key -> (encoded last version, deltas written since its full version)
+        self._bases: "OrderedDict[Any, Tuple[bytes, int]]" = OrderedDict()
+        self._bases_bytes = 0
+        self._tail: Optional[Tuple[int, int]] = None # (segment, size) after our last append
+        self._pruned_marker = self._marker()
+        self._reset()
+
+        try:
+            with open(os.path.join(path, RETENTION_FILE)) as f:
+                self.retention: Dict[str, float] = json.load(f)
+        except FileNotFoundError:
+            self.retention = {}
+        self.last_prune: Optional[Dict[str, Any]] = None
+        self._pruned_at = time.monotonic()
+        self._pruner: Optional[threading.Thread] = None
+
+    def _list_segments(self) -> List[int]:
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    def _segment(self, seq: int) -> BlockStorage:
+        storage = self._segments.get(seq)
+        if storage is None:
+            storage = BlockStorage(os.path.join(self.path, f"{seq:06d}{SEGMENT_SUFFIX}"), codec="binary")
+            self._segments[seq] = storage
+            if seq not in self._seqs:
+                self._seqs.append(seq)
+        return storage
+
+    def _shared(self):
+        return self._file_lock.shared() if self._file_lock else nullcontext()
+
+    def _exclusive(self):
+        return self._file_lock.exclusive() if self._file_lock else nullcontext()
+
+    def _marker(self) -> Optional[int]:
+        try:
+            return os.stat(os.path.join(self.path, PRUNED_MARKER)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _reset(self) -> None:
+        """Forget open segments, the index and the delta bases (after a prune). Caller holds the locks."""
+        for storage in self._segments.values():
+            storage.close()
+        self._segments.clear()
+        self._seqs = self._list_segments()
+        self._index = None
+        self._indexed = (self._seqs[0] if self._seqs else 1, 0) # Scan progress: (segment, offset)
+        self._epoch += 1
+        self._bases.clear()
+        self._bases_bytes = 0
+        self._tail = None
+
+    def _sync_view(self) -> None:
+        """Pick up segments started, appends made and prunes run by other processes. Caller holds the locks."""
+        if not self.multiprocess:
+            return
+        marker = self._marker()
+        if marker != self._pruned_marker:
+            self._pruned_marker = marker
+            self._reset()
+            return
+        last = self._seqs[-1] if self._seqs else 0
+        for seq in self._list_segments():
+            if seq > last:
+                self._seqs.append(seq)
+        for seq in self._seqs:
+            if seq >= last and seq in self._segments:
+                self._segments[seq].refresh()
+
+    def _encode(self, key: Any, ts: float, data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Build the record of a version, as a delta if the key's previous version is known. Caller holds the locks."""
+        bases = self._bases
+        base = bases.pop(key, None)
+        if base is not None:
+            self._bases_bytes -= len(base[0])
+        if data is None:
+            return {"key": key, "ts": ts, "data": None}
+
+        encoded = _data_codec.encode(data)
+        record = None
+        if base is not None and base[1] + 1 < self.snapshot_every:
+            delta = _data_codec.encode(diff(_data_codec.decode(base[0]), data))
+            if len(delta) < len(encoded):
+                record = {"key": key, "ts": ts, "delta": delta}
+                bases[key] = (encoded, base[1] + 1)
+        if record is None:
+            record = {"key": key, "ts": ts, "data": encoded}
+            bases[key] = (encoded, 0)
+        self._bases_bytes += len(encoded)
+        while self._bases_bytes > DELTA_BASE_BYTES:
+            _, (evicted, _) = bases.popitem(last=False)
+            self._bases_bytes -= len(evicted)
+        return record
+
+    def append(self, entries: List[Tuple[Any, float, Optional[Dict[str, Any]]]]) -> None:
+        """Append (key, timestamp, document) versions; a None document records a deletion."""
+        with self._lock, self._exclusive():
+            self._sync_view()
+            if not self._seqs:
+                self._segment(1)
+            storage = self._segment(self._seqs[-1])
+            if (self._seqs[-1], storage.size) != self._tail:
+                # Another process appended meanwhile: the remembered versions
+                # may no longer be the keys' previous ones
+                self._bases.clear()
+                self._bases_bytes = 0
+            if storage.size >= self.segment_bytes:
+                storage = self._start_segment()
+            storage.write_records([self._encode(key, ts, data) for key, ts, data in entries])
+            storage.flush()
+            self._tail = (self._seqs[-1], storage.size)
+        self._maybe_prune()
+
+    def _start_segment(self) -> BlockStorage:
+        if self._seqs:
+            sealed = self._seqs[-1]
+            self._save_segment_index(sealed, self._segment_index(sealed))
+        return self._segment(self._seqs[-1] + 1 if self._seqs else 1)
+
+    def rotate(self) -> int:
+        """
+        Seal the current segment; later versions go to a new one.
+
+        Returns:
+            Number of the new segment
+        """
+        with self._lock, self._exclusive():
+            self._sync_view()
+            if self._seqs and not self._segment(self._seqs[-1]).size:
+                return self._seqs[-1] # Already empty
+            self._start_segment()
+            return self._seqs[-1]
+
+    def segments(self) -> List[str]:
+        """Paths of the segment files, oldest first."""
+        with self._lock, self._shared():
+            self._sync_view()
+            return [self._segment(seq).path for seq in self._seqs]
+
+    def _segment_index(self, seq: int, start: int = 0) -> Dict[Any, Tuple[array, array]]:
+        """Index of the versions in segment ``seq`` from offset ``start``. Caller holds the locks."""
+        index: Dict[Any, Tuple[array, array]] = {}
+        base = seq << SEGMENT_SHIFT
+        for offset, record in self._segment(seq).scan(start):
+            versions = index.get(record["key"])
+            if versions is None:
+                versions = index[record["key"]] = (array("d"), array("q"))
+            timestamps, positions = versions
+            ts = record["ts"]
+            if timestamps and ts < timestamps[-1]:
+                ts = timestamps[-1] # Clock skew between writers: keep the timestamps sorted
+            timestamps.append(ts)
+            positions.append(base | offset)
+        return index
+
+    def _save_segment_index(self, seq: int, index: Dict[Any, Tuple[array, array]]) -> None:
+        """Save the index of sealed segment ``seq`` next to it. Caller holds the locks."""
+        path = os.path.join(self.path, f"{seq:06d}{INDEX_SUFFIX}")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((INDEX_TAG, self._segment(seq).size, index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _load_segment_index(self, seq: int) -> Optional[Dict[Any, Tuple[array, array]]]:
+        """The saved index of segment ``seq``; None if missing, damaged or stale. Caller holds the locks."""
+        try:
+            with open(os.path.join(self.path, f"{seq:06d}{INDEX_SUFFIX}"), "rb") as f:
+                tag, size, index = pickle.load(f)
+        except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return None
+        if tag != INDEX_TAG or size != self._segment(seq).size:
+            return None
+        return index
+
+    def _catch_up(self) -> Dict[Any, Tuple[array, array]]:
+        """Index versions appended since the last call. Caller holds the locks."""
+        self._sync_view()
+        if self._index is None:
+            self._index = {}
+        index = self._index
+        seq, start = self._indexed
+        for seq in [s for s in self._seqs if s >= seq]:
+            segment = None
+            if not start and seq != self._seqs[-1]:
+                # Sealed: use its saved index, saving one if it has none yet
+                segment = self._load_segment_index(seq)
+                if segment is None:
+                    segment = self._segment_index(seq)
+                    self._save_segment_index(seq, segment)
+            if segment is None:
+                segment = self._segment_index(seq, start)
+            for key, (timestamps, positions) in segment.items():
+                versions = index.get(key)
+                if versions is None:
+                    index[key] = (timestamps, positions)
+                    continue
+                last = versions[0][-1]
+                for i, ts in enumerate(timestamps):
+                    if ts >= last:
+                        break
+                    timestamps[i] = last # Clock skew between segments
+                versions[0].extend(timestamps)
+                versions[1].extend(positions)
+            self._indexed = (seq, self._segment(seq).size)
+            start = 0
+        return index
+
+    def _record(self, position: int) -> Optional[Dict[str, Any]]:
+        return self._segment(position >> SEGMENT_SHIFT).read_record(position & OFFSET_MASK)
+
+    def _version(self, positions: array, i: int) -> Optional[Dict[str, Any]]:
+        """
+        Rebuild a key's ``i``-th version: its nearest full version plus the
+        deltas written since. None for a tombstone. Caller holds the locks.
+        """
+        deltas = []
+        while i >= 0:
+            record = self._record(positions[i])
+            if record is None:
+                return None
+            if "delta" not in record:
+                break
+            deltas.append(record["delta"])
+            i -= 1
+        else:
+            return None
+        if record["data"] is None:
+            return None
+        doc = _data_codec.decode(record["data"])
+        for delta in reversed(deltas):
+            doc = patch(doc, _data_codec.decode(delta))
+        return doc
+
+    def versions(self, key: Any) -> List[Tuple[float, int]]:
+        """(timestamp, position) of every version of ``key``, oldest first."""
+        with self._lock, self._shared():
+            versions = self._catch_up().get(key)
+            return list(zip(*versions)) if versions else []
+
+    def version_at(self, key: Any, timestamp: float, default: Any = None) -> Optional[Dict[str, Any]]:
+        """
+        The latest version of ``key`` archived at or before ``timestamp``
+        (None if that is a deletion), or ``default`` if there is none.
+        """
+        with self._lock, self._shared():
+            versions = self._catch_up().get(key)
+            i = bisect_right(versions[0], timestamp) if versions else 0
+            return self._version(versions[1], i - 1) if i else default
+
+    def read(self, position: int) -> Optional[Dict[str, Any]]:
+        """Document of the version stored at ``position`` (None for a tombstone)."""
+        with self._lock, self._shared():
+            record = self._record(position)
+            if record is None:
+                return None
+            positions = self._catch_up()[record["key"]][1]
+            return self._version(positions, bisect_left(positions, position))
+
+    def history(self, key: Any) -> List[Dict[str, Any]]:
+        """Every version of ``key`` as {"timestamp", "data"} entries, oldest first; deletions are left out."""
+        with self._lock, self._shared():
+            versions = self._catch_up().get(key)
+            if not versions:
+                return []
+            history = []
+            doc = None
+            for ts, position in zip(*versions):
+                record = self._record(position)
+                if record is None:
+                    doc = None
+                elif "delta" in record:
+                    doc = None if doc is None else patch(doc, _data_codec.decode(record["delta"]))
+                else:
+                    doc = None if record["data"] is None else _data_codec.decode(record["data"])
+                if doc is not None:
+                    history.append({"timestamp": ts, "data": doc})
+            return history
+
+    def keys_at(self, timestamp: float) -> Set[Any]:
+        """Keys with a version (possibly a tombstone) archived at or before ``timestamp``."""
+        with self._lock, self._shared():
+            return {key for key, (timestamps, _) in self._catch_up().items() if timestamps[0] <= timestamp}
+
+    def scan_at(self, timestamp: float) -> Iterator[Dict[str, Any]]:
+        """
+        Yield every document as it was at ``timestamp``: each key's latest
+        version up to then, unless that is a tombstone.
+
+        The versions are picked by bisecting each key's timestamps and then
+        read in position order, i.e. front to back through the segments.
+        The lock is taken per batch of documents, so archiving goes on
+        meanwhile; a prune meanwhile ends the scan.
+
+        Raises:
+            RuntimeError: If the history was pruned during the scan
+        """
+        with self._lock, self._shared():
+            epoch = self._epoch
+            picks = []
+            for timestamps, positions in self._catch_up().values():
+                i = bisect_right(timestamps, timestamp)
+                if i:
+                    picks.append((positions[i - 1], i - 1, positions))
+        picks.sort(key=lambda pick: pick[0])
+        for start in range(0, len(picks), SCAN_BATCH):
+            with self._lock, self._shared():
+                self._sync_view()
+                if self._epoch != epoch:
+                    raise RuntimeError(f"History in {self.path} was pruned during the scan")
+                batch = [self._version(positions, i) for _, i, positions in picks[start:start + SCAN_BATCH]]
+            for data in batch:
+                if data is not None:
+                    yield data
+
+    # -- Retention ----------------------------------------------------------
+
+    def set_retention(self, max_age: Optional[float] = None, max_versions: Optional[int] = None,
+                      keep_one_per: Optional[float] = None) -> None:
+        """
+        Set the retention policy (persisted in ``retention.json``); all None
+        keeps every version.
+
+        Raises:
+            ValueError: If a limit is not positive
+        """
+        policy = {"max_age": max_age, "max_versions": max_versions, "keep_one_per": keep_one_per}
+        for name, value in policy.items():
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive")
+        policy = {name: value for name, value in policy.items() if value is not None}
+        with self._lock, self._exclusive():
+            path = os.path.join(self.path, RETENTION_FILE)
+            with open(path + ".tmp", "w") as f:
+                json.dump(policy, f)
+            os.replace(path + ".tmp", path)
+            self.retention = policy
+
+    def _kept(self, timestamps: array, positions: array, now: float) -> List[int]:
+        """Indices of the versions of one key the retention policy keeps. Caller holds the locks."""
+        policy = self.retention
+        last = len(timestamps) - 1
+        keep = list(range(last + 1))
+
+        interval = policy.get("keep_one_per")
+        if interval:
+            # The last version of each interval, i.e. the one in effect at its end
+            keep = [i for i in keep if i == last or timestamps[i] // interval != timestamps[i + 1] // interval]
+
+        max_versions = policy.get("max_versions")
+        if max_versions:
+            keep = keep[-int(max_versions):]
+
+        max_age = policy.get("max_age")
+        if max_age:
+            # Versions older than the cutoff go, except the one still in
+            # effect at the cutoff (unless that is a deletion)
+            older = bisect_right([timestamps[i] for i in keep], now - max_age)
+            if older:
+                keep = keep[older - 1:]
+                record = self._record(positions[keep[0]])
+                if record is not None and "delta" not in record and record["data"] is None:
+                    keep = keep[1:]
+        return keep
+
+    def prune(self) -> Dict[str, Any]:
+        """
+        Drop the versions the retention policy no longer keeps.
+
+        The segments holding them (the current one is sealed first) are
+        rewritten without them, newest first. A kept delta whose previous
+        version is dropped is stored in full instead, so every version stays
+        readable if a crash interrupts the pass.
+
+        Returns:
+            Report with dropped versions, deltas rewritten in full, segments
+            rewritten and removed, bytes before/after and duration in seconds
+        """
+        started = time.time()
+        with self._lock, self._exclusive():
+            report = {"dropped": 0, "rebased": 0, "segments_rewritten": 0, "segments_removed": 0}
+            index = self._catch_up()
+            report["bytes_before"] = sum(self._segment(seq).size for seq in self._seqs)
+
+            drop: Set[int] = set()
+            rebase: Dict[int, Dict[str, Any]] = {}
+            if self.retention:
+                now = time.time()
+                for timestamps, positions in index.values():
+                    keep = self._kept(timestamps, positions, now)
+                    if len(keep) == len(positions):
+                        continue
+                    kept = set(keep)
+                    drop.update(position for i, position in enumerate(positions) if i not in kept)
+                    for i in keep:
+                        if i and i - 1 not in kept:
+                            record = self._record(positions[i])
+                            if record is not None and "delta" in record:
+                                rebase[positions[i]] = self._version(positions, i)
+
+            if drop:
+                affected = {position >> SEGMENT_SHIFT for position in drop}
+                affected.update(position >> SEGMENT_SHIFT for position in rebase)
+                if self._seqs[-1] in affected:
+                    self._start_segment()
+                for seq in sorted(affected, reverse=True):
+                    if self._rewrite(seq, drop, rebase):
+                        report["segments_rewritten"] += 1
+                    else:
+                        report["segments_removed"] += 1
+                self._reset()
+                if self.multiprocess:
+                    marker = os.path.join(self.path, PRUNED_MARKER)
+                    open(marker + ".tmp", "w").close()
+                    os.replace(marker + ".tmp", marker) # A new inode tells other processes to reload
+                    self._pruned_marker = self._marker()
+
+            report["dropped"] = len(drop)
+            report["rebased"] = len(rebase)
+            report["bytes_after"] = sum(self._segment(seq).size for seq in self._seqs)
+            report["duration"] = time.time() - started
+            self.last_prune = report
+            self._pruned_at = time.monotonic()
+            return report
+
+    def _rewrite(self, seq: int, drop: Set[int], rebase: Dict[int, Dict[str, Any]]) -> bool:
+        """
+        Replace a segment by a copy without the dropped versions. Returns
+        False if nothing was left and the segment was removed. Caller holds
+        the locks.
+        """
+        storage = self._segment(seq)
+        base = seq << SEGMENT_SHIFT
+        out = BlockStorage(storage.path + ".tmp", codec="binary")
+        kept = 0
+        batch = []
+        for offset, record in storage.scan():
+            position = base | offset
+            if position in drop:
+                continue
+            if position in rebase:
+                record = {"key": record["key"], "ts": record["ts"], "data": _data_codec.encode(rebase[position])}
+            batch.append(record)
+            kept += 1
+            if len(batch) >= SCAN_BATCH:
+                out.write_records(batch)
+                batch = []
+        if batch:
+            out.write_records(batch)
+        out.sync()
+        out.close()
+        storage.close()
+        del self._segments[seq]
+        if kept:
+            os.replace(out.path, storage.path)
+            self._save_segment_index(seq, self._segment_index(seq))
+        else:
+            os.remove(out.path)
+            os.remove(storage.path)
+            index_path = os.path.join(self.path, f"{seq:06d}{INDEX_SUFFIX}")
+            if os.path.exists(index_path):
+                os.remove(index_path)
+        return bool(kept)
+
+    def _maybe_prune(self) -> None:
+        """Start a background ``prune`` once ``prune_interval`` seconds have passed since the last one."""
+        if not self.retention or self.prune_interval is None:
+            return
+        if time.monotonic() - self._pruned_at < self.prune_interval:
+            return
+        if self._pruner is not None and self._pruner.is_alive():
+            return
+        self._pruned_at = time.monotonic()
+        self._pruner = threading.Thread(target=self._auto_prune, daemon=True,
+                                        name=f"smartkdb-prune-{os.path.basename(self.path)}")
+        self._pruner.start()
+
+    def _auto_prune(self) -> None:
+        try:
+            self.prune()
+        except (OSError, ValueError):
+            pass # Closed meanwhile; a later append tries again
+
+    def close(self) -> None:
+        pruner = self._pruner
+        if pruner is not None and pruner is not threading.current_thread():
+            pruner.join()
+        with self._lock:
+            for storage in self._segments.values():
+                storage.close()
+            self._segments.clear()
+            if self._file_lock is not None:
+                self._file_lock.close()
+
 
 class VersionManager:
-    def __init__(self, db_path: str):
+    """
+    Keeps the archived versions of every record.
+
+    History lives in one append-only ``HistoryStore`` per table under
+    ``history/<table>/``, versions mostly stored as deltas against the
+    previous one. Per-table retention policies (``set_retention``) bound
+    its growth. Per-record JSON files written by older versions
+    (``history/<table>_<id>.json``) are still read, as the oldest part of
+    a record's history, but never written.
+
+    ``drain``, when set, is called before every read and write of a table's
+    history; ``SmartKDB`` sets it to flush its post-commit pipeline, so the
+    versions of writes still queued there are not missed or reordered.
+    """
+
+    def __init__(self, db_path: str, segment_bytes: int = 64 << 20, snapshot_every: int = 16,
+                 prune_interval: Optional[float] = 60.0, multiprocess: bool = False):
         self.history_path = os.path.join(db_path, "history")
         if not os.path.exists(self.history_path):
             os.makedirs(self.history_path)
+        self.segment_bytes = segment_bytes
+        self.snapshot_every = snapshot_every
+        self.prune_interval = prune_interval
+        self.multiprocess = multiprocess
+        self.drain: Optional[Callable[[], Any]] = None
+        self._stores: Dict[str, HistoryStore] = {}
+        self._lock = threading.Lock()
+
+    def store(self, table: str) -> HistoryStore:
+        """The history store of ``table``, opened on first use."""
+        store = self._stores.get(table)
+        if store is None:
+            with self._lock:
+                store = self._stores.get(table)
+                if store is None:
+                    store = HistoryStore(os.path.join(self.history_path, table), self.segment_bytes,
+                                         self.snapshot_every, self.prune_interval, self.multiprocess)
+                    self._stores[table] = store
+        return store
+
+    def _drained(self, table: str) -> HistoryStore:
+        if self.drain is not None:
+            self.drain()
+        return self.store(table)
 
     def _get_history_file(self, table: str, record_id: str) -> str:
-        # Simple file-based history: history/table_recordid.json
-        # In production, this should be sharded or stored in a dedicated history table.
-        safe_id = "".join([c if c.isalnum() else "_" for c in record_id])
-        return os.path.join(self.history_path, f"{table}_{safe_id}.json")
+        # Legacy per-record history: history/table_recordid.json
+        return os.path.join(self.history_path, f"{table}_{_safe_id(record_id)}.json")
+
+    @staticmethod
+    def _read_legacy(path: str) -> List[Dict[str, Any]]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
 
-    def archive_record(self, table: str, record_id: str, data: Dict[str, Any], timestamp: float = None):
+    def _legacy_history(self, table: str, record_id: str) -> List[Dict[str, Any]]:
+        return self._read_legacy(self._get_history_file(table, record_id))
+
+    def _legacy_files(self, table: str) -> Dict[str, str]:
+        """Paths of the legacy per-record history files of ``table``, by safe record id."""
+        prefix = f"{table}_"
+        # Files of a table named "<table>_..." share the prefix; they are
+        # left to that table (legacy names cannot tell the two apart)
+        try:
+            others = [f"{name}_" for name in os.listdir(os.path.join(os.path.dirname(self.history_path), "tables"))
+                      if name.startswith(prefix)]
+        except FileNotFoundError:
+            others = []
+        files = {}
+        for name in os.listdir(self.history_path):
+            if name.startswith(prefix) and name.endswith(".json") and \
+                    not any(name.startswith(other) for other in others):
+                files[name[len(prefix):-len(".json")]] = os.path.join(self.history_path, name)
+        return files
+
+    def archive_record(self, table: str, record_id: str, data: Optional[Dict[str, Any]], timestamp: float = None):
         """
-        Save a snapshot of the record.
+        Save a snapshot of the record (one append to the table's history).
+        ``data=None`` records that the record was deleted.
         """
         if timestamp is None:
             timestamp = time.time()
+        self._drained(table).append([(record_id, timestamp, data)])
 
-        history_file = self._get_history_file(table, record_id)
-        
-        entry = {
-            "timestamp": timestamp,
-            "data": data
-        }
-
-        history = []
-        if os.path.exists(history_file):
-            try:
-                with open(history_file, "r") as f:
-                    history = json.load(f)
-            except:
-                pass # Corrupt history, start fresh
-        
-        history.append(entry)
-        
-        # Write back
-        with open(history_file, "w") as f:
-            json.dump(history, f)
+    def archive_records(self, table: str, records: List[Tuple[str, Optional[Dict[str, Any]]]], timestamp: float = None):
+        """
+        Save snapshots of several records with a single timestamp, as one
+        append to the table's history.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if records:
+            self._drained(table).append([(record_id, timestamp, data) for record_id, data in records])
+
+    def rotate(self, table: str) -> int:
+        """
+        Start a new history segment for ``table``.
+
+        Returns:
+            Number of the new segment
+        """
+        return self._drained(table).rotate()
+
+    def set_retention(self, table: str, max_age: Optional[float] = None, max_versions: Optional[int] = None,
+                      keep_one_per: Optional[float] = None) -> None:
+        """
+        Bound the history kept for ``table``; enforced by a background prune
+        every ``prune_interval`` seconds while the table is written, or by
+        calling ``prune``. A record's latest version is always kept, unless
+        it is a deletion older than ``max_age``.
+
+        Args:
+            table: Table name
+            max_age: Drop versions superseded more than this many seconds ago
+            max_versions: Keep at most this many versions per record
+            keep_one_per: Downsample to the last version of every interval
+                of this many seconds (e.g. 3600 for one per hour)
+
+        Raises:
+            ValueError: If a limit is not positive
+
+        Example:
+            >>> db.version_manager.set_retention("metrics", max_age=30 * 86400, keep_one_per=3600)
+        """
+        self.store(table).set_retention(max_age, max_versions, keep_one_per)
+
+    def retention(self, table: str) -> Dict[str, float]:
+        """The retention policy of ``table`` (empty: keep everything)."""
+        return dict(self.store(table).retention)
+
+    def prune(self, table: str) -> Dict[str, Any]:
+        """
+        Apply the retention policy of ``table`` now.
+
+        Returns:
+            Report with dropped versions, deltas rewritten in full, segments
+            rewritten and removed, bytes before/after and duration in seconds
+        """
+        return self._drained(table).prune()
 
     def get_version_at(self, table: str, record_id: str, timestamp: float) -> Optional[Dict[str, Any]]:
         """
-        Get the state of a record at a specific time.
+        Get the state of a record at a specific time: its latest version
+        archived at or before ``timestamp``, found by bisection. None if the
+        record did not exist yet or had been deleted.
         """
-        history_file = self._get_history_file(table, record_id)
-        if not os.path.exists(history_file):
-            return None
+        doc = self._drained(table).version_at(record_id, timestamp, _MISSING)
+        if doc is not _MISSING:
+            return doc
 
-        try:
-            with open(history_file, "r") as f:
-                history = json.load(f)
-        except:
-            return None
+        # Older versions may still sit in a legacy per-record file
+        legacy = self._legacy_history(table, record_id)
+        i = bisect_right([entry["timestamp"] for entry in legacy], timestamp)
+        return legacy[i - 1]["data"] if i else None
 
-        # Find the latest version <= timestamp
-        # Assuming history is sorted by timestamp (append-only)
-        candidate = None
-        for entry in history:
-            if entry["timestamp"] <= timestamp:
-                candidate = entry["data"]
-            else:
-                break
-        
-        return candidate
+    def scan_at(self, table: str, timestamp: float) -> Iterator[Dict[str, Any]]:
+        """
+        Stream the whole table as it was at ``timestamp``, in history
+        segment order, followed by the records whose version at that time
+        is only in a legacy per-record file.
+        """
+        store = self._drained(table)
+        legacy = self._legacy_files(table)
+        if not legacy:
+            return store.scan_at(timestamp)
+        return self._scan_with_legacy(store, legacy, timestamp)
+
+    def _scan_with_legacy(self, store: HistoryStore, legacy: Dict[str, str],
+                          timestamp: float) -> Iterator[Dict[str, Any]]:
+        # As in get_version_at, a record's segments win once they hold a version up to then
+        covered = {_safe_id(key) for key in store.keys_at(timestamp)}
+        yield from store.scan_at(timestamp)
+        for safe_id, path in sorted(legacy.items()):
+            if safe_id in covered:
+                continue
+            history = self._read_legacy(path)
+            i = bisect_right([entry["timestamp"] for entry in history], timestamp)
+            if i and history[i - 1]["data"] is not None:
+                yield history[i - 1]["data"]
 
     def get_history(self, table: str, record_id: str) -> List[Dict[str, Any]]:
         """
         Get full history of a record.
         """
-        history_file = self._get_history_file(table, record_id)
-        if not os.path.exists(history_file):
-            return []
+        return self._legacy_history(table, record_id) + self._drained(table).history(record_id)
 
-        try:
-            with open(history_file, "r") as f:
-                return json.load(f)
-        except:
-            return []
+    def close(self) -> None:
+        """Release the files of all opened history stores."""
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores.clear()
@@ -0,0 +1,89 @@
+import asyncio
+import os
+import shutil
+import unittest
+
+from smartkdb import AsyncSmartKDB
+
+
+class TestAsyncAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db_path = "test_aio.kdb"
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+        self.db = AsyncSmartKDB(self.db_path)
+        self.users = await self.db.create_table("users", indexes=["role"])
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    async def test_concurrent_writes_are_coalesced(self):
+        docs = await asyncio.gather(*(self.users.insert({"id": f"u{i}", "role": "user"}) for i in range(100)))
+        self.assertEqual([doc["id"] for doc in docs], [f"u{i}" for i in range(100)])
+        self.assertLess(self.users.stats["write_batches"], 10)
+
+        # A failing write only fails its own caller
+        results = await asyncio.gather(
+            self.users.insert({"id": "u1"}),
+            self.users.insert({"id": "new", "role": "admin"}),
+            self.users.update("u2", {"role": "admin"}),
+            self.users.update("missing", {"role": "admin"}),
+            self.users.delete("u3"),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(results[1]["id"], "new")
+        self.assertEqual(results[2]["role"], "admin")
+        self.assertIsInstance(results[3], ValueError)
+        self.assertIsNone(results[4])
+        self.assertEqual(len(self.users.table.query().where("role", "==", "admin").execute()), 2)
+
+        # Nor does one whose document cannot be encoded, which only shows
+        # once the batch is being written
+        results = await asyncio.gather(
+            self.users.update("u4", {"n": 1}),
+            self.users.update("u5", {"tags": {"a", "b"}}),
+            self.users.update("u6", {"n": 3}),
+            return_exceptions=True,
+        )
+        self.assertEqual(results[0]["n"], 1)
+        self.assertIsInstance(results[1], TypeError)
+        self.assertEqual(results[2]["n"], 3)
+        self.assertEqual([(await self.users.get(key)).get("n") for key in ("u4", "u5", "u6")], [1, None, 3])
+
+    async def test_concurrent_gets_are_batched(self):
+        await self.users.insert_many([{"id": f"u{i}", "role": "user"} for i in range(50)])
+        docs = await asyncio.gather(*(self.users.get(f"u{i % 25}") for i in range(50)), self.users.get("missing"))
+        self.assertEqual([doc["id"] for doc in docs[:50]], [f"u{i % 25}" for i in range(50)])
+        self.assertIsNone(docs[50])
+        self.assertEqual(self.users.stats["read_batches"], 1)
+        # Callers asking for the same key get their own copy
+        self.assertIsNot(docs[0], docs[25])
+
+    async def test_query_cursor(self):
+        await self.users.insert_many([{"id": f"u{i}", "role": "admin" if i % 2 else "user"} for i in range(30)])
+        query = self.users.query().where("role", "==", "admin")
+        self.assertEqual(len(await query.execute()), 15)
+        streamed = [doc["id"] async for doc in query.cursor(batch_size=4)]
+        self.assertEqual(sorted(streamed), sorted(f"u{i}" for i in range(1, 30, 2)))
+        self.assertEqual(len([doc async for doc in self.users.scan(batch_size=7)]), 30)
+        self.assertTrue(await self.users.query().where("id", "==", "u3").exists())
+
+    async def test_transactions(self):
+        await self.users.insert({"id": "u1", "role": "user"})
+        async with self.db.transaction() as tx:
+            await self.users.update("u1", {"role": "admin"}, transaction_id=tx.id)
+        self.assertEqual((await self.users.get("u1"))["role"], "admin")
+
+        with self.assertRaises(RuntimeError):
+            async with self.db.transaction(deferred=True) as tx:
+                await self.users.delete("u1", transaction_id=tx.id)
+                self.assertIsNone(await self.users.get("u1", transaction_id=tx.id))
+                raise RuntimeError("abort")
+        self.assertIsNotNone(await self.users.get("u1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
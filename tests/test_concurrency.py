@@ -0,0 +1,243 @@
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import unittest
+
+from smartkdb import SmartKDB, WriteConflictError
+from smartkdb.core.locks import HAVE_FILE_LOCKS
+
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_concurrency.kdb"
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+        self.db = SmartKDB(self.db_path)
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    def _run(self, workers):
+        errors = []
+
+        def guard(fn, *args):
+            try:
+                fn(*args)
+            except Exception as exc: # Reported by the main thread
+                errors.append(exc)
+
+        threads = [threading.Thread(target=guard, args=worker) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_writers_and_readers(self):
+        table = self.db.create_table("hits", indexes=["worker", {"field": "n", "type": "ordered"}])
+        table.auto_compact_min_bytes = 0
+        writers, per_writer = 6, 150
+
+        def write(w):
+            for i in range(per_writer):
+                key = f"w{w}-{i}"
+                table.insert({"id": key, "worker": w, "n": i})
+                if i % 3 == 0:
+                    table.update(key, {"n": i + 1000})
+                if i % 5 == 0:
+                    table.delete(key)
+            tx = self.db.tx_manager.begin(deferred=w % 2 == 0)
+            table.insert_many([{"id": f"tx{w}-{i}", "worker": w, "n": -1} for i in range(10)], transaction_id=tx)
+            self.db.tx_manager.commit(tx)
+
+        def read():
+            for i in range(300):
+                if i % 10 == 0:
+                    for doc in table.query().where("n", ">=", 1000).limit(20):
+                        self.assertGreaterEqual(doc["n"], 1000)
+                doc = table.get(f"w{i % writers}-1")
+                self.assertTrue(doc is None or doc["n"] == 1)
+
+        self._run([(write, w) for w in range(writers)] + [(read,) for _ in range(3)])
+        if table._compactor is not None:
+            table._compactor.join()
+
+        live = per_writer - len(range(0, per_writer, 5))
+        self.assertEqual(len(table.id_index), writers * (live + 10))
+        for w in range(writers):
+            docs = table.query().where("worker", "==", w).execute()
+            self.assertEqual(len(docs), live + 10)
+            self.assertEqual(sum(doc["n"] >= 1000 for doc in docs),
+                             len([i for i in range(0, per_writer, 3) if i % 5]))
+        self.assertEqual(sorted(doc["id"] for doc in table.scan()), sorted(k for k, _ in table.id_index.items()))
+
+        self.db.close()
+        self.db = SmartKDB(self.db_path)
+        self.assertEqual(len(self.db.get_table("hits").query().execute()), writers * (live + 10))
+
+    def test_snapshot_commits_first_writer_wins(self):
+        table = self.db.create_table("counters")
+        table.insert({"id": "c", "n": 0})
+        barrier = threading.Barrier(4)
+        outcomes = []
+
+        def bump():
+            tx = self.db.tx_manager.begin(snapshot=True)
+            n = table.get("c", transaction_id=tx)["n"]
+            barrier.wait()
+            table.update("c", {"n": n + 1}, transaction_id=tx)
+            try:
+                self.db.tx_manager.commit(tx)
+                outcomes.append("committed")
+            except WriteConflictError:
+                outcomes.append("conflict")
+
+        self._run([(bump,) for _ in range(4)])
+        self.assertEqual(sorted(outcomes), ["committed", "conflict", "conflict", "conflict"])
+        self.assertEqual(table.get("c")["n"], 1)
+
+    def test_commit_checks_and_applies_atomically(self):
+        stock = self.db.create_table("stock")
+        orders = self.db.create_table("orders")
+        stock.insert({"id": "s", "qty": 10})
+        tx = self.db.tx_manager.begin(snapshot=True)
+        stock.update("s", {"qty": 9}, transaction_id=tx)
+        orders.insert({"id": "o1"}, transaction_id=tx)
+
+        # A plain write arriving while the commit checks for conflicts waits
+        # until its changes are applied, instead of being overwritten
+        writers = []
+        check = stock._check_write_set
+
+        def racing_check(tx, changes):
+            writer = threading.Thread(target=stock.update, args=("s", {"qty": 5}))
+            writer.start()
+            writer.join(0.05)
+            self.assertTrue(writer.is_alive())
+            writers.append(writer)
+            check(tx, changes)
+
+        stock._check_write_set = racing_check
+        self.db.tx_manager.commit(tx)
+        writers[0].join()
+        self.assertEqual(stock.get("s")["qty"], 5)
+        self.assertIsNotNone(orders.get("o1"))
+
+
+# Run by each worker process of TestMultiprocess
+WORKER = """
+import sys
+from smartkdb import SmartKDB
+path, w = sys.argv[1], int(sys.argv[2])
+db = SmartKDB(path, multiprocess=True)
+table = db.get_table("hits")
+for i in range(100):
+    table.insert({"id": f"{w}-{i}", "worker": w, "n": i})
+    if i % 3 == 0:
+        table.update(f"{w}-{i}", {"n": -i})
+    if i % 5 == 0:
+        table.delete(f"{w}-{i}")
+    if i % 40 == 0:
+        table.compact()
+    table.get(f"{(w + 1) % 4}-{i // 2}")
+db.close()
+"""
+
+
+@unittest.skipUnless(HAVE_FILE_LOCKS, "multiprocess mode needs fcntl")
+class TestMultiprocess(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_multiprocess.kdb"
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+        # Handles hold their own file descriptors, so two of them in one
+        # process lock each other out like two processes would
+        self.a = SmartKDB(self.db_path, multiprocess=True)
+        self.b = SmartKDB(self.db_path, multiprocess=True)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    def test_handles_see_each_others_writes(self):
+        ta = self.a.create_table("users", indexes=["role"])
+        tb = self.b.get_table("users")
+        ta.insert({"id": "u1", "role": "admin"})
+        self.assertEqual(tb.get("u1")["role"], "admin")
+        index = tb.id_index
+
+        tb.insert({"id": "u2", "role": "user"})
+        ta.update("u1", {"role": "user"})
+        tb.delete("u2")
+        self.assertIsNone(ta.get("u2"))
+        self.assertEqual(tb.get("u1")["role"], "user")
+        self.assertEqual([d["id"] for d in tb.query().where("role", "==", "user").execute()], ["u1"])
+        # Caught up from the journal tail, not reloaded
+        self.assertIs(tb.id_index, index)
+
+        for i in range(50):
+            ta.insert({"id": f"x{i}", "role": "temp"})
+        for i in range(50):
+            tb.delete(f"x{i}")
+        ta.compact()
+        self.assertEqual(tb.get("u1")["role"], "user")
+        self.assertEqual([d["id"] for d in tb.scan()], ["u1"])
+        tb.insert({"id": "u3", "role": "user"})
+        self.assertEqual(len(ta.query().where("role", "==", "user").execute()), 2)
+
+        # History appended by either handle lands in one shared set of segments,
+        # once the handle's post-commit queue is applied
+        self.b.post_commit.flush()
+        history = self.a.version_manager.get_history("users", "u1")
+        self.assertEqual([entry["data"]["role"] for entry in history], ["admin", "user"])
+        tb.update("u1", {"role": "admin"})
+        self.b.post_commit.flush()
+        self.assertEqual(len(self.a.version_manager.get_history("users", "u1")), 3)
+
+    def test_concurrent_processes(self):
+        self.a.create_table("hits", indexes=["worker"])
+        workers = [subprocess.Popen([sys.executable, "-c", WORKER, self.db_path, str(w)],
+                                    stderr=subprocess.PIPE, text=True) for w in range(4)]
+        for worker in workers:
+            _, err = worker.communicate()
+            self.assertEqual(worker.returncode, 0, err)
+
+        table = self.b.get_table("hits")
+        expected = {f"{w}-{i}" for w in range(4) for i in range(100) if i % 5}
+        self.assertEqual({d["id"] for d in table.scan()}, expected)
+        self.assertEqual({key for key, _ in table.id_index.items()}, expected)
+        self.assertEqual(table.get("2-3")["n"], -3)
+        self.assertEqual(len(table.query().where("worker", "==", 1).execute()), 80)
+
+    def test_log_of_crashed_process_is_recovered(self):
+        self.a.create_table("users").insert({"id": "u1", "role": "admin"})
+        crash = (
+            "import os, sys\n"
+            "from smartkdb import SmartKDB\n"
+            "db = SmartKDB(sys.argv[1], multiprocess=True)\n"
+            "tx = db.tx_manager.begin()\n"
+            "db.get_table('users').update('u1', {'role': 'root'}, transaction_id=tx)\n"
+            "os._exit(1)\n"
+        )
+        subprocess.run([sys.executable, "-c", crash, self.db_path])
+        self.assertEqual(self.a.get_table("users").get("u1")["role"], "root")
+
+        # The live handles' logs are left alone, the orphan is undone
+        db = SmartKDB(self.db_path, multiprocess=True)
+        try:
+            self.assertEqual(db.last_recovery, {"redone": 0, "undone": 1})
+            self.assertEqual(self.a.get_table("users").get("u1")["role"], "admin")
+            self.assertTrue(os.path.exists(self.a.tx_manager.wal.path))
+            self.assertTrue(os.path.exists(self.b.tx_manager.wal.path))
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,13 @@
 import unittest
 import shutil
 import os
-from smartkdb import SmartKDB
+import enum
+import json
+import time
+import threading
+from collections import OrderedDict
+from smartkdb import SmartKDB, WriteConflictError
+from smartkdb.core.index import OrderedIndex
 
 class TestSmartKDBv5(unittest.TestCase):
     def setUp(self):
@@ -11,6 +17,7 @@ class TestSmartKDBv5(unittest.TestCase):
         self.db = SmartKDB(self.db_path)
 
     def tearDown(self):
+        self.db.close()
         if os.path.exists(self.db_path):
             shutil.rmtree(self.db_path)
 
@@ -22,6 +29,113 @@ class TestSmartKDBv5(unittest.TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(results[0]["name"], "Alice")
 
+    def test_scan_in_file_order(self):
+        table = self.db.create_table("events")
+        for i in range(5):
+            table.insert({"id": f"e{i}", "seq": i})
+        table.update("e1", {"seq": 10})
+        table.delete("e3")
+        self.assertEqual([doc["seq"] for doc in table.scan()], [0, 2, 4, 10])
+
+    def test_lazy_query_cursor(self):
+        table = self.db.create_table("people")
+        table.insert_many([{"id": f"p{i}", "role": "admin" if i % 10 == 0 else "user", "n": i} for i in range(100)])
+
+        page = table.query().where("role", "==", "user").offset(5).limit(3).execute()
+        self.assertEqual([doc["n"] for doc in page], [6, 7, 8])
+        self.assertEqual(table.query().where("role", "==", "admin").first()["n"], 0)
+        self.assertTrue(table.query().where("role", "==", "admin").exists())
+        self.assertFalse(table.query().where("role", "==", "owner").exists())
+        self.assertEqual(len([doc for doc in table.query().where("n", ">", 89)]), 10)
+
+        # Early termination: only the rows up to the first match are decoded
+        decoded = []
+        scan = table.scan
+        def counting_scan():
+            for doc in scan():
+                decoded.append(doc)
+                yield doc
+        table.scan = counting_scan
+        table.query().where("role", "==", "admin").offset(1).first()
+        self.assertEqual(len(decoded), 11)
+
+    def test_index_query_planner(self):
+        table = self.db.create_table("staff", indexes=["dept", "level"])
+        table.insert_many([
+            {"id": f"s{i}", "dept": ["eng", "ops", "hr"][i % 3], "level": i % 5, "age": 20 + i}
+            for i in range(60)
+        ])
+
+        query = table.query().where("dept", "==", "ops").where("level", "in", [1, 2]).where("age", ">", 40)
+        plan = query.explain()
+        self.assertEqual(plan["strategy"], "index")
+        self.assertEqual(plan["predicates"], [("dept", "==", "ops"), ("level", "in", [1, 2])])
+        self.assertEqual(plan["estimated_rows"], 8)
+        self.assertEqual(plan["residual_filters"], [("age", ">", 40)])
+        expected = [d for d in table.scan() if d["dept"] == "ops" and d["level"] in (1, 2) and d["age"] > 40]
+        self.assertEqual(query.execute(), expected)
+
+        self.assertEqual(table.query().where("id", "in", ["s3", "s4", "nope"]).explain()["strategy"], "primary_key")
+        self.assertEqual(len(table.query().where("id", "in", ["s3", "s4", "nope"]).execute()), 2)
+        self.assertEqual(table.query().where("age", "<", 30).explain()["strategy"], "full_scan")
+
+        # Index entries follow updates and deletes
+        table.update("s1", {"dept": "hr"})
+        table.delete("s4")
+        self.assertEqual(len(table.query().where("dept", "==", "ops").execute()), 18)
+
+    def test_ordered_index_ranges_and_order_by(self):
+        table = self.db.create_table("scores", indexes=[{"field": "points", "type": "ordered"}, "team"])
+        table.insert_many([{"id": f"p{i}", "points": (i * 37) % 100, "team": i % 2} for i in range(50)])
+        table.insert({"id": "nopoints", "team": 0})
+        idx = table.secondary_indexes["points"]
+        values = sorted((i * 37) % 100 for i in range(50))
+        self.assertEqual((idx.min(), idx.max()), (values[0], values[-1]))
+
+        window = table.query().where("points", ">=", 20).where("points", "<", 30)
+        self.assertEqual(window.explain()["strategy"], "index")
+        self.assertEqual(sorted(d["points"] for d in window.execute()), [v for v in values if 20 <= v < 30])
+
+        top = table.query().order_by("points", desc=True).limit(3)
+        plan = top.explain()
+        self.assertEqual(plan["strategy"], "ordered_index")
+        self.assertEqual(plan["order"], ("index", "points", "desc"))
+        self.assertEqual([d["points"] for d in top.execute()], values[::-1][:3])
+
+        everything = table.query().order_by("points").execute()
+        self.assertEqual(everything[-1]["id"], "nopoints")
+        self.assertEqual([d["points"] for d in everything[:-1]], sorted(d["points"] for d in everything[:-1]))
+
+        # Other candidate sets are sorted in memory instead
+        team = table.query().where("team", "==", 1).order_by("points")
+        self.assertEqual(team.explain()["order"], ("sort", "points", "asc"))
+        points = [d["points"] for d in team.execute()]
+        self.assertEqual(points, sorted(points))
+        self.assertEqual(len(points), 25)
+
+        # Rows are read as the cursor advances, and writes may land in between
+        reads = []
+        read = table._read
+        table._read = lambda offset: reads.append(offset) or read(offset)
+        cursor = table.query().where("points", ">=", 10).order_by("points").iter()
+        self.assertEqual(next(cursor)["points"], 10)
+        self.assertEqual(len(reads), 1)
+        del table._read
+        gone = next(i for i in range(50) if (i * 37) % 100 == min(v for v in values if v > 10))
+        table.delete(f"p{gone}")
+        table.insert({"id": "late", "points": 50.5, "team": 0})
+        self.assertEqual([d["points"] for d in cursor],
+                         sorted([v for v in values if v > 10 and v != (gone * 37) % 100] + [50.5]))
+        table.delete("late")
+
+        table.update("p1", {"points": 1000})
+        self.assertEqual(table.query().order_by("points", desc=True).first()["id"], "p1")
+        self.db.close()
+        reopened = SmartKDB(self.db_path).get_table("scores")
+        self.assertIsInstance(reopened.secondary_indexes["points"], OrderedIndex)
+        self.assertEqual(reopened.secondary_indexes["points"].max(), 1000)
+        reopened.close()
+
     def test_acid_transaction_commit(self):
         table = self.db.create_table("bank")
         tx = self.db.tx_manager.begin()
@@ -44,6 +158,277 @@ class TestSmartKDBv5(unittest.TestCase):
         results = table.query().execute()
         self.assertEqual(len(results), 0)
 
+    def test_rollback_restores_before_images(self):
+        table = self.db.create_table("ledger", indexes=["owner"])
+        table.insert({"id": "a", "owner": "ann", "bal": 10})
+        table.insert({"id": "b", "owner": "bob", "bal": 20})
+        accounts = self.db.create_table("accounts", pk="uid")
+        tx = self.db.tx_manager.begin()
+        table.update("a", {"bal": 0}, transaction_id=tx)
+        table.update("a", {"owner": "bob"}, transaction_id=tx)
+        table.delete("b", transaction_id=tx)
+        accounts.insert({"uid": "u1"}, transaction_id=tx)
+        self.db.tx_manager.rollback(tx)
+
+        self.assertEqual(table.get("a"), {"id": "a", "owner": "ann", "bal": 10})
+        self.assertEqual(table.get("b")["bal"], 20)
+        self.assertEqual([doc["id"] for doc in table.query().where("owner", "==", "bob").execute()], ["b"])
+        self.assertIsNone(accounts.get("u1"))
+
+        # A crash after the rollback recovers to the same state
+        table._save_indexes()
+        table.storage.flush()
+        recovered = SmartKDB(self.db_path)
+        self.assertEqual(recovered.last_recovery, {"redone": 0, "undone": 0})
+        self.assertEqual(recovered.get_table("ledger").get("a")["bal"], 10)
+        self.assertIsNone(recovered.get_table("accounts").get("u1"))
+        recovered.close()
+
+    def test_deferred_transaction(self):
+        table = self.db.create_table("orders", indexes=["status"])
+        table.insert({"id": "o1", "status": "open", "total": 5})
+        table.insert({"id": "o2", "status": "open", "total": 7})
+        size = table.storage.size
+
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.insert_many([{"id": f"n{i}", "status": "new", "total": i} for i in range(3)], transaction_id=tx)
+        table.update("o1", {"status": "paid"}, transaction_id=tx)
+        table.delete("o2", transaction_id=tx)
+        self.assertEqual(table.storage.size, size)
+
+        # Read-your-own-writes; other readers see committed data only
+        self.assertEqual(table.get("o1", transaction_id=tx)["status"], "paid")
+        self.assertIsNone(table.get("o2", transaction_id=tx))
+        self.assertEqual(table.get("o1")["status"], "open")
+        self.assertEqual(table.query(transaction_id=tx).where("status", "==", "open").execute(), [])
+        self.assertEqual(len(table.query(transaction_id=tx).where("status", "==", "new").execute()), 3)
+        self.assertEqual(len(table.query().where("status", "==", "open").execute()), 2)
+        with self.assertRaises(ValueError):
+            table.insert({"id": "n0"}, transaction_id=tx)
+
+        self.db.tx_manager.commit(tx)
+        self.assertEqual(table.get("o1")["status"], "paid")
+        self.assertIsNone(table.get("o2"))
+        self.assertEqual([d["id"] for d in table.query().where("status", "==", "new").order_by("total").execute()],
+                         ["n0", "n1", "n2"])
+
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.update("n0", {"total": 100}, transaction_id=tx)
+        size = table.storage.size
+        self.db.tx_manager.rollback(tx)
+        self.assertEqual(table.storage.size, size)
+        self.assertEqual(table.get("n0")["total"], 0)
+
+        # A key inserted by someone else after it was staged fails the commit
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.insert({"id": "o2", "status": "reopened"}, transaction_id=tx)
+        table.insert({"id": "n9", "status": "new"}, transaction_id=tx)
+        table.update("n1", {"total": 100}, transaction_id=tx)
+        table.insert({"id": "n9", "status": "direct"})
+        with self.assertRaises(ValueError):
+            self.db.tx_manager.commit(tx)
+        self.assertEqual(table.get("n9")["status"], "direct")
+        self.assertIsNone(table.get("o2"))
+        self.assertEqual(table.get("n1")["total"], 1)
+        self.assertIsNone(self.db.tx_manager.get_transaction(tx))
+
+        # Re-inserting a key the transaction deleted replaces the record
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.delete("n2", transaction_id=tx)
+        table.insert({"id": "n2", "status": "replaced"}, transaction_id=tx)
+        self.db.tx_manager.commit(tx)
+        self.assertEqual(table.get("n2")["status"], "replaced")
+
+    def test_failed_commit_is_rolled_back(self):
+        accounts = self.db.create_table("accounts")
+        accounts.insert({"id": "a", "bal": 10})
+        tags = self.db.create_table("tags")
+        tags.insert({"id": "t", "names": []})
+        packed = self.db.create_table("packed", codec="binary")
+        packed.insert({"id": "p", "n": 0})
+
+        # accounts is applied first, then a document that cannot be encoded fails the commit
+        for table, key, updates, error in ((tags, "t", {"names": {"x"}}, TypeError),
+                                           (packed, "p", {"n": object()}, ValueError)):
+            tx = self.db.tx_manager.begin(deferred=True)
+            accounts.update("a", {"bal": 0}, transaction_id=tx)
+            table.update(key, updates, transaction_id=tx)
+            with self.assertRaises(error):
+                self.db.tx_manager.commit(tx)
+            self.assertIsNone(self.db.tx_manager.get_transaction(tx))
+            self.assertEqual(accounts.get("a")["bal"], 10)
+        self.assertEqual(tags.get("t"), {"id": "t", "names": []})
+        self.assertEqual(packed.get("p"), {"id": "p", "n": 0})
+        self.assertEqual(len(self.db.version_manager.get_history("accounts", "a")), 1)
+        self.assertTrue(self.db.tx_manager.checkpoint())
+
+        self.db.close()
+        self.db = SmartKDB(self.db_path)
+        self.assertEqual(self.db.get_table("accounts").get("a")["bal"], 10)
+        self.assertEqual(self.db.get_table("tags").get("t"), {"id": "t", "names": []})
+
+    def test_snapshot_isolation(self):
+        table = self.db.create_table("stock", indexes=[{"field": "qty", "type": "ordered"}])
+        table.insert_many([{"id": f"s{i}", "qty": i} for i in range(5)])
+        reader = self.db.tx_manager.begin(snapshot=True)
+
+        table.update("s1", {"qty": 100})
+        table.delete("s2")
+        table.insert({"id": "s9", "qty": 9})
+        table.update("s1", {"qty": 200})
+
+        self.assertEqual(table.get("s1", transaction_id=reader)["qty"], 1)
+        self.assertEqual(table.get("s2", transaction_id=reader)["qty"], 2)
+        self.assertIsNone(table.get("s9", transaction_id=reader))
+        snapshot = table.query(transaction_id=reader).where("qty", ">=", 1).order_by("qty").execute()
+        self.assertEqual([doc["id"] for doc in snapshot], ["s1", "s2", "s3", "s4"])
+        self.assertEqual(table.get("s1")["qty"], 200)
+        with self.assertRaises(ValueError):
+            table.compact()
+
+        # Write-write conflict: s1 changed after the snapshot was taken
+        table.update("s1", {"qty": 2}, transaction_id=reader)
+        with self.assertRaises(WriteConflictError):
+            self.db.tx_manager.commit(reader)
+        self.assertEqual(table.get("s1")["qty"], 200)
+        self.assertEqual(table._versions, {})
+
+        writer = self.db.tx_manager.begin(snapshot=True)
+        table.update("s3", {"qty": 30}, transaction_id=writer)
+        table.update("s4", {"qty": 40})
+        self.db.tx_manager.commit(writer)
+        self.assertEqual(table.get("s3")["qty"], 30)
+
+    def test_wal_recovery_redoes_committed_transaction(self):
+        table = self.db.create_table("ledger")
+        table.insert({"id": "a", "balance": 10})
+        self.db.close()
+        table_dir = os.path.join(self.db_path, "tables", "ledger")
+        shutil.copytree(table_dir, table_dir + ".bak")
+
+        db = SmartKDB(self.db_path)
+        table = db.get_table("ledger")
+        tx = db.tx_manager.begin()
+        table.update("a", {"balance": 5}, transaction_id=tx)
+        table.insert({"id": "b", "balance": 5}, transaction_id=tx)
+        db.tx_manager.commit(tx)
+
+        # Crash: the commit record survived, the table writes did not
+        shutil.rmtree(table_dir)
+        os.rename(table_dir + ".bak", table_dir)
+        recovered = SmartKDB(self.db_path)
+        self.assertEqual(recovered.last_recovery, {"redone": 2, "undone": 0})
+        ledger = recovered.get_table("ledger")
+        self.assertEqual(ledger.get("a")["balance"], 5)
+        self.assertEqual(ledger.get("b")["balance"], 5)
+        recovered.close()
+        self.assertEqual(os.path.getsize(os.path.join(self.db_path, "wal.log")), 0)
+
+    def test_wal_recovery_undoes_uncommitted_transaction(self):
+        table = self.db.create_table("ledger", indexes=["owner"])
+        table.insert({"id": "a", "owner": "ann", "balance": 10})
+        tx = self.db.tx_manager.begin()
+        table.update("a", {"balance": 0}, transaction_id=tx)
+        table.insert({"id": "b", "owner": "bob", "balance": 10}, transaction_id=tx)
+        table.delete("a", transaction_id=tx)
+
+        # Crash after the writes reached the files, before commit
+        table._save_indexes()
+        table.storage.flush()
+        recovered = SmartKDB(self.db_path)
+        self.assertEqual(recovered.last_recovery, {"redone": 0, "undone": 3})
+        ledger = recovered.get_table("ledger")
+        self.assertEqual(ledger.get("a")["balance"], 10)
+        self.assertIsNone(ledger.get("b"))
+        self.assertEqual(len(ledger.query().where("owner", "==", "ann").execute()), 1)
+        recovered.close()
+
+    def test_wal_forced_once_per_commit(self):
+        self.db.close()
+        db = SmartKDB(self.db_path, durability="on_commit")
+        table = db.create_table("ledger")
+        other = db.create_table("other")
+        table.insert_many([{"id": f"a{i}", "balance": 10} for i in range(50)])
+        wal = db.tx_manager.wal.storage
+        wal_inode = os.fstat(wal._file.fileno()).st_ino
+        wal_syncs = []
+        real_fsync = os.fsync
+
+        def tracing_fsync(fd):
+            if os.fstat(fd).st_ino == wal_inode:
+                wal_syncs.append(fd)
+            real_fsync(fd)
+
+        os.fsync = tracing_fsync
+        try:
+            tx = db.tx_manager.begin()
+            for i in range(50):
+                table.update(f"a{i}", {"balance": 0}, transaction_id=tx)
+            self.assertEqual(wal_syncs, [])
+            # An fsync of a data file first forces the log entries written so far
+            other.insert({"id": "x"})
+            self.assertEqual(len(wal_syncs), 1)
+            self.assertEqual(wal._synced_gen, wal._write_gen)
+            table.update("a0", {"balance": 1}, transaction_id=tx)
+            db.tx_manager.commit(tx)
+            self.assertEqual(len(wal_syncs), 2)
+        finally:
+            os.fsync = real_fsync
+        db.close()
+
+    def test_rollback_commits_each_table_once(self):
+        self.db.close()
+        db = SmartKDB(self.db_path, durability="on_commit")
+        table = db.create_table("ledger", indexes=["owner"])
+        table.insert_many([{"id": f"a{i}", "owner": "ann", "balance": 10} for i in range(50)])
+        commits = []
+        commit = table.storage.commit
+        table.storage.commit = lambda: commits.append(1) or commit()
+
+        tx = db.tx_manager.begin()
+        for i in range(50):
+            table.update(f"a{i}", {"owner": "bob", "balance": 0}, transaction_id=tx)
+        table.insert({"id": "new", "owner": "bob"}, transaction_id=tx)
+        db.tx_manager.rollback(tx)
+        self.assertEqual(len(commits), 1)
+        self.assertEqual({doc["balance"] for doc in table.query().execute()}, {10})
+        self.assertEqual(table.query().where("owner", "==", "bob").execute(), [])
+
+        # Restored indexes are saved and survive a reopen
+        db.close()
+        db = SmartKDB(self.db_path)
+        table = db.get_table("ledger")
+        self.assertIsNone(table.get("new"))
+        self.assertEqual(len(table.query().where("owner", "==", "ann").execute()), 50)
+        db.close()
+
+    def test_index_journals_synced_before_data(self):
+        self.db.close()
+        for durability in ("on_commit", "always"):
+            shutil.rmtree(self.db_path)
+            db = SmartKDB(self.db_path, durability=durability)
+            table = db.create_table("ledger", indexes=["owner"])
+            table.insert({"id": "a", "owner": "ann"})
+            files = {os.stat(os.path.join(table.table_dir, name)).st_ino: name
+                     for name in ("data.bin", "pk.idx.log", "owner.idx.log")}
+            synced = []
+            real_fsync = os.fsync
+
+            def tracing_fsync(fd):
+                synced.append(files.get(os.fstat(fd).st_ino))
+                real_fsync(fd)
+
+            os.fsync = tracing_fsync
+            try:
+                table.update("a", {"owner": "bob"})
+            finally:
+                os.fsync = real_fsync
+            # The deletion mark of the old version reaches the disk after the new index entries
+            last_data_sync = len(synced) - 1 - synced[::-1].index("data.bin")
+            self.assertIn("pk.idx.log", synced[:last_data_sync])
+            self.assertIn("owner.idx.log", synced[:last_data_sync])
+            db.close()
+
     def test_versioning(self):
         table = self.db.create_table("history_test", pk="id")
         doc = table.insert({"id": "doc1", "val": 1})
@@ -59,5 +444,241 @@ class TestSmartKDBv5(unittest.TestCase):
         history = self.db.version_manager.get_history("history_test", "doc1")
         self.assertEqual(len(history), 2) # Insert + Update
 
+    def test_history_of_json_only_values(self):
+        class Level(enum.IntEnum):
+            HIGH = 2
+
+        table = self.db.create_table("alerts")
+        table.insert({"id": "a", "level": Level.HIGH, "meta": OrderedDict(src="x")})
+        tx = self.db.tx_manager.begin()
+        table.update("a", {"level": Level.HIGH, "n": 1}, transaction_id=tx)
+        self.db.tx_manager.commit(tx)
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.update("a", {"meta": OrderedDict(src="y")}, transaction_id=tx)
+        self.db.tx_manager.commit(tx)
+
+        # Archived as the table stores them
+        history = self.db.version_manager.get_history("alerts", "a")
+        self.assertEqual([entry["data"] for entry in history], [
+            {"id": "a", "level": 2, "meta": {"src": "x"}},
+            {"id": "a", "level": 2, "meta": {"src": "x"}, "n": 1},
+            {"id": "a", "level": 2, "meta": {"src": "y"}, "n": 1},
+        ])
+        self.assertEqual(self.db.post_commit.stats()["errors"], 0)
+
+    def test_history_segments(self):
+        vm = self.db.version_manager
+        vm.segment_bytes = 512
+        table = self.db.create_table("segmented")
+        table.insert({"id": "a", "v": 0})
+        for v in range(1, 20):
+            table.update("a", {"v": v, "pad": "x" * 50})
+        vm.archive_record("segmented", "b", {"id": "b"}, timestamp=1.0)
+
+        # Old per-record files still count as the start of a record's history
+        with open(os.path.join(vm.history_path, "segmented_b.json"), "w") as f:
+            json.dump([{"timestamp": 0.5, "data": {"id": "b", "old": True}}], f)
+
+        segments = vm.store("segmented").segments()
+        self.assertGreater(len(segments), 1)
+        self.assertEqual(vm.rotate("segmented"), len(segments) + 1)
+        vm.archive_record("segmented", "b", {"id": "b", "v": 2}, timestamp=2.0)
+        self.db.close()
+
+        vm = SmartKDB(self.db_path).version_manager
+        self.assertEqual([entry["data"]["v"] for entry in vm.get_history("segmented", "a")], list(range(20)))
+        self.assertEqual([entry["timestamp"] for entry in vm.get_history("segmented", "b")], [0.5, 1.0, 2.0])
+        self.assertEqual(vm.get_version_at("segmented", "b", 0.7), {"id": "b", "old": True})
+        self.assertEqual(vm.get_version_at("segmented", "b", 1.5), {"id": "b"})
+        self.assertEqual(vm.get_version_at("segmented", "b", 9.0), {"id": "b", "v": 2})
+        self.assertIsNone(vm.get_version_at("segmented", "b", 0.1))
+        self.assertEqual(vm.get_history("segmented", "missing"), [])
+        vm.close()
+
+    def test_as_of_queries(self):
+        table = self.db.create_table("accounts", indexes=["tier"])
+        table.insert_many([{"id": f"a{i}", "tier": "free", "n": i} for i in range(10)])
+        time.sleep(0.01)
+        before = time.time()
+        time.sleep(0.01)
+        table.update("a1", {"tier": "pro"})
+        table.delete("a2")
+        tx = self.db.tx_manager.begin(deferred=True)
+        table.delete("a3", transaction_id=tx)
+        table.insert({"id": "a10", "tier": "pro", "n": 10}, transaction_id=tx)
+        self.db.tx_manager.commit(tx)
+
+        self.assertEqual(table.get("a1", as_of=before)["tier"], "free")
+        self.assertIsNone(table.get("a2"))
+        self.assertEqual(table.get("a2", as_of=before)["n"], 2)
+        self.assertIsNone(table.get("a10", as_of=before))
+        self.assertIsNone(table.get("a2", as_of=time.time()))
+        with self.assertRaises(ValueError):
+            table.get("a1", transaction_id="tx", as_of=before)
+
+        then = table.query().as_of(before)
+        self.assertEqual(sorted(doc["n"] for doc in then.execute()), list(range(10)))
+        self.assertEqual(then.explain()["strategy"], "history")
+        self.assertEqual(table.query().as_of(before).where("tier", "==", "pro").execute(), [])
+        self.assertEqual(sorted(doc["id"] for doc in table.query().as_of(time.time()).where("tier", "==", "pro")),
+                         ["a1", "a10"])
+        self.assertEqual(len(table.query().as_of(time.time()).execute()), 9)
+        top = table.query().as_of(before).order_by("n", desc=True).limit(2).execute()
+        self.assertEqual([doc["n"] for doc in top], [9, 8])
+
+        by_key = table.query().as_of(before).where("id", "in", ["a2", "a3", "a10"])
+        self.assertEqual(by_key.explain()["estimated_rows"], 3)
+        self.assertEqual(sorted(doc["id"] for doc in by_key.execute()), ["a2", "a3"])
+        # Deletions are not part of a record's history
+        self.assertEqual(len(self.db.version_manager.get_history("accounts", "a2")), 1)
+
+    def test_insert_many_and_update_many(self):
+        table = self.db.create_table("bulk", indexes=["group"])
+        docs = table.insert_many([{"id": f"r{i}", "group": i % 3, "n": i} for i in range(30)])
+        self.assertEqual(len(docs), 30)
+        self.assertEqual(table.get("r7")["n"], 7)
+        self.assertEqual(len(table.secondary_indexes["group"].get(1)), 10)
+
+        # Duplicates are rejected before anything is written
+        with self.assertRaises(ValueError):
+            table.insert_many([{"id": "new"}, {"id": "r1"}])
+        self.assertIsNone(table.get("new"))
+
+        updated = table.update_many([("r1", {"n": 100}), ("r2", {"group": 1}), ("r1", {"tag": "x"})])
+        self.assertEqual(updated[2], {"id": "r1", "group": 1, "n": 100, "tag": "x"})
+        self.assertEqual(table.get("r1")["n"], 100)
+        self.assertEqual(table.get("r1")["tag"], "x")
+        self.assertEqual(len(table.secondary_indexes["group"].get(1)), 11)
+        self.assertEqual(len(table.secondary_indexes["group"].get(2)), 9)
+
+        history = self.db.version_manager.get_history("bulk", "r1")
+        self.assertEqual(len(history), 3) # Insert + 2 updates
+
+    def test_table_codec_persists(self):
+        table = self.db.create_table("packed", codec="binary", indexes=["kind"])
+        table.insert({"id": "a", "kind": "x", "score": 1.5})
+        self.db.close()
+
+        reopened = SmartKDB(self.db_path).get_table("packed")
+        self.assertEqual(reopened.codec, "binary")
+        self.assertEqual(reopened.get("a"), {"id": "a", "kind": "x", "score": 1.5})
+        reopened.close()
+
+    def test_lazy_table_open(self):
+        table = self.db.create_table("lazy", indexes=["tag"])
+        table.insert_many([{"id": f"l{i}", "tag": i % 3} for i in range(30)])
+        self.db.close()
+        meta_path = os.path.join(self.db_path, "tables", "lazy", "meta.json")
+        mtime = os.stat(meta_path).st_mtime_ns
+
+        reopened = SmartKDB(self.db_path).get_table("lazy")
+        self.assertIn("open", reopened.load_stats)
+        self.assertIsNone(reopened._id_index)
+        self.assertIsNone(reopened._secondary_indexes)
+        self.assertEqual(os.stat(meta_path).st_mtime_ns, mtime)
+
+        self.assertEqual(reopened.get("l4")["tag"], 1)
+        self.assertIn("pk_index", reopened.load_stats)
+        self.assertIsNone(reopened._secondary_indexes)
+        self.assertEqual(len(reopened.query().where("tag", "==", 2).execute()), 10)
+        self.assertIn("secondary_indexes", reopened.load_stats)
+        reopened.close()
+
+    def test_record_cache(self):
+        table = self.db.create_table("cached")
+        table.insert({"id": "hot", "n": 1})
+
+        first = table.get("hot")
+        first["n"] = 999 # Callers get copies, the cache is not affected
+        self.assertEqual(table.get("hot")["n"], 1)
+        stats = self.db.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+        table.update("hot", {"n": 2})
+        self.assertEqual(table.get("hot")["n"], 2)
+        table.delete("hot")
+        self.assertIsNone(table.get("hot"))
+
+        tiny = SmartKDB(self.db_path, cache_bytes=2000)
+        small = tiny.get_table("cached")
+        small.insert_many([{"id": f"k{i}", "pad": "x" * 100} for i in range(20)])
+        for i in range(20):
+            small.get(f"k{i}")
+        self.assertGreater(tiny.cache.stats()["evictions"], 0)
+        self.assertLessEqual(tiny.cache.stats()["size_bytes"], 2000)
+        tiny.close()
+
+    def test_compact_pk_index_table(self):
+        table = self.db.create_table("big", pk_index="compact", indexes=["kind"])
+        docs = table.insert_many([{"kind": i % 2} for i in range(300)])
+        table.update(docs[10]["id"], {"kind": 5})
+        table.delete(docs[11]["id"])
+        self.assertEqual(table.get(docs[10]["id"])["kind"], 5)
+        self.assertIsNone(table.get(docs[11]["id"]))
+        self.assertEqual(table.query().where("id", "==", docs[12]["id"]).first()["kind"], 0)
+
+        table.compact()
+        self.db.close()
+        reopened = SmartKDB(self.db_path).get_table("big")
+        self.assertEqual(reopened.pk_index, "compact")
+        self.assertEqual(len(reopened.id_index), 299)
+        self.assertEqual(reopened.get(docs[299]["id"])["kind"], 1)
+        reopened.close()
+
+    def test_compaction(self):
+        table = self.db.create_table("compact_me", indexes=["group"])
+        table.insert_many([{"id": f"r{i}", "group": i % 2, "n": i} for i in range(40)])
+        for i in range(0, 40, 2):
+            table.update(f"r{i}", {"n": -i})
+        for i in range(1, 40, 4):
+            table.delete(f"r{i}")
+        dead_before = table.storage.dead_bytes
+        self.assertGreater(dead_before, 0)
+
+        report = table.compact()
+        self.assertEqual(report["reclaimed_bytes"], dead_before)
+        self.assertEqual(report["live_records"], 30)
+        self.assertEqual(table.storage.dead_bytes, 0)
+        self.assertEqual(table.get("r4")["n"], -4)
+        self.assertIsNone(table.get("r5"))
+        self.assertEqual(len(table.query().where("group", "==", 0).execute()), 20)
+        self.assertEqual(len(table.secondary_indexes["group"].get(1)), 10)
+
+        # Offsets survive a reopen, and writes continue on the new segment
+        table.insert({"id": "after", "group": 1})
+        self.db.close()
+        reopened = SmartKDB(self.db_path).get_table("compact_me")
+        self.assertEqual(reopened.get("r6")["n"], -6)
+        self.assertEqual(reopened.get("after")["group"], 1)
+        reopened.close()
+
+    def test_auto_compaction(self):
+        table = self.db.create_table("churn")
+        table.auto_compact_min_bytes = 0
+        table.insert({"id": "counter", "n": 0})
+        for i in range(1, 10):
+            table.update("counter", {"n": i})
+            if table._compactor is not None:
+                table._compactor.join() # Compaction runs in the background
+        self.assertIsNotNone(table.last_compaction)
+        self.assertLess(table.storage.size, 200)
+        self.assertEqual(table.get("counter")["n"], 9)
+
+        # Reopened, the dead bytes are counted off the write path
+        self.db.close()
+        self.db = SmartKDB(self.db_path)
+        table = self.db.get_table("churn")
+        table.auto_compact_min_bytes = 0
+        self.assertIsNone(table.storage.counted_dead_bytes)
+        walkers = []
+        walk = table.storage._walk
+        table.storage._walk = lambda *args: walkers.append(threading.current_thread()) or walk(*args)
+        table.update("counter", {"n": 10})
+        table._compactor.join()
+        self.assertNotIn(threading.current_thread(), walkers)
+        counted = table.storage.counted_dead_bytes
+        table.storage._dead_bytes = None
+        self.assertEqual(counted, table.storage.dead_bytes)
+
 if __name__ == '__main__':
     unittest.main()
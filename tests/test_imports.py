@@ -0,0 +1,32 @@
+import subprocess
+import sys
+import unittest
+
+
+class TestImportTime(unittest.TestCase):
+    def _loaded_after(self, statement):
+        code = f"import sys; {statement}; print(' '.join(sorted(sys.modules)))"
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        return set(out.stdout.split())
+
+    def test_core_import_skips_optional_modules(self):
+        loaded = self._loaded_after("from smartkdb import SmartKDB")
+        for module in ("requests", "smartkdb.ai.brain", "smartkdb.ai.trainer",
+                       "smartkdb.ai.llm_connectors", "smartkdb.plugins.manager", "smartkdb.core.aio"):
+            self.assertNotIn(module, loaded)
+
+    def test_optional_components_load_on_access(self):
+        loaded = self._loaded_after("import smartkdb; smartkdb.Brain; smartkdb.PluginManager")
+        self.assertIn("smartkdb.ai.brain", loaded)
+        self.assertIn("smartkdb.plugins.manager", loaded)
+        self.assertNotIn("smartkdb.ai.trainer", loaded)
+
+        import smartkdb
+        from smartkdb.ai.llm_connectors import LLMConnector
+        self.assertIs(smartkdb.LLMConnector, LLMConnector)
+        with self.assertRaises(AttributeError):
+            smartkdb.Missing
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,185 @@
+import unittest
+import shutil
+import os
+import pickle
+import tracemalloc
+import uuid
+from smartkdb.core.index import Index, SecondaryIndex, CompactIndex, OVERLAY_FRACTION
+
+class TestIndexJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = "test_index_dir"
+        if os.path.exists(self.dir_path):
+            shutil.rmtree(self.dir_path)
+        os.makedirs(self.dir_path)
+        self.path = os.path.join(self.dir_path, "pk.idx")
+
+    def tearDown(self):
+        if os.path.exists(self.dir_path):
+            shutil.rmtree(self.dir_path)
+
+    def test_journal_replay_and_checkpoint(self):
+        idx = Index(self.path, checkpoint_min=100)
+        for i in range(10):
+            idx.set(f"k{i}", i)
+            idx.save()
+        idx.remove("k3")
+        idx.save()
+        idx.close()
+
+        # Small changes only touch the journal
+        self.assertFalse(os.path.exists(self.path))
+        reloaded = Index(self.path, checkpoint_min=100)
+        self.assertEqual(len(reloaded.data), 9)
+        self.assertIsNone(reloaded.get("k3"))
+
+        for i in range(10, 200):
+            reloaded.set(f"k{i}", i)
+        reloaded.save()
+        reloaded.close()
+
+        # A large batch is folded into a snapshot
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(Index(self.path).get("k150"), 150)
+
+    def test_journal_bounded_while_growing(self):
+        idx = Index(self.path, checkpoint_min=100)
+        for batch in range(50):
+            for i in range(200):
+                idx.set(f"k{batch}-{i}", batch)
+            idx.save()
+            # Insert-only growth still folds the journal into snapshots
+            self.assertLessEqual(os.path.getsize(idx.log_path), os.path.getsize(self.path))
+        self.assertLess(idx.generation, 15)
+        idx.close()
+        self.assertEqual(len(Index(self.path)), 10000)
+
+    def test_torn_tail_and_stale_journal(self):
+        idx = SecondaryIndex(self.path)
+        idx.add("red", 1)
+        idx.add("red", 2)
+        idx.save()
+        idx.close()
+
+        # A half-written record at the end of the journal is ignored
+        with open(idx.log_path, "ab") as f:
+            f.write(b"\x40\x00\x00\x00partial")
+        reloaded = SecondaryIndex(self.path)
+        self.assertEqual(list(reloaded.get("red")), [1, 2])
+        reloaded.remove_val("red", 1)
+        reloaded.save()
+        self.assertEqual(list(SecondaryIndex(self.path).get("red")), [2])
+
+        # A journal left over from an older snapshot generation is discarded
+        reloaded.checkpoint()
+        with open(self.path, "rb") as f:
+            tag, generation, data = pickle.load(f)
+        self.assertEqual(generation, 1)
+        with open(idx.log_path, "wb") as f:
+            f.write(reloaded._encode(("gen", 0)) + reloaded._encode(("rm", "red", 2)))
+        self.assertEqual(list(SecondaryIndex(self.path).get("red")), [2])
+
+    def test_legacy_pickle_and_corruption(self):
+        with open(self.path, "wb") as f:
+            pickle.dump({"a": 10}, f)
+        self.assertEqual(Index(self.path).get("a"), 10)
+
+        with open(self.path, "wb") as f:
+            f.write(b"\x80\x04garbage")
+        with self.assertRaises(ValueError):
+            Index(self.path)
+
+    def test_sorted_posting_lists(self):
+        idx = SecondaryIndex(self.path)
+        for offset in (50, 10, 30, 10, 40):
+            idx.add("k", offset)
+        self.assertEqual(idx.get("k").typecode, "q")
+        self.assertEqual(list(idx.get("k")), [10, 30, 40, 50])
+        idx.remove_val("k", 30)
+        idx.remove_val("k", 35) # Not present: no-op
+        self.assertEqual(list(idx.get("k")), [10, 40, 50])
+        for offset in (10, 40, 50):
+            idx.remove_val("k", offset)
+        self.assertIsNone(idx.get("k"))
+
+        # Legacy list postings are converted on load
+        legacy_path = os.path.join(self.dir_path, "legacy.idx")
+        with open(legacy_path, "wb") as f:
+            pickle.dump({"old": [7, 3]}, f)
+        self.assertEqual(list(SecondaryIndex(legacy_path).get("old")), [3, 7])
+
+    def test_compact_index(self):
+        idx = CompactIndex(self.path, checkpoint_min=50)
+        keys = ["3f1c2a9e-5b7d-4c1e-9a2b-8d7e6f5a4b3c", "plain", 42, 7.5, "ABCDEFGH-not-a-uuid-but-36-chars-xx"]
+        for i, key in enumerate(keys):
+            idx.set(key, i * 100)
+        idx.save()
+        self.assertEqual(idx.get(42), 200)
+        self.assertEqual(idx.get(42.0), 200)
+        self.assertIsNone(idx.get("missing"))
+
+        # Enough changes to fold the overlay into a memory-mapped snapshot
+        for i in range(100):
+            idx.set(f"k{i:03d}", i)
+        idx.save()
+        self.assertIsInstance(idx._ends, memoryview)
+        self.assertEqual(len(idx), 105)
+        self.assertEqual(idx.get("k050"), 50)
+        self.assertEqual(idx.get(keys[0]), 0)
+
+        # Overlay on top of the mapped base: update, remove, re-add
+        idx.set("k050", 5000)
+        idx.remove("k051")
+        idx.remove("plain")
+        idx.set("plain", 1)
+        idx.remove("never-there")
+        self.assertEqual(len(idx), 104)
+        self.assertEqual(dict(idx.items())["k050"], 5000)
+        idx.close()
+
+        reloaded = CompactIndex(self.path)
+        self.assertEqual(reloaded.get("k050"), 5000)
+        self.assertIsNone(reloaded.get("k051"))
+        self.assertEqual(reloaded.get("plain"), 1)
+        self.assertEqual(reloaded.get(keys[0]), 0)
+        self.assertEqual(len(reloaded), 104)
+
+        reloaded.remap_offsets({v: v + 1 for v in reloaded.values()})
+        self.assertEqual(reloaded.get("k050"), 5001)
+
+    def test_compact_index_overlay_bounded(self):
+        keys = [str(uuid.uuid4()) for _ in range(20000)]
+        idx = CompactIndex(self.path, checkpoint_min=100)
+        hashed = Index(os.path.join(self.dir_path, "hash.idx"), checkpoint_min=100)
+        for start in range(0, len(keys), 500):
+            for i in range(start, start + 500):
+                idx.set(keys[i], i)
+                hashed.set(keys[i], i)
+            idx.save()
+            hashed.save()
+            self.assertLess(len(idx._overlay), max(100, idx._count // OVERLAY_FRACTION))
+        idx.close()
+        hashed.close()
+
+        tracemalloc.start()
+        reloaded = CompactIndex(self.path)
+        compact_heap = tracemalloc.get_traced_memory()[0]
+        reloaded_hash = Index(hashed.path)
+        hash_heap = tracemalloc.get_traced_memory()[0] - compact_heap
+        tracemalloc.stop()
+        # Most keys are served from the mapped snapshot, not the overlay
+        self.assertLess(len(reloaded._overlay), len(keys) // OVERLAY_FRACTION)
+        self.assertLess(compact_heap, hash_heap / 4)
+        self.assertEqual(reloaded.get(keys[12345]), 12345)
+        self.assertEqual(len(reloaded), len(reloaded_hash))
+
+    def test_compact_index_converts_pickled_snapshot(self):
+        with open(self.path, "wb") as f:
+            pickle.dump({"a": 1, "b": 2}, f)
+        idx = CompactIndex(self.path)
+        self.assertEqual(dict(idx.items()), {"a": 1, "b": 2})
+        idx.checkpoint()
+        self.assertEqual(CompactIndex(self.path).get("b"), 2)
+
+if __name__ == '__main__':
+    unittest.main()
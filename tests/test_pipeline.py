@@ -0,0 +1,134 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+
+from smartkdb import SmartKDB
+from smartkdb.core.distributed import NodeManager
+from smartkdb.core.pipeline import PostCommitPipeline
+from smartkdb.core.versioning import VersionManager
+
+
+class GatedNodeManager(NodeManager):
+    """Records broadcasts, each one waiting for ``gate`` to open."""
+
+    def __init__(self):
+        super().__init__("localhost:8000")
+        self.gate = threading.Event()
+        self.sent = []
+
+    def broadcast_updates(self, table, records):
+        self.gate.wait()
+        if table == "broken":
+            raise ConnectionError("peer down")
+        self.sent.append((table, [key for key, _ in records]))
+
+
+class TestPostCommitPipeline(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_pipeline.kdb"
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    def tearDown(self):
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    def test_writes_are_archived_in_background(self):
+        db = SmartKDB(self.db_path)
+        table = db.create_table("items")
+        doc = table.insert({"id": "a", "n": 0})
+        doc["n"] = -1 # The caller's copy is not what gets archived
+        before = time.time()
+        time.sleep(0.01)
+        for n in range(1, 50):
+            table.update("a", {"n": n})
+        table.insert_many([{"id": f"b{i}"} for i in range(10)])
+        table.delete("b0")
+
+        # History reads wait for the queue
+        self.assertEqual(table.get("a", as_of=before), {"id": "a", "n": 0})
+        self.assertEqual([e["data"]["n"] for e in db.version_manager.get_history("items", "a")], list(range(50)))
+        self.assertEqual(len(table.query().as_of(time.time()).execute()), 10)
+        stats = db.post_commit.stats()
+        self.assertEqual((stats["pending"], stats["lag"]), (0, 0.0))
+        self.assertEqual(stats["processed"], 52)
+        self.assertLessEqual(stats["batches"], 52)
+        self.assertEqual(stats["errors"], 0)
+
+        table.update("a", {"n": 50})
+        db.close()
+        db = SmartKDB(self.db_path, post_commit_queue=0)
+        self.assertEqual(len(db.version_manager.get_history("items", "a")), 51)
+        # Synchronous mode: applied inside the write, no worker
+        db.get_table("items").update("a", {"n": 51})
+        self.assertIsNone(db.post_commit._worker)
+        self.assertGreater(db.version_manager.store("items").versions("a")[-1][0], before)
+        self.assertEqual(db.post_commit.stats()["processed"], 1)
+        db.close()
+
+    def test_transactional_writes_wait_for_commit(self):
+        db = SmartKDB(self.db_path)
+        nodes = GatedNodeManager()
+        nodes.gate.set()
+        db.post_commit.node_manager = nodes
+        table = db.create_table("items")
+        table.insert({"id": "a", "n": 0})
+
+        for deferred in (False, True):
+            tx = db.tx_manager.begin(deferred=deferred)
+            table.insert({"id": "b", "n": 1}, transaction_id=tx)
+            table.update("a", {"n": 1}, transaction_id=tx)
+            db.post_commit.flush()
+            self.assertEqual(db.version_manager.get_history("items", "b"), [])
+            db.tx_manager.rollback(tx)
+        # Rolled back writes leave no history and are not replicated
+        self.assertEqual(db.version_manager.get_history("items", "b"), [])
+        self.assertEqual(len(db.version_manager.get_history("items", "a")), 1)
+        self.assertIsNone(table.get("b", as_of=time.time()))
+        self.assertEqual(nodes.sent, [("items", ["a"])])
+
+        tx = db.tx_manager.begin()
+        table.insert({"id": "b", "n": 2}, transaction_id=tx)
+        db.tx_manager.commit(tx)
+        self.assertEqual([e["data"]["n"] for e in db.version_manager.get_history("items", "b")], [2])
+        self.assertEqual(nodes.sent[-1], ("items", ["b"]))
+        db.close()
+
+    def test_backpressure_and_batching(self):
+        nodes = GatedNodeManager()
+        pipeline = PostCommitPipeline(VersionManager(self.db_path), nodes, max_pending=2)
+        pipeline.submit("t", [("k0", {"v": 0})], replicate=True) # Taken by the worker, which waits
+        while pipeline.stats()["pending"]:
+            time.sleep(0.001)
+        pipeline.submit("t", [("k1", {"v": 1})], replicate=True)
+        pipeline.submit("t", [("k2", None)], replicate=True)
+
+        writer = threading.Thread(target=pipeline.submit, args=("t", [("k3", {"v": 3})], True))
+        writer.start()
+        writer.join(0.05)
+        self.assertTrue(writer.is_alive()) # Queue full
+        stats = pipeline.stats()
+        self.assertEqual((stats["pending"], stats["blocked"]), (2, 1))
+        self.assertGreater(stats["lag"], 0)
+        self.assertFalse(pipeline.flush(timeout=0.01))
+
+        nodes.gate.set()
+        writer.join()
+        pipeline.submit("broken", [("x", {"v": 0})], replicate=True)
+        self.assertTrue(pipeline.flush())
+        self.assertEqual(nodes.sent[0], ("t", ["k0"]))
+        self.assertEqual([key for _, keys in nodes.sent for key in keys], ["k0", "k1", "k3"]) # Deletions are not replicated
+        stats = pipeline.stats()
+        self.assertEqual((stats["processed"], stats["errors"]), (5, 1))
+        self.assertLess(stats["batches"], 5)
+        self.assertIn("peer down", stats["last_error"])
+        # Failed replication does not lose the history
+        self.assertEqual(pipeline.version_manager.get_history("broken", "x")[0]["data"], {"v": 0})
+        pipeline.close()
+        pipeline.version_manager.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import shutil
+import os
+import threading
+import time
+from smartkdb.core.storage import BlockStorage
+
+class TestBlockStorage(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = "test_storage_dir"
+        if os.path.exists(self.dir_path):
+            shutil.rmtree(self.dir_path)
+        os.makedirs(self.dir_path)
+        self.storage = BlockStorage(os.path.join(self.dir_path, "data.bin"))
+
+    def tearDown(self):
+        self.storage.close()
+        if os.path.exists(self.dir_path):
+            shutil.rmtree(self.dir_path)
+
+    def test_read_after_append_grows_map(self):
+        # Empty file: nothing is mapped yet
+        self.assertIsNone(self.storage.read_record(0))
+
+        first = self.storage.write_record({"n": 1})
+        self.assertEqual(self.storage.read_record(first), {"n": 1})
+
+        # Appends after the map was created must still be readable
+        offsets = [self.storage.write_record({"n": i}) for i in range(2, 50)]
+        for i, offset in zip(range(2, 50), offsets):
+            self.assertEqual(self.storage.read_record(offset), {"n": i})
+
+    def test_deleted_and_out_of_range(self):
+        offset = self.storage.write_record({"name": "gone"})
+        self.storage.mark_deleted(offset)
+        self.assertIsNone(self.storage.read_record(offset))
+        self.assertIsNone(self.storage.read_record(10_000))
+        self.assertIsNone(self.storage.read_record(-1))
+
+    def test_buffered_writes_reach_file_on_commit(self):
+        offset = self.storage.write_record({"n": 1})
+        # Still buffered, but readable through the storage object
+        self.assertEqual(os.path.getsize(self.storage.path), 0)
+        self.assertEqual(self.storage.read_record(offset), {"n": 1})
+
+        self.storage.write_record({"n": 2})
+        self.storage.commit()
+        reopened = BlockStorage(self.storage.path)
+        try:
+            self.assertEqual(reopened.read_record(offset), {"n": 1})
+        finally:
+            reopened.close()
+
+    def test_group_commit_durability(self):
+        storage = BlockStorage(os.path.join(self.dir_path, "sync.bin"), durability="on_commit")
+        fsyncs = []
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            fsyncs.append(fd)
+            time.sleep(0.005) # A slow disk: committers pile up behind each fsync
+            real_fsync(fd)
+
+        def writer(n):
+            for i in range(20):
+                storage.write_record({"writer": n, "i": i})
+                storage.commit()
+
+        os.fsync = slow_fsync
+        try:
+            threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            os.fsync = real_fsync
+            storage.close()
+
+        # Every commit is covered by an fsync, but committers share them
+        self.assertGreater(len(fsyncs), 0)
+        self.assertLess(len(fsyncs), 160 // 2)
+        self.assertEqual(storage._synced_gen, storage._write_gen)
+
+    def test_second_handle_is_not_overwritten(self):
+        other = BlockStorage(self.storage.path)
+        try:
+            # Taking turns: each append starts at the real end of the file
+            first = self.storage.write_record({"by": "first"})
+            self.storage.commit()
+            second = other.write_record({"by": "other"})
+            other.commit()
+            third = self.storage.write_record({"by": "first", "n": 2})
+            self.storage.commit()
+            self.assertGreater(second, first)
+            self.assertGreater(third, second)
+
+            # Interleaved: the buffered record would land on the other handle's
+            lost = self.storage.write_record({"by": "first", "n": 3})
+            kept = other.write_record({"by": "other", "n": 2})
+            other.commit()
+            self.assertEqual(lost, kept)
+            with self.assertRaises(OSError):
+                self.storage.commit()
+            self.storage.commit()
+
+            reader = BlockStorage(self.storage.path)
+            self.assertEqual([doc for _, doc in reader.scan()],
+                             [{"by": "first"}, {"by": "other"}, {"by": "first", "n": 2}, {"by": "other", "n": 2}])
+            reader.close()
+        finally:
+            other.close()
+
+    def test_binary_codec_and_mixed_files(self):
+        # Records written before the switch keep their JSON encoding
+        old = self.storage.write_record({"n": 1, "name": "json"})
+        self.storage.close()
+
+        self.storage = BlockStorage(self.storage.path, codec="binary")
+        doc = {"n": 2, "ratio": 0.5, "tags": ["a", "b"], "nested": {"ok": True}}
+        new = self.storage.write_record(doc)
+        self.assertEqual(self.storage.read_record(old), {"n": 1, "name": "json"})
+        self.assertEqual(self.storage.read_record(new), doc)
+
+        # Deleting keeps the codec tag and still hides the record
+        self.storage.mark_deleted(new)
+        self.assertIsNone(self.storage.read_record(new))
+        self.assertEqual(self.storage.dead_bytes, self.storage.size - new)
+
+        with self.assertRaises(ValueError):
+            BlockStorage(self.storage.path, codec="xml")
+
+    def test_sequential_scan(self):
+        offsets = [self.storage.write_record({"n": i}) for i in range(10)]
+        self.storage.mark_deleted(offsets[3])
+        self.storage.mark_deleted(offsets[7])
+        scanned = list(self.storage.scan())
+        self.assertEqual([offset for offset, _ in scanned], [o for i, o in enumerate(offsets) if i not in (3, 7)])
+        self.assertEqual([doc["n"] for _, doc in scanned], [0, 1, 2, 4, 5, 6, 8, 9])
+        self.assertEqual(len(list(self.storage.scan(start=offsets[5]))), 4)
+
+    def test_unknown_durability_policy(self):
+        with self.assertRaises(ValueError):
+            BlockStorage(os.path.join(self.dir_path, "bad.bin"), durability="sometimes")
+
+if __name__ == '__main__':
+    unittest.main()
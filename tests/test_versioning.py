@@ -0,0 +1,147 @@
+import unittest
+import shutil
+import os
+import json
+from smartkdb.core.versioning import VersionManager
+
+class TestVersionManager(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_versioning.kdb"
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+        self.vm = VersionManager(self.db_path, snapshot_every=4)
+
+    def tearDown(self):
+        self.vm.close()
+        if os.path.exists(self.db_path):
+            shutil.rmtree(self.db_path)
+
+    def test_delta_versions(self):
+        versions = []
+        doc = {"id": "c", "count": 0, "label": "x" * 200, "tags": [1, 2]}
+        for ts in range(1, 21):
+            doc = dict(doc, count=ts)
+            if ts == 7:
+                del doc["tags"]
+            if ts == 12:
+                doc["tags"] = [1.0, 2.0]
+            versions.append(doc)
+            self.vm.archive_record("counters", "c", doc, timestamp=float(ts))
+        self.vm.archive_record("counters", "c", None, timestamp=21.0)
+
+        store = self.vm.store("counters")
+        records = [store._record(position) for _, position in store.versions("c")]
+        self.assertEqual(sum("delta" in record for record in records), 15) # Every 4th version is full
+        self.assertLess(os.path.getsize(store.segments()[0]), 20 * 200)
+
+        self.vm.close()
+        self.vm = VersionManager(self.db_path, snapshot_every=4)
+        history = self.vm.get_history("counters", "c")
+        self.assertEqual([entry["data"] for entry in history], versions)
+        self.assertEqual(history[12]["data"]["tags"], [1.0, 2.0])
+        self.assertIsInstance(history[12]["data"]["tags"][0], float)
+        self.assertEqual(self.vm.get_version_at("counters", "c", 10.5), versions[9])
+        self.assertIsNone(self.vm.get_version_at("counters", "c", 30.0))
+
+    def test_retention(self):
+        for ts in range(0, 7200, 600):
+            self.vm.archive_records("metrics", [("a", {"v": ts}), ("b", {"v": -ts})], timestamp=float(ts))
+        self.vm.archive_record("metrics", "b", None, timestamp=7200.0)
+
+        self.vm.set_retention("metrics", keep_one_per=3600)
+        self.assertEqual(self.vm.retention("metrics"), {"keep_one_per": 3600})
+        report = self.vm.prune("metrics")
+        self.assertEqual(report["dropped"], 20)
+        self.assertEqual([e["data"]["v"] for e in self.vm.get_history("metrics", "a")], [3000, 6600])
+        self.assertEqual(self.vm.get_version_at("metrics", "a", 4000.0), {"v": 3000})
+        self.assertEqual(sorted(doc["v"] for doc in self.vm.scan_at("metrics", 7000.0)), [-6600, 6600])
+        self.assertEqual(list(self.vm.scan_at("metrics", 7200.0)), [{"v": 6600}])
+
+        self.vm.set_retention("metrics", max_versions=1)
+        self.vm.prune("metrics")
+        self.assertEqual([e["data"]["v"] for e in self.vm.get_history("metrics", "a")], [6600])
+
+        # Everything is older than max_age: only the current versions stay, deletions go
+        self.vm.set_retention("metrics", max_age=60)
+        self.vm.prune("metrics")
+        self.assertEqual(self.vm.get_history("metrics", "b"), [])
+        self.assertEqual(self.vm.store("metrics").versions("b"), [])
+        self.assertEqual(self.vm.get_version_at("metrics", "a", 1e12), {"v": 6600})
+
+        with self.assertRaises(ValueError):
+            self.vm.set_retention("metrics", max_versions=0)
+
+    def test_scan_includes_legacy_history(self):
+        # Per-record JSON files as written by older versions
+        legacy = {
+            "metrics_a.json": [{"timestamp": 10.0, "data": {"id": "a", "v": 1}}],
+            "metrics_b.json": [{"timestamp": 10.0, "data": {"id": "b", "v": 1}},
+                               {"timestamp": 20.0, "data": {"id": "b", "v": 2}}],
+            "metrics_x_1.json": [{"timestamp": 10.0, "data": {"id": "x-1", "v": 1}}],
+            "metrics_raw_c.json": [{"timestamp": 10.0, "data": {"id": "c", "v": 1}}],
+        }
+        for name, history in legacy.items():
+            with open(os.path.join(self.vm.history_path, name), "w") as f:
+                json.dump(history, f)
+        os.makedirs(os.path.join(self.db_path, "tables", "metrics_raw"))
+        self.vm.archive_record("metrics", "b", {"id": "b", "v": 3}, timestamp=30.0)
+        self.vm.archive_record("metrics", "x-1", None, timestamp=30.0)
+        self.vm.archive_record("metrics", "d", {"id": "d", "v": 1}, timestamp=30.0)
+
+        def scan(ts):
+            return sorted((doc["id"], doc["v"]) for doc in self.vm.scan_at("metrics", ts))
+
+        self.assertEqual(scan(5.0), [])
+        self.assertEqual(scan(25.0), [("a", 1), ("b", 2), ("x-1", 1)])
+        self.assertEqual(scan(35.0), [("a", 1), ("b", 3), ("d", 1)])
+        self.assertEqual(scan(35.0), sorted((key, doc["v"]) for key in ("a", "b", "d", "x-1")
+                                            for doc in [self.vm.get_version_at("metrics", key, 35.0)] if doc))
+        self.assertEqual([doc["id"] for doc in self.vm.scan_at("metrics_raw", 35.0)], ["c"])
+
+    def test_background_prune(self):
+        self.vm.close()
+        self.vm = VersionManager(self.db_path, prune_interval=0)
+        for n in range(10):
+            self.vm.archive_record("events", "e", {"n": n, "pad": "x" * 100})
+        store = self.vm.store("events")
+        self.assertIsNone(store._pruner) # No policy, no pruning
+
+        self.vm.set_retention("events", max_versions=2)
+        self.vm.archive_record("events", "e", {"n": 10, "pad": "x" * 100})
+        store._pruner.join()
+        self.assertEqual(store.last_prune["dropped"], 9)
+        self.assertEqual([e["data"]["n"] for e in self.vm.get_history("events", "e")], [9, 10])
+
+    def test_sealed_segments_keep_their_index(self):
+        self.vm.close()
+        self.vm = VersionManager(self.db_path, segment_bytes=2048, prune_interval=None)
+        for n in range(60):
+            self.vm.archive_records("events", [("a", {"n": n, "pad": "x" * 50}), (f"k{n}", {"n": n})],
+                                    timestamp=float(n))
+        store = self.vm.store("events")
+        self.assertGreater(len(store.segments()), 3)
+        self.assertEqual(len([name for name in os.listdir(store.path) if name.endswith(".idx")]),
+                         len(store.segments()) - 1)
+
+        # Reopened: only the current segment is scanned
+        self.vm.close()
+        self.vm = VersionManager(self.db_path, segment_bytes=2048, prune_interval=None)
+        store = self.vm.store("events")
+        scanned = []
+        segment_index = store._segment_index
+        store._segment_index = lambda seq, start=0: scanned.append(seq) or segment_index(seq, start)
+        self.assertEqual([e["data"]["n"] for e in self.vm.get_history("events", "a")], list(range(60)))
+        self.assertEqual(self.vm.get_version_at("events", "k7", 30.0), {"n": 7})
+        self.assertEqual(set(scanned), {store._seqs[-1]})
+
+        # Pruning rewrites the indexes of the segments it changes
+        self.vm.set_retention("events", max_versions=1)
+        self.vm.prune("events")
+        self.vm.close()
+        self.vm = VersionManager(self.db_path, segment_bytes=2048, prune_interval=None)
+        self.assertEqual([e["data"]["n"] for e in self.vm.get_history("events", "a")], [59])
+        self.assertEqual(len(self.vm.get_history("events", "k7")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()